@@ -2,30 +2,70 @@
 
 from flask import Flask
 from app.config import Config
-from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager
 from flask_security import SQLAlchemyUserDatastore
 from flask_security import Security
 from flask_moment import Moment
+from app.ingest import IngestQueue
+from app.tokens import TokenCache, UserSessions
+from app.activity import ActivityTracker
+from app.feed import DataFeed
+from app.retention import Retention
+from app.partitions import DataPartitions
+from app.instrumentation import SQLInstrumentation
+from app.metrics import Metrics
+from app.counters import Counters
+from app.rollups import Rollups
+from app.snapshots import LatestSnapshots
+from app.versions import ChangeVersions
+from app.compression import Compression
+from app.database import ProfiledSQLAlchemy, DatabaseProfile
+from app import migrations, serialize
 import cli
 
 
-db = SQLAlchemy()
+db = ProfiledSQLAlchemy()
+db_profile = DatabaseProfile()
 login = LoginManager()
 login.login_view = 'auth.login'
 security = Security()
 moment = Moment()
-
-
-
-def create_app():
+ingest_queue = IngestQueue()
+token_cache = TokenCache()
+user_sessions = UserSessions()
+activity_tracker = ActivityTracker()
+data_feed = DataFeed()
+retention = Retention()
+data_partitions = DataPartitions()
+sql_instrumentation = SQLInstrumentation()
+metrics = Metrics()
+counters = Counters()
+rollups = Rollups()
+latest_snapshots = LatestSnapshots()
+change_versions = ChangeVersions()
+compression = Compression()
+
+
+
+def create_app(config_class=Config):
     
     app = Flask(__name__)
-    app.config.from_object(Config)
+    app.config.from_object(config_class)
+    serialize.set_encoder(app.config.get('JSON_ENCODER', 'auto'))
 
     db.init_app(app)
+    db_profile.init_app(app)
+    sql_instrumentation.init_app(app)
+    metrics.init_app(app)
+    compression.init_app(app)
     login.init_app(app)
     moment.init_app(app)
+    token_cache.init_app(app)
+    user_sessions.init_app(app)
+    data_partitions.init_app(app)
+    counters.init_app(app)
+    rollups.init_app(app)
+    change_versions.init_app(app)
 
     from app.auth import auth as auth_bp
     app.register_blueprint(auth_bp)
@@ -41,7 +81,15 @@ def create_app():
     security.init_app(app, app.user_datastore)
 
     with app.app_context():
+        new_database = not db.engine.has_table('data')
         db.create_all()
+        if new_database:
+            migrations.stamp(db.engine)
+        migrations.require_current(app, db.engine)
+
+    ingest_queue.init_app(app)
+    activity_tracker.init_app(app)
+    retention.init_app(app)
   
     cli.register(app)
 
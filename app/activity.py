@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+
+import atexit
+import threading
+from sqlalchemy import bindparam, text
+
+
+# Поля, которые можно отмечать через трекер: таблица -> допустимые колонки
+TRACKED_FIELDS = {
+    'users': ('last_login_at', 'last_logout_at'),
+    'clients': ('last_login_at',),
+}
+
+
+class ActivityTracker(object):
+    """Отметки активности ("последний вход") без записи в базу на каждый запрос.
+
+    touch() только запоминает время в памяти; фоновый поток раз в
+    ACTIVITY_FLUSH_INTERVAL секунд (и при остановке процесса) пишет все
+    накопленные отметки одним пакетным UPDATE на колонку. last_seen()
+    возвращает более позднее из значения в памяти и значения из базы.
+
+    Поток запускается первым обслуженным запросом (после того как
+    применены миграции, app/migrations.py) и только при BACKGROUND_JOBS:
+    flask-команды и бенчмарки его не запускают, их отметки пишутся при
+    остановке процесса.
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self.interval = 10
+        self._pending = {}
+        self._flushing = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._exit_registered = False
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.interval = app.config.get('ACTIVITY_FLUSH_INTERVAL', self.interval)
+
+        if not self._exit_registered:
+            self._exit_registered = True
+            atexit.register(self.stop)
+        if app.config.get('BACKGROUND_JOBS', True):
+            app.before_request(self.start)
+
+    def start(self):
+        # вызывается перед каждым запросом; после запуска потока - сразу выход
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name='activity-flusher')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def touch(self, table, id, field, when):
+        if field not in TRACKED_FIELDS.get(table, ()):
+            raise ValueError('Поле %s.%s не отслеживается' % (table, field))
+        key = (table, id, field)
+        with self._lock:
+            current = self._pending.get(key)
+            if current is None or when > current:
+                self._pending[key] = when
+
+    def last_seen(self, table, id, field, stored=None):
+        key = (table, id, field)
+        with self._lock:
+            values = [value for value in (self._pending.get(key), self._flushing.get(key), stored) if value]
+        if not values:
+            return None
+        return max(values)
+
+    def pending(self):
+        with self._lock:
+            return len(self._pending)
+
+    def flush(self):
+        from app import db
+
+        with self._flush_lock:
+            with self._lock:
+                if not self._pending:
+                    return 0
+                self._flushing, self._pending = self._pending, {}
+
+            # один пакетный UPDATE (executemany) на каждую пару таблица/колонка;
+            # более старое время никогда не перетирает более новое
+            groups = {}
+            for (table, id, field), when in self._flushing.items():
+                groups.setdefault((table, field), []).append({'id': id, 'value': when})
+
+            try:
+                with self.app.app_context():
+                    try:
+                        for (table, field), params in groups.items():
+                            statement = text(
+                                'UPDATE %s SET %s = :value WHERE id = :id AND (%s IS NULL OR %s < :value)'
+                                % (table, field, field, field)
+                            ).bindparams(bindparam('value', type_=db.DateTime))
+                            db.session.execute(statement, params)
+                        db.session.commit()
+                    except Exception:
+                        db.session.rollback()
+                        raise
+            except Exception:
+                self.app.logger.exception('Activity tracker: ошибка записи отметок активности')
+                with self._lock:
+                    for key, when in self._flushing.items():
+                        current = self._pending.get(key)
+                        if current is None or when > current:
+                            self._pending[key] = when
+                    self._flushing = {}
+                return 0
+
+            with self._lock:
+                count = len(self._flushing)
+                self._flushing = {}
+            return count
+
+    def stop(self):
+        if self._stop.is_set():
+            return
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.flush()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.flush()
@@ -1,8 +1,11 @@
 # -*- coding: utf-8 -*-
 
-from flask import g, Response, abort, jsonify, make_response
+from flask import g, Response, abort
+from app import token_cache, activity_tracker, user_sessions
 from app.models import Client, Parser, User
-from flask_httpauth import HTTPTokenAuth, HTTPBasicAuth
+from app.tokens import TokenIdentity
+from app.serialize import json_response
+from flask_httpauth import HTTPTokenAuth, HTTPBasicAuth, MultiAuth
 from .errors import error_response
 from datetime import datetime, timedelta
 
@@ -13,19 +16,32 @@ parser_token_auth = HTTPTokenAuth()
 
 users_basic_auth = HTTPBasicAuth()
 
+users_token_auth = HTTPTokenAuth()
+
+# API пользователей: Basic-авторизация или Bearer-токен из /api/v1.0/auth/token
+users_auth = MultiAuth(users_basic_auth, users_token_auth)
+
 
 @client_token_auth.verify_token
 def verify_token(token):
-    client = Client.query.filter_by(token=token).first()
-    if client and client.active:
+    g.client = None
+    identity = token_cache.get('client', token)
+
+    if identity is None:
+        client = Client.query.filter_by(token=token).first()
+        if client is None:
+            return False
+        identity = TokenIdentity('client', client.id, client.active, client.token_expiration)
+        token_cache.set(token, identity)
+
+    if identity.active:
 
-        if client.token_expiration < datetime.utcnow():
-            resp = make_response(jsonify({'error':'The key has expired!'}))
-            resp.headers ['Content-Type'] = 'application/json'
-            return abort(resp)
+        if identity.expiration < datetime.utcnow():
+            return abort(json_response({'error':'The key has expired!'}))
         else:
-            client.update_last_login_time(datetime.utcnow())
-            return client 
+            activity_tracker.touch('clients', identity.id, 'last_login_at', datetime.utcnow())
+            g.client = identity
+            return identity
     else: 
         return False
 
@@ -38,17 +54,50 @@ def token_auth_error():
 @parser_token_auth.verify_token
 def verify_token(token):
 
-    parser = Parser.query.filter_by(token=token).first()
-    if not parser:
-        return None
-    return parser
+    g.parser = None
+    identity = token_cache.get('parser', token)
+
+    if identity is None:
+        parser = Parser.query.filter_by(token=token).first()
+        if not parser:
+            return None
+        identity = TokenIdentity('parser', parser.id, True, None)
+        token_cache.set(token, identity)
+
+    g.parser = identity
+    return identity
 
 
 @users_basic_auth.verify_password
 def verify_password(username, password):
     g.user = None
-    user = User.query.filter_by(name=username).first()
-    if user is not None and user.active and user.check_password(password):
+    user = None
+
+    # повторная проверка той же пары логин/пароль не считает PBKDF2
+    user_id = user_sessions.check_credentials(username, password)
+    if user_id is not None:
+        user = User.query.get(user_id)
+    else:
+        user = User.query.filter_by(name=username).first()
+        if user is not None and user.check_password(password):
+            user_sessions.remember_credentials(username, password, user.id)
+        else:
+            user = None
+
+    return _login_api_user(user)
+
+
+@users_token_auth.verify_token
+def verify_user_token(token):
+    g.user = None
+    user = user_sessions.verify_token(token, User.query.get)
+    if user is None:
+        return False
+    return _login_api_user(user)
+
+
+def _login_api_user(user):
+    if user is not None and user.active:
         user._update_last_login_time(datetime.utcnow())
         user._update_last_logout_time(datetime.utcnow() + timedelta(seconds=60))
         g.user = user
@@ -1,21 +1,37 @@
 # -*- coding: utf-8 -*-
 
-from flask import jsonify, request, current_app, g
+from flask import request, current_app, g, Response, stream_with_context
 from flask_security import login_required, roles_required, roles_accepted, current_user
 from werkzeug.security import generate_password_hash, check_password_hash
 from . import api
-from app import db
+from app import db, db_profile, export, ingest_queue, token_cache, user_sessions, data_feed, sql_instrumentation, metrics, rollups, latest_snapshots, change_versions
+from app.ingest import QueueFull
 from app.models import Data, User, Parser, Client, Role
-from .auth import client_token_auth, parser_token_auth, users_basic_auth
+from app.streaming import wants_ndjson, ndjson_response
+from app.serialize import canonical_json, dumps, json_response
+from app.filters import get_data_filters, get_rollup_params, parse_datestamp
+from .auth import client_token_auth, parser_token_auth, users_basic_auth, users_auth
+from .errors import error_response
 from datetime import datetime
+import time
 
 
 ###############################################################################################################
 #                                           Client API                                                        #
 ###############################################################################################################
+#  Параметры get_data (query string):                                                                         #
+#     after_id=<id>           - записи новее id, по возрастанию id (инкрементальный опрос)                      #
+#     before_id=<id>          - записи старше id, по убыванию id (листание истории)                             #
+#     parser_id=<id>[,<id>]   - только данные указанных парсеров                                                #
+#     date_from, date_to      - диапазон datestamp, формат %Y-%m-%d %H:%M:%S                                     #
+#  count ограничен CLIENT_DATA_MAX_PAGE, в ответе next_cursor - параметр для следующего запроса                #
+#  ?stream=1 или Accept: application/x-ndjson - потоковый ответ NDJSON, count до CLIENT_DATA_MAX_STREAM       #
+#  ETag / Last-Modified: If-None-Match / If-Modified-Since без новых данных - ответ 304                       #
+###############################################################################################################
+@api.route('/api/v1.0/clients/get_data', methods=['GET'])
 @api.route('/api/v1.0/clients/get_data/<int:count>', methods=['GET'])
 @client_token_auth.login_required
-def get_client_data(count):
+def get_client_data(count=None):
     
 
     api_resp = {
@@ -29,22 +45,236 @@ def get_client_data(count):
     api_resp['url'] = '/api/v1.0/clients/get_data/<count>'
     api_resp['method'] = 'GET'
 
+    metrics.client_polled(g.client.id)
+
+    stream = wants_ndjson()
+
+    if count is None:
+        count = current_app.config['CLIENT_DATA_DEFAULT_PAGE']
+    if stream:
+        count = min(count, current_app.config['CLIENT_DATA_MAX_STREAM'])
+    else:
+        count = min(count, current_app.config['CLIENT_DATA_MAX_PAGE'])
+
+    try:
+        filters = get_data_filters(request.args)
+    except ValueError:
+        api_resp['success'] = False
+        api_resp['error'] = 'Неверный формат параметров after_id, before_id, parser_id, date_from, date_to!'
+        return json_response(api_resp)
+
+    # условный GET: пока в data ничего не менялось, ответ тот же - 304 без запроса к data
+    validator = change_versions.validator(['data'], stream)
+    if validator.not_modified:
+        return validator.response()
+
+    # потоковый режим: одна запись - одна строка NDJSON, без конверта api_resp
+    if stream:
+        data = Data.iter_page(limit=count, chunk_size=current_app.config['STREAM_CHUNK_SIZE'], **filters)
+        return validator.apply(ndjson_response(item.to_dict() for item in data))
+
     data_list = []
-    data = db.session.query(Data).order_by(Data.id.desc()).limit(count)
-
-    for item in data:
-        new_item = {
-            'id': item.id,
-            'parser_id': item.parser_id,
-            'datestamp': item.datestamp,
-            'json': item.json
-        }
-        data_list.append(new_item)
+
+    for item in Data.iter_page(limit=count, **filters):
+        data_list.append(item.to_dict())
+
+    if 'after_id' in filters:
+        # при пустом ответе опрашиваем дальше с того же места
+        last_id = data_list[-1]['id'] if data_list else filters['after_id']
+        api_resp['next_cursor'] = {'after_id': last_id}
+    elif data_list and len(data_list) == count:
+        api_resp['next_cursor'] = {'before_id': data_list[-1]['id']}
+    else:
+        api_resp['next_cursor'] = None
 
     api_resp['success'] = True
     api_resp['resp_data'] = data_list
 
-    return jsonify(api_resp)
+    # json записей уже сериализован в базе и вставляется в ответ как есть
+    return validator.apply(json_response(api_resp))
+
+
+###############################################################################################################
+#  /api/v1.0/clients/latest - последняя запись каждого парсера (текущее состояние), по строке на парсер       #
+#     parser_id=<id>[,<id>]   - только указанные парсеры                                                      #
+###############################################################################################################
+@api.route('/api/v1.0/clients/latest', methods=['GET'])
+@client_token_auth.login_required
+def get_client_latest():
+
+    api_resp = {
+        'url': '',     
+        'method': '',                 
+        'success': True,                 
+        'resp_data': '',               
+        'error': ''                
+    }
+
+    api_resp['url'] = '/api/v1.0/clients/latest'
+    api_resp['method'] = 'GET'
+
+    metrics.client_polled(g.client.id)
+
+    try:
+        parser_ids = get_data_filters(request.args).get('parser_ids')
+    except ValueError:
+        api_resp['success'] = False
+        api_resp['error'] = 'Неверный формат параметра parser_id!'
+        return json_response(api_resp)
+
+    api_resp['resp_data'] = [item.to_dict() for item in latest_snapshots.latest(parser_ids)]
+
+    return json_response(api_resp)
+
+
+###############################################################################################################
+#  /api/v1.0/clients/export - выгрузка записей потоком для анализа (pandas, pyarrow)                          #
+#     format=csv|msgpack|arrow - по умолчанию csv; msgpack и arrow - если установлены msgpack, pyarrow       #
+#     parser_id, date_from, date_to, after_id, before_id - как у get_data, по умолчанию все записи по id      #
+#     limit=<n>               - не больше n записей, до CLIENT_EXPORT_MAX_ROWS                                #
+#  Столбцы id, parser_id, datestamp (UTC), json (строка как в базе):                                          #
+#     csv     - заголовок и строки, datestamp %Y-%m-%d %H:%M:%S                                               #
+#     msgpack - по массиву [id, parser_id, datestamp, json] на запись, datestamp в секундах                   #
+#     arrow   - Arrow IPC stream, RecordBatch на CLIENT_EXPORT_BATCH записей, datestamp - timestamp[s]        #
+###############################################################################################################
+@api.route('/api/v1.0/clients/export', methods=['GET'])
+@client_token_auth.login_required
+def get_client_export():
+
+    api_resp = {
+        'url': '',     
+        'method': '',                 
+        'success': True,                 
+        'resp_data': '',               
+        'error': ''                
+    }
+
+    api_resp['url'] = '/api/v1.0/clients/export'
+    api_resp['method'] = 'GET'
+
+    config = current_app.config
+    name = request.args.get('format', 'csv')
+    if name not in export.FORMATS:
+        api_resp['success'] = False
+        api_resp['error'] = 'Неизвестный формат, ожидается: %s' % ', '.join(sorted(export.FORMATS))
+        return json_response(api_resp, 400)
+    chunks, mimetype, extension, available = export.FORMATS[name]
+    if not available:
+        api_resp['success'] = False
+        api_resp['error'] = 'Формат недоступен на сервере, доступны: %s' % ', '.join(export.available_formats())
+        return json_response(api_resp, 501)
+
+    try:
+        filters = get_data_filters(request.args)
+        limit = min(int(request.args.get('limit', config['CLIENT_EXPORT_MAX_ROWS'])), config['CLIENT_EXPORT_MAX_ROWS'])
+    except ValueError:
+        api_resp['success'] = False
+        api_resp['error'] = 'Неверный формат параметров after_id, before_id, parser_id, date_from, date_to, limit!'
+        return json_response(api_resp, 400)
+    if 'after_id' not in filters and 'before_id' not in filters:
+        filters['after_id'] = 0
+
+    validator = change_versions.validator(['data'])
+    if validator.not_modified:
+        return validator.response()
+
+    # строки читаются из курсора пачками, без ORM и без разбора json
+    batches = Data.iter_batches(limit=limit, chunk_size=config['CLIENT_EXPORT_BATCH'], epoch=True, **filters)
+    response = Response(stream_with_context(chunks(batches)), mimetype=mimetype)
+    response.headers['Content-Disposition'] = 'attachment; filename=export-%s.%s' % (
+        datetime.utcnow().strftime('%Y%m%d-%H%M%S'), extension)
+    return validator.apply(response)
+
+
+def format_sse_event(item):
+    return 'id: %d\nevent: data\ndata: %s\n\n' % (item['id'], dumps(item))
+
+
+###############################################################################################################
+#  /api/v1.0/clients/stream - новые записи Data по мере их появления                                          #
+#     по умолчанию Server-Sent Events (text/event-stream), id события = Data.id,                              #
+#     переподключение продолжает с заголовка Last-Event-ID;                                                   #
+#     ?mode=poll - long-poll: ответ приходит, как только есть записи новее after_id,                          #
+#     или пустым через FEED_LONGPOLL_TIMEOUT секунд;                                                          #
+#     без курсора - только записи, пришедшие после подключения; фильтры parser_id, date_from, date_to -       #
+#     как в get_data                                                                                          #
+###############################################################################################################
+@api.route('/api/v1.0/clients/stream', methods=['GET'])
+@client_token_auth.login_required
+def get_client_stream():
+
+    api_resp = {
+        'url': '',     
+        'method': '',                 
+        'success': True,                 
+        'resp_data': '',               
+        'error': ''                
+    }
+
+    api_resp['url'] = '/api/v1.0/clients/stream'
+    api_resp['method'] = 'GET'
+
+    try:
+        filters = get_data_filters(request.args)
+        if request.headers.get('Last-Event-ID'):
+            filters['after_id'] = int(request.headers['Last-Event-ID'])
+    except ValueError:
+        api_resp['success'] = False
+        api_resp['error'] = 'Неверный формат параметров after_id, parser_id, date_from, date_to, Last-Event-ID!'
+        return json_response(api_resp)
+
+    parser_ids = filters.get('parser_ids')
+    date_from = filters.get('date_from')
+    date_to = filters.get('date_to')
+    after_id = filters.get('after_id')
+    if after_id is None:
+        after_id = Data.max_id()
+
+    config = current_app.config
+
+    def read_new(after_id):
+        version = data_feed.version
+        items = [item.to_dict() for item in Data.iter_page(parser_ids=parser_ids, after_id=after_id,
+                                                            date_from=date_from, date_to=date_to,
+                                                            limit=config['FEED_BATCH'])]
+        # не держим транзакцию открытой, пока ждем новых записей
+        db.session.rollback()
+        return version, items
+
+    if request.args.get('mode') == 'poll':
+        deadline = time.time() + config['FEED_LONGPOLL_TIMEOUT']
+        version, items = read_new(after_id)
+        while not items and time.time() < deadline:
+            # уведомления приходят только от записей этого процесса, поэтому
+            # не реже раза в FEED_HEARTBEAT проверяем базу сами
+            notified = data_feed.wait(version, min(config['FEED_HEARTBEAT'], deadline - time.time()))
+            if not notified:
+                newest = Data.max_id()
+                db.session.rollback()
+                if not newest or newest <= after_id:
+                    continue
+            version, items = read_new(after_id)
+
+        api_resp['resp_data'] = items
+        api_resp['next_cursor'] = {'after_id': items[-1]['id'] if items else after_id}
+        return json_response(api_resp)
+
+    def generate(after_id):
+        deadline = time.time() + config['FEED_SSE_MAX_DURATION']
+        yield 'retry: 3000\n\n'
+        while time.time() < deadline:
+            version, items = read_new(after_id)
+            for item in items:
+                yield format_sse_event(item)
+            if items:
+                after_id = items[-1]['id']
+            elif not data_feed.wait(version, min(config['FEED_HEARTBEAT'], deadline - time.time())):
+                yield ': keepalive\n\n'
+
+    response = Response(stream_with_context(generate(after_id)), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
 
 
 ###############################################################################################################
@@ -54,8 +284,6 @@ def get_client_data(count):
 @parser_token_auth.login_required
 def set_parser_data():
 
-    format = r"%Y-%m-%d %H:%M:%S"
-    
     api_resp = {
         'url': '',     
         'method': '',                 
@@ -70,21 +298,148 @@ def set_parser_data():
     api_resp['url'] = '/api/v1.0/parsers/set_data'
     api_resp['method'] = 'POST'
 
-    parser = Parser.query.filter_by(token=data['token']).first()
+    parser = g.parser
 
-    if parser:
-        parser.set_data(datestamp=datetime.strptime(data['datestamp'][:-7], format), json=str(data['json']))
-        api_resp['success'] = True
+    if parser is None:
+        api_resp['success'] = False
+        return json_response(api_resp)
+
+    datestamp = parse_datestamp(data['datestamp'])
+
+    try:
+        json_data = canonical_json(data['json'])
+    except (TypeError, ValueError):
+        api_resp['success'] = False
+        api_resp['error'] = 'Поле json должно содержать корректный JSON!'
+        return json_response(api_resp)
+
+    if ingest_queue.enabled:
+        try:
+            ingest_queue.put(parser.id, datestamp, json_data)
+        except QueueFull:
+            response = error_response(503, 'Очередь записи переполнена, повторите позже!')
+            response.headers['Retry-After'] = str(ingest_queue.retry_after)
+            return response
+        api_resp['resp_data'] = {'queue_depth': ingest_queue.depth()}
     else:
+        Data.add_records(parser.id, [{'datestamp': datestamp, 'json': json_data}])
+
+    metrics.ingested(parser.id, 1, len(json_data.encode('utf-8')))
+
+    api_resp['success'] = True
+
+    return json_response(api_resp)
+
+
+@api.route('/api/v1.0/parsers/queue', methods=['GET'])
+@parser_token_auth.login_required
+def get_ingest_queue():
+
+    api_resp = {
+        'url': '',     
+        'method': '',                 
+        'success': True,                 
+        'resp_data': '',               
+        'error': ''                
+    }
+
+    api_resp['url'] = '/api/v1.0/parsers/queue'
+    api_resp['method'] = 'GET'
+    api_resp['resp_data'] = {
+        'write_behind': ingest_queue.enabled,
+        'depth': ingest_queue.depth(),
+        'max_size': ingest_queue.max_size if ingest_queue.enabled else 0
+    }
+
+    return json_response(api_resp)
+
+
+@api.route('/api/v1.0/parsers/set_data_batch', methods=['POST'])
+@parser_token_auth.login_required
+def set_parser_data_batch():
+
+    api_resp = {
+        'url': '',     
+        'method': '',                 
+        'success': True,                 
+        'resp_data': '',               
+        'error': ''                
+    }
+
+    api_resp['url'] = '/api/v1.0/parsers/set_data_batch'
+    api_resp['method'] = 'POST'
+
+    # массив записей передается в поле records: голый JSON-массив в теле
+    # запроса ломает request loader flask_security (он ждет объект)
+    data = request.get_json(silent=True)
+
+    if isinstance(data, dict):
+        data = data.get('records')
+
+    if not isinstance(data, list):
+        api_resp['success'] = False
+        api_resp['error'] = 'Необходимо передать массив записей {datestamp, json} в параметре records!'
+        return json_response(api_resp)
+
+    max_records = current_app.config['PARSER_BATCH_MAX_RECORDS']
+    if len(data) > max_records:
         api_resp['success'] = False
+        api_resp['error'] = 'Слишком много записей в пакете, максимум %d!' % max_records
+        return json_response(api_resp)
+
+    records = []
+    statuses = []
+
+    for index, item in enumerate(data):
+        status = {'index': index, 'success': False, 'error': ''}
+        statuses.append(status)
+
+        if not isinstance(item, dict) or 'datestamp' not in item or 'json' not in item:
+            status['error'] = 'Нет одного или нескольких параметров: datestamp, json'
+            continue
+
+        try:
+            datestamp = parse_datestamp(item['datestamp'])
+        except (TypeError, ValueError, AttributeError):
+            status['error'] = 'Неверный формат datestamp!'
+            continue
+
+        try:
+            json_data = canonical_json(item['json'])
+        except (TypeError, ValueError):
+            status['error'] = 'Поле json должно содержать корректный JSON!'
+            continue
 
-    return jsonify(api_resp)
+        records.append({'datestamp': datestamp, 'json': json_data})
+        status['success'] = True
+
+    try:
+        Data.add_records(g.parser.id, records)
+        metrics.ingested(g.parser.id, len(records), sum(len(record['json'].encode('utf-8')) for record in records))
+    except:
+        for status in statuses:
+            if status['success']:
+                status['success'] = False
+                status['error'] = 'Ошибка записи данных!'
+        api_resp['error'] = 'Ошибка записи данных!'
+
+    accepted = len([status for status in statuses if status['success']])
+
+    api_resp['success'] = accepted == len(statuses)
+    api_resp['resp_data'] = {
+        'accepted': accepted,
+        'rejected': len(statuses) - accepted,
+        'records': statuses
+    }
+
+    return json_response(api_resp)
 
 
 ###############################################################################################################
 #                                           User API                                                          #
 ###############################################################################################################
 #  +  /api/v1.0/help                     GET       root, admin, moderator                                                 #
+#  +  /api/v1.0/auth/token               POST      root, admin, moderator (только Basic)                       #
 #  +  /api/v1.0/users/get                GET       root, admin                                                 #
 #  +  /api/v1.0/users/add                POST      root, admin                                                 #
 #  +  /api/v1.0/users/del                POST      root, admin                                                 #
@@ -93,8 +448,11 @@ def set_parser_data():
 #  +  /api/v1.0/clients/del              POST      root, admin, moderator                                      #
 #     /api/v1.0/clients/prolong          POST      root, admin, moderator                                      #
 #  +  /api/v1.0/parsers/get              GET       root, admin                                                 #
+#  +  /api/v1.0/parsers/get_data/<id>    GET       root, admin                                                 #
 #  +  /api/v1.0/parsers/add              POST      root, admin                                                 #
 #  +  /api/v1.0/parsers/del              POST      root, admin                                                 #
+#  +  /api/v1.0/system/sql_stats         GET       root, admin                                                 #
+#  +  /metrics                           GET       root, admin                                                 #
 ###############################################################################################################
 #    response_data = {                                                                                        #
 #       'api': '/api/v1.0/users/',                                                                            #
@@ -105,9 +463,29 @@ def set_parser_data():
 # }                                                                                                           #
 ###############################################################################################################
 
+# Получить токен пользователя
+@api.route('/api/v1.0/auth/token', methods=['POST'])
+@users_basic_auth.login_required
+def get_user_token():
+    resp_data = {}
+    resp_data['api'] = '/api/v1.0/auth/token'
+    resp_data['method'] = 'post'
+    resp_data['error'] = ''
+
+    token, expiration = user_sessions.issue_token(g.user)
+
+    resp_data['data'] = {
+        'token': token,
+        'token_expiration': expiration
+    }
+    resp_data['success'] = True
+
+    return json_response(resp_data)
+
+
 # Получить пользователей
 @api.route('/api/v1.0/help', methods=['GET'])
-@users_basic_auth.login_required
+@users_auth.login_required
 def get_help():
     resp_data = {}
     resp_data['api'] = '/api/v1.0/help'
@@ -115,6 +493,7 @@ def get_help():
     resp_data['data'] = {
         'routes': [
             { 'url': '/api/v1.0/help', 'description':'Справка', 'method':'GET', 'access':'root, admin, moderator'},
+            { 'url': '/api/v1.0/auth/token', 'description':'Получить токен для заголовка Authorization: Bearer, только Basic-авторизация', 'method':'POST', 'access':'root, admin, moderator'},
             { 'url': '/api/v1.0/users/get','description':'Получить пользователей', 'method': 'GET', 'access': 'root, admin'},
             { 'url': '/api/v1.0/users/add','description':'Добавить пользователя, принимает параметры: name', 'method': 'POST', 'access': 'root, admin'},
             {'url': '/api/v1.0/users/del', 'description': 'Удалить пользователей, принимает параметры: id или token',
@@ -126,19 +505,27 @@ def get_help():
             {'url': '/api/v1.0/clients/prolong', 'description': 'Продлить токен клиента, принимает параметры: id или token и days(количество дней)',
                 'method': 'GET', 'access': 'root, admin, moderator'},
             { 'url': '/api/v1.0/parsers/get','description':'Получить парсеры', 'method':'GET', 'access':'root, admin'},
+            { 'url': '/api/v1.0/parsers/get_data/<id>','description':'Получить данные парсера, ?stream=1 - потоковый ответ NDJSON', 'method':'GET', 'access':'root, admin'},
+            { 'url': '/api/v1.0/parsers/rollups/<id>','description':'Сводки приема данных парсера, параметры: period (minute, hour, day), date_from, date_to, fill', 'method':'GET', 'access':'root, admin'},
             {'url': '/api/v1.0/parsers/add', 'description': 'Добавить парсер, принимает параметры: name',
                 'method': 'GET', 'access': 'root, admin'},
             {'url': '/api/v1.0/parsers/del', 'description': 'Удалить парсер , принимает параметры: id или token',
+                'method': 'GET', 'access': 'root, admin'},
+            {'url': '/api/v1.0/system/sql_stats', 'description': 'Сводка запросов к базе по endpoint, ?reset=1 - сбросить',
+                'method': 'GET', 'access': 'root, admin'},
+            {'url': '/api/v1.0/system/db_stats', 'description': 'Профиль базы, пул соединений и блокировки, ?reset=1 - сбросить',
+                'method': 'GET', 'access': 'root, admin'},
+            {'url': '/metrics', 'description': 'Метрики в формате Prometheus',
                 'method': 'GET', 'access': 'root, admin'}
         ]
     }
     resp_data['error'] = ''
-    return jsonify(resp_data)
+    return json_response(resp_data)
 
 
 # Получить пользователей
 @api.route('/api/v1.0/users/get', methods=['GET'])
-@users_basic_auth.login_required
+@users_auth.login_required
 def get_users():
     resp_data = {}
     resp_data['api'] = '/api/v1.0/users/get'                                                                          
@@ -147,14 +534,14 @@ def get_users():
     resp_data['error'] = ''
     
     if g.user.has_role('root'):
-        users = User.query.all()
+        users = User.query.options(db.selectinload(User.roles)).all()
         for user in users:
             resp_data['data'].append(user.to_dict())
         resp_data['success'] = True
 
 
     elif g.user.has_role('admin'):
-        users = User.query.filter_by(parent_id=g.user.id).all()
+        users = User.query.filter_by(parent_id=g.user.id).options(db.selectinload(User.roles)).all()
         for user in users:
             resp_data['data'].append(user.to_dict())
         resp_data['success'] = True
@@ -162,12 +549,12 @@ def get_users():
     else:
         resp_data['success'] = False
 
-    return jsonify(resp_data)
+    return json_response(resp_data)
 
 
 # Создание пользователей
 @api.route('/api/v1.0/users/add', methods=['POST'])
-@users_basic_auth.login_required
+@users_auth.login_required
 def add_user():  
     
     resp_data = {}
@@ -180,22 +567,22 @@ def add_user():
 
     if not data.has_key('name') or not data.has_key('password') or not data.has_key('role'): 
         resp_data['error'] = 'Нет одного или нескольких параметров: name, password, role'
-        return jsonify(resp_data)
+        return json_response(resp_data)
 
     if g.user.has_role('admin') and data['role'] == 'admin':
         resp_data['error'] = 'Администратор не может создавать пользователей с ролью admin!'
-        return jsonify(resp_data)
+        return json_response(resp_data)
 
     if g.user.has_role('moderator'):
         resp_data['error'] = 'Модератор не может создавать пользователей!'
-        return jsonify(resp_data)
+        return json_response(resp_data)
 
     unique_test = User.query.filter_by(name=data['name']).first()
 
     if unique_test:
         resp_data['success'] = False
         resp_data['error'] = 'Указанный пользователь уже есть в базе!'
-        return jsonify(resp_data)
+        return json_response(resp_data)
 
     user = current_app.user_datastore.create_user(name=data['name'])
     user.password_hash = generate_password_hash(data['password'])
@@ -208,7 +595,7 @@ def add_user():
         resp_data['success'] = False
         resp_data['error'] = 'Ошибка добавления пользователя!'
 
-        return jsonify(resp_data)
+        return json_response(resp_data)
 
     role = Role.query.filter_by(name=data['role']).first()
 
@@ -222,18 +609,18 @@ def add_user():
             resp_data['success'] = False
             resp_data['error'] = 'Ошибка добавления роли пользователю!'
 
-            return jsonify(resp_data)
+            return json_response(resp_data)
 
     resp_data['data'] = user.to_dict()
     resp_data['success'] = True
 
-    return jsonify(resp_data)
+    return json_response(resp_data)
     
 
 
 # Удаление пользователей
 @api.route('/api/v1.0/users/del', methods=['POST'])
-@users_basic_auth.login_required
+@users_auth.login_required
 def del_user():
 
     resp_data = {}
@@ -252,17 +639,17 @@ def del_user():
     else:
         resp_data['success'] = False
         resp_data['error'] = 'Необходимо передать параметр id или name!'
-        return jsonify(resp_data)
+        return json_response(resp_data)
 
     # если пользователя в базе нет - ошибка
     if user is None:
         resp_data['error'] = 'Пользователь не найден в базе!'
-        return jsonify(resp_data)
+        return json_response(resp_data)
 
     # если тот кто удаляет не root и учетка не удаляет сама себя
     if g.user.name != 'root' and user.parent_id != g.user.id:
         resp_data['error'] = 'Ошибка удаления пользователя!'
-        return jsonify(resp_data)
+        return json_response(resp_data)
 
 
     
@@ -275,15 +662,17 @@ def del_user():
                     try:
                         db.session.delete(client)
                         db.session.commit()
+                        token_cache.invalidate(client.token)
                     except:
                         resp_data['error'] = 'Не удалось удалить клиентов удаляемого пользователя!'
-                        return jsonify(resp_data)
+                        return json_response(resp_data)
             try:
                 db.session.delete(moderator)
                 db.session.commit()
+                user_sessions.forget_user(moderator.id)
             except:
                 resp_data['error'] = 'Не удалось удалить засисимых пользователей удаляемого пользователя!'
-                return jsonify(resp_data)
+                return json_response(resp_data)
     
     parsers = Parser.query.filter_by(user_id=user.id).all()
     if parsers:
@@ -291,9 +680,10 @@ def del_user():
             try:
                 db.session.delete(parser)
                 db.session.commit()
+                token_cache.invalidate(parser.token)
             except:
                 resp_data['error'] = 'Не удалось удалить парсеры удаляемого пользователя!'
-                return jsonify(resp_data)
+                return json_response(resp_data)
     
     clients = Client.query.filter_by(user_id=user.id).all()
     if clients:
@@ -301,25 +691,27 @@ def del_user():
             try:
                 db.session.delete(client)
                 db.session.commit()
+                token_cache.invalidate(client.token)
             except:
                 db.session.rollback()
                 resp_data['error'] = 'Ошибка удаления клиента удаляемого пользователя!'
-                return jsonify(resp_data)
+                return json_response(resp_data)
 
     try:
         db.session.delete(user)
         db.session.commit()
+        user_sessions.forget_user(user.id)
         resp_data['success'] = True
     except:
         db.session.rollback()
         resp_data['error'] = 'Ошибка удаления пользователя!'
 
-    return jsonify(resp_data)
+    return json_response(resp_data)
 
 
 # Получить парсеры
 @api.route('/api/v1.0/parsers/get', methods=['GET'])
-@users_basic_auth.login_required
+@users_auth.login_required
 def get_parsers():
     resp_data = {}
     resp_data['api'] = '/api/v1.0/parsers/get'
@@ -327,14 +719,18 @@ def get_parsers():
     resp_data['data'] = []
     resp_data['error'] = ''
 
+    validator = change_versions.validator(['parsers', 'users'], g.user.id)
+    if validator.not_modified:
+        return validator.response()
+
     if g.user.has_role('root'):
-        parsers = Parser.query.all()
+        parsers = Parser.query.options(db.joinedload(Parser.owner)).all()
         for parser in parsers:
             resp_data['data'].append(parser.to_dict())
         resp_data['success'] = True
 
     elif g.user.has_role('admin'):
-        parsers = Parser.query.filter_by(user_id=g.user.id).all()
+        parsers = Parser.query.filter_by(user_id=g.user.id).options(db.joinedload(Parser.owner)).all()
         for parser in parsers:
             resp_data['data'].append(parser.to_dict())
         resp_data['success'] = True
@@ -342,12 +738,12 @@ def get_parsers():
     else:
         resp_data['success'] = False
 
-    return jsonify(resp_data)
+    return validator.apply(json_response(resp_data))
 
 
 # Добавить парсер
 @api.route('/api/v1.0/parsers/add', methods=['POST'])
-@users_basic_auth.login_required
+@users_auth.login_required
 def add_parser():
     resp_data = {}
     resp_data['api'] = '/api/v1.0/parsers/add'
@@ -359,7 +755,7 @@ def add_parser():
     
     if g.user.has_role('moderator'):
         resp_data['error'] = 'Ошибка добавления парсера!'
-        return jsonify(resp_data)
+        return json_response(resp_data)
    
     new_parser = Parser(name=data['name'])
     new_parser.owner = g.user
@@ -372,14 +768,14 @@ def add_parser():
         resp_data['data'] = new_parser.to_dict()
     except:
         resp_data['error'] = 'Ошибка добавления клиента!'
-        return jsonify(resp_data)
+        return json_response(resp_data)
 
-    return jsonify(resp_data)
+    return json_response(resp_data)
 
 
 # Удалить парсер
 @api.route('/api/v1.0/parsers/del', methods=['POST'])
-@users_basic_auth.login_required
+@users_auth.login_required
 def del_parser():
     resp_data = {}
     resp_data['api'] = '/api/v1.0/parsers/del'
@@ -391,7 +787,7 @@ def del_parser():
 
     if g.user.has_role('moderator'):
         resp_data['error'] = 'Ошибка удаления парсера!'
-        return jsonify(resp_data)
+        return json_response(resp_data)
 
     if data.has_key('id'):
         parser = Parser.query.filter_by(id=data['id']).first()
@@ -401,23 +797,97 @@ def del_parser():
     if parser is None:
         resp_data['success'] = False
         resp_data['error'] = 'Парсер не обнаружен!'
-        return jsonify(resp_data)
+        return json_response(resp_data)
     
     if parser.owner == g.user or g.user.has_role('root'): 
         try:
             db.session.delete(parser)
             db.session.commit()
+            token_cache.invalidate(parser.token)
             resp_data['success'] = True
         except:
             resp_data['error'] = 'Ошибка удаления парсера!'
-            return jsonify(resp_data)
+            return json_response(resp_data)
+
+    return json_response(resp_data)
+
 
-    return jsonify(resp_data)
+# Получить данные парсера
+@api.route('/api/v1.0/parsers/get_data/<int:id>', methods=['GET'])
+@users_auth.login_required
+def get_parser_data(id):
+    resp_data = {}
+    resp_data['api'] = '/api/v1.0/parsers/get_data/<id>'
+    resp_data['method'] = 'get'
+    resp_data['data'] = []
+    resp_data['error'] = ''
+
+    parser = Parser.query.filter_by(id=id).first()
+
+    if parser is None:
+        resp_data['success'] = False
+        resp_data['error'] = 'Парсер не обнаружен!'
+        return json_response(resp_data)
+
+    if parser.user_id != g.user.id and not g.user.has_role('root'):
+        resp_data['success'] = False
+        resp_data['error'] = 'Нужно быть владельцем парсера или root!'
+        return json_response(resp_data)
+
+    if wants_ndjson():
+        return ndjson_response(parser.iter_data(current_app.config['STREAM_CHUNK_SIZE']))
+
+    resp_data['data'] = parser.to_dict()
+    resp_data['data']['data'] = list(parser.iter_data())
+    resp_data['success'] = True
+
+    return json_response(resp_data)
+
+
+# Сводки приема данных парсера по интервалам:
+#   ?period=minute|hour|day (по умолчанию hour), date_from, date_to, fill=1 - с пустыми интервалами
+@api.route('/api/v1.0/parsers/rollups/<int:id>', methods=['GET'])
+@users_auth.login_required
+def get_parser_rollups(id):
+    resp_data = {}
+    resp_data['api'] = '/api/v1.0/parsers/rollups/<id>'
+    resp_data['method'] = 'get'
+    resp_data['data'] = {}
+    resp_data['error'] = ''
+
+    parser = Parser.query.filter_by(id=id).first()
+
+    if parser is None:
+        resp_data['success'] = False
+        resp_data['error'] = 'Парсер не обнаружен!'
+        return json_response(resp_data)
+
+    if parser.user_id != g.user.id and not g.user.has_role('root'):
+        resp_data['success'] = False
+        resp_data['error'] = 'Нужно быть владельцем парсера или root!'
+        return json_response(resp_data)
+
+    try:
+        params = get_rollup_params(request.args)
+        resp_data['data'] = {
+            'parser_id': parser.id,
+            'period': params['period'],
+            'buckets': rollups.series(parser.id, **params),
+            'summary': rollups.summary(parser.id)
+        }
+    except ValueError as err:
+        resp_data['success'] = False
+        resp_data['error'] = str(err)
+        return json_response(resp_data, 400)
+
+    resp_data['success'] = True
+
+    return json_response(resp_data)
 
 
 # Получить клиентов
 @api.route('/api/v1.0/clients/get', methods=['GET'])
-@users_basic_auth.login_required
+@users_auth.login_required
 def get_clients():
     resp_data = {}
     resp_data['api'] = '/api/v1.0/clients/get'
@@ -425,22 +895,25 @@ def get_clients():
     resp_data['data'] = []
     resp_data['error'] = ''
 
+    validator = change_versions.validator(['clients', 'users'], g.user.id)
+    if validator.not_modified:
+        return validator.response()
+
     if g.user.has_role('root'):
-        clients = Client.query.all()
+        clients = Client.query.options(db.joinedload(Client.owner)).all()
         for client in clients:
             resp_data['data'].append(client.to_dict())
         resp_data['success'] = True
 
     elif g.user.has_role('admin'):
-        users = User.query.filter_by(parent_id=g.user.id).all()
-        clients = Client.query.all()
+        clients = Client.query.join(Client.owner).filter(User.parent_id == g.user.id) \
+            .options(db.contains_eager(Client.owner)).all()
         for client in clients:
-            if client.owner in users:
-                resp_data['data'].append(client.to_dict())
+            resp_data['data'].append(client.to_dict())
         resp_data['success'] = True
 
     elif g.user.has_role('moderator'):
-        clients = Client.query.filter_by(user_id=g.user.id).all()
+        clients = Client.query.filter_by(user_id=g.user.id).options(db.joinedload(Client.owner)).all()
         for client in clients:
             resp_data['data'].append(client.to_dict())
         resp_data['success'] = True
@@ -448,12 +921,12 @@ def get_clients():
     else:
         resp_data['success'] = False
 
-    return jsonify(resp_data)
+    return validator.apply(json_response(resp_data))
 
 
 # Добавить клиента
 @api.route('/api/v1.0/clients/add', methods=['POST'])
-@users_basic_auth.login_required
+@users_auth.login_required
 def add_client():
 
     resp_data = {}
@@ -467,7 +940,7 @@ def add_client():
     if data is None:
         resp_data['success'] = False
         resp_data['error'] = 'Необходимо передать имя клиента параметром name'
-        return jsonify(resp_data)
+        return json_response(resp_data)
 
     new_client = Client(name=data['name'])
     new_client.owner = g.user
@@ -480,14 +953,14 @@ def add_client():
         resp_data['data'] = new_client.to_dict()
     except:
         resp_data['error'] = 'Ошибка добавления клиента!'
-        return jsonify(resp_data)
+        return json_response(resp_data)
 
-    return jsonify(resp_data)
+    return json_response(resp_data)
 
 
 # Удаление клиента
 @api.route('/api/v1.0/clients/del', methods=['POST'])
-@users_basic_auth.login_required
+@users_auth.login_required
 def del_client():
 
     resp_data = {}
@@ -505,22 +978,23 @@ def del_client():
 
     if not g.user.has_role('root') and g.user != client.owner:
         resp_data['error'] = 'Ошибка удаления клиента!'
-        return jsonify(resp_data)
+        return json_response(resp_data)
 
     try:
         db.session.delete(client)
         db.session.commit()
+        token_cache.invalidate(client.token)
         resp_data['success'] = True
     except:
         resp_data['error'] = 'Ошибка удаления клиента!'
-        return jsonify(resp_data)
+        return json_response(resp_data)
 
-    return jsonify(resp_data)
+    return json_response(resp_data)
 
 
 # Продлить токен клиента
 @api.route('/api/v1.0/clients/prolong', methods=['POST'])
-@users_basic_auth.login_required
+@users_auth.login_required
 def prolong_client_token():
     resp_data = {}
     resp_data['api'] = '/api/v1.0/clients/prolong'
@@ -533,7 +1007,7 @@ def prolong_client_token():
     if not data.has_key('days'):
         resp_data['success'] = False
         resp_data['error'] = '1. Не указано количество дней для продления!'
-        return jsonify(resp_data)
+        return json_response(resp_data)
 
     if data.has_key('id'):
         client = Client.query.filter_by(id=data['id']).first()
@@ -542,26 +1016,96 @@ def prolong_client_token():
     else:
         resp_data['success'] = False
         resp_data['error'] = '2. Необходиме передать id или token клиента!'
-        return jsonify(resp_data)
+        return json_response(resp_data)
 
     if client is None:
         resp_data['success'] = False
         resp_data['error'] = '3. Объект не найден!'
-        return jsonify(resp_data)
+        return json_response(resp_data)
 
     if not g.user.has_role('root') and client.owner != g.user:
         resp_data['success'] = False
         resp_data['error'] = '4. Нужно быть владельцем или root для удаления!'
-        return jsonify(resp_data)
+        return json_response(resp_data)
         
     try:
         client.update_token_expiration(int(data['days']))
         db.session.commit()
+        token_cache.invalidate(client.token)
         resp_data['data'] = client.to_dict()
         resp_data['success'] = True
     except:
         resp_data['success'] = False
         resp_data['error'] = '5. Ошибка продления токена клиента!'
-        return jsonify(resp_data)
+        return json_response(resp_data)
+
+    return json_response(resp_data)
+
+
+###############################################################################################################
+#                                           System API                                                        #
+###############################################################################################################
+#     /api/v1.0/system/sql_stats         GET       root, admin                                                 #
+#        сводка по endpoint: число запросов к базе, время в базе и всего запроса (avg, p95),                   #
+#        самый медленный запрос, сколько раз найден N+1; ?reset=1 - начать сводку заново                        #
+###############################################################################################################
+@api.route('/api/v1.0/system/sql_stats', methods=['GET'])
+@users_auth.login_required
+def get_sql_stats():
+    resp_data = {}
+    resp_data['api'] = '/api/v1.0/system/sql_stats'
+    resp_data['method'] = 'get'
+    resp_data['data'] = []
+    resp_data['error'] = ''
+
+    if not g.user.has_role('root') and not g.user.has_role('admin'):
+        resp_data['success'] = False
+        resp_data['error'] = 'Нужно быть root или admin!'
+        return json_response(resp_data)
+
+    resp_data['data'] = sql_instrumentation.summary()
+    if request.args.get('reset') in ('1', 'true'):
+        sql_instrumentation.reset()
+    resp_data['success'] = True
+
+    return json_response(resp_data)
+
+
+###############################################################################################################
+#     /api/v1.0/system/db_stats          GET       root, admin                                                #
+#        профиль базы (DB_PROFILE), фактические значения его PRAGMA, состояние пула соединений,               #
+#        ожидание блокировки записи и ошибки "database is locked"; ?reset=1 - сбросить счетчики               #
+###############################################################################################################
+@api.route('/api/v1.0/system/db_stats', methods=['GET'])
+@users_auth.login_required
+def get_db_stats():
+    resp_data = {}
+    resp_data['api'] = '/api/v1.0/system/db_stats'
+    resp_data['method'] = 'get'
+    resp_data['data'] = []
+    resp_data['error'] = ''
+
+    if not g.user.has_role('root') and not g.user.has_role('admin'):
+        resp_data['success'] = False
+        resp_data['error'] = 'Нужно быть root или admin!'
+        return json_response(resp_data)
+
+    resp_data['data'] = db_profile.stats(db.engine)
+    if request.args.get('reset') in ('1', 'true'):
+        db_profile.lock_stats.reset()
+    resp_data['success'] = True
+
+    return json_response(resp_data)
+
+
+###############################################################################################################
+#     /metrics                           GET       root, admin                                                 #
+#        метрики в текстовом формате Prometheus (см. app/metrics.py), Basic или Bearer авторизация             #
+###############################################################################################################
+@api.route('/metrics', methods=['GET'])
+@users_auth.login_required
+def get_metrics():
+    if not g.user.has_role('root') and not g.user.has_role('admin'):
+        return error_response(403, 'Нужно быть root или admin!')
 
-    return jsonify(resp_data)
+    return Response(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 
+import ast
 import click
+import json as std_json
 from datetime import datetime, timedelta
 from werkzeug.security import generate_password_hash, check_password_hash
 
@@ -17,10 +19,12 @@ def register(app):
     def initdb(passwd):
         """Initialize the database."""
         
-        from app import db
+        from app import db, migrations, data_partitions
 
+        data_partitions.drop_all()
         db.drop_all()
         db.create_all()
+        migrations.stamp(db.engine)
 
         u0 = app.user_datastore.create_user(name='root')
         u0.password_hash = generate_password_hash(passwd)
@@ -47,18 +51,218 @@ def register(app):
 
 
     @system.command()
-    @click.argument('count')
-    def remove_data(count):
+    @click.option('--target', type=int, default=None, help='Stop after this version.')
+    def migrate(target):
+        """Apply pending schema migrations and verify them."""
+
+        from app import db, migrations
+
+        done = migrations.upgrade(db.engine, target=target, echo=click.echo)
+        click.echo('Applied %d migration(s)' % len(done))
+        _echo_verification(migrations.verify(db.engine))
+
+
+    @system.command()
+    def migrate_status():
+        """Show applied and pending schema migrations."""
+
+        from app import db, migrations
+
+        applied = migrations.applied_versions(db.engine)
+        for m in migrations.MIGRATIONS:
+            state = 'applied' if m.version in applied else 'pending'
+            click.echo('%3d  %-8s %s' % (m.version, state, m.description))
+
+
+    @system.command()
+    def verify_schema():
+        """Check applied migrations and the query plans of hot queries."""
+
+        from app import db, migrations
+
+        if not _echo_verification(migrations.verify(db.engine)):
+            raise SystemExit(1)
+
+
+    @system.command()
+    @click.argument('count', type=int)
+    @click.option('--parser', 'parser_id', type=int, default=None, help='Only this parser.')
+    @click.option('--chunk', type=int, default=None, help='Records per transaction.')
+    def remove_data(count, parser_id, chunk):
+        """Remove data older than COUNT days."""
+
+        from app import db, retention
+        from app.models import Parser
+        from app.retention import RetentionBusy
+
+        cutoff = datetime.utcnow() - timedelta(days=count)
+        if parser_id is None:
+            parser_ids = [row.id for row in db.session.query(Parser.id).order_by(Parser.id)]
+        else:
+            parser_ids = [parser_id]
+
+        try:
+            with retention.exclusive():
+                results = [retention.purge(id, cutoff, chunk=chunk) for id in parser_ids]
+        except RetentionBusy:
+            click.echo('Retention is already running in another process')
+            raise SystemExit(1)
+        _echo_retention([], results)
+
+
+    @system.command(name='retention')
+    def run_retention():
+        """Remove data according to the parsers' retention policies."""
+
+        from app import retention
+        from app.retention import RetentionBusy
+
+        try:
+            dropped, results = retention.run()
+        except RetentionBusy:
+            click.echo('Retention is already running in another process')
+            raise SystemExit(1)
+        _echo_retention(dropped, results)
+
+
+    @system.command()
+    @click.argument('parser_id', type=int)
+    @click.argument('days')
+    def set_retention(parser_id, days):
+        """Set parser data retention in DAYS ('default' to reset)."""
+
+        from app import db
+        from app.models import Parser
+
+        parser = Parser.query.get(parser_id)
+        if parser is None:
+            raise click.BadParameter('parser %d not found' % parser_id)
+        if days == 'default':
+            parser.retention_days = None
+        else:
+            try:
+                parser.retention_days = int(days)
+            except ValueError:
+                raise click.BadParameter('DAYS must be a number or "default"')
+        db.session.commit()
+        click.echo('Parser %d: retention %s' % (parser.id, days))
+
+
+    @system.command()
+    @click.option('--chunk', default=1000, help='Records per transaction.')
+    def convert_data(chunk):
+        """Convert Data.json from Python repr to canonical JSON."""
+
+        from app import db, change_versions
         from app.models import Data
-        data_list = Data.query.all()
-        if data_list:
-            for data in data_list:
-                if data.datestamp >  datetime.now() + timedelta(days=int(count)): 
-                    try:
-                        db.session.delete(data)
-                        db.session.commit()
-                    except:
-                        db.session.rollback()
-                    
-        
+        from app.serialize import canonical_json
+
+        converted = failed = 0
+        last_id = 0
+
+        while True:
+            rows = db.session.query(Data.id, Data.json).filter(Data.id > last_id) \
+                .order_by(Data.id).limit(chunk).all()
+            if not rows:
+                break
+            last_id = rows[-1].id
+
+            updates = []
+            for row in rows:
+                value = _convert_legacy_json(row.json, canonical_json)
+                if value is None:
+                    failed += 1
+                elif value != row.json:
+                    updates.append({'id': row.id, 'json': value})
+
+            if updates:
+                db.session.bulk_update_mappings(Data, updates)
+                # ETag ответов по данным строятся по версии набора 'data'
+                change_versions.bump(['data'])
+                db.session.commit()
+                converted += len(updates)
+
+        click.echo('Convert data: converted %d, failed %d' % (converted, failed))
+
+
+    @system.command()
+    @click.option('--check', is_flag=True, help='Only report counters that differ from the data.')
+    def rebuild_counters(check):
+        """Recalculate dashboard counters from the data."""
+
+        from app import db, counters
+
+        with db.engine.begin() as conn:
+            drift = counters.check(conn) if check else counters.rebuild(conn)
+        for key in sorted(drift):
+            click.echo('%s %s %s: %d -> %d' % (key + drift[key]))
+        click.echo('Counters: %d differ%s' % (len(drift), '' if check else ', rebuilt'))
+
+
+    @system.command()
+    def rebuild_rollups():
+        """Recalculate parser ingestion rollups from the data."""
+
+        from app import db, rollups
+
+        with db.engine.begin() as conn:
+            total = rollups.rebuild(conn)
+        click.echo('Rollups: rebuilt from %d records' % total)
+
+
+    @system.command()
+    @click.option('--admins', default=2, help='Admin users.')
+    @click.option('--moderators', default=10, help='Moderator users.')
+    @click.option('--parsers', default=10, help='Parsers.')
+    @click.option('--clients', default=1000, help='Clients.')
+    @click.option('--rows', default=100000, help='Data records.')
+    @click.option('--days', default=30, help='Spread records over this many days.')
+    @click.option('--password', default='seed', help='Password of the generated users.')
+    @click.option('--seed', 'random_seed', default=1, help='Random seed.')
+    @click.option('--chunk', default=10000, help='Records per transaction.')
+    def seed(admins, moderators, parsers, clients, rows, days, password, random_seed, chunk):
+        """Fill the database with synthetic data (after initdb)."""
+
+        from app.seed import seed_database
+
+        started = datetime.utcnow()
+        seed_database(app, admins=admins, moderators=moderators, parsers=parsers, clients=clients,
+                      rows=rows, days=days, password=password, random_seed=random_seed, chunk=chunk,
+                      echo=click.echo)
+        click.echo('Seed: done in %.1fs' % (datetime.utcnow() - started).total_seconds())
+
+
+def _echo_verification(results):
+    ok = True
+    for m, passed, message in results:
+        click.echo('%3d  %-4s %s' % (m.version, 'OK' if passed else 'FAIL', message if not passed else m.description))
+        ok = ok and passed
+    return ok
+
+
+def _echo_retention(dropped, results):
+    for partition in dropped:
+        click.echo('Dropped partition %s (newest record %s) in %.2fs'
+                   % (partition.name, partition.newest.strftime('%Y-%m-%d %H:%M:%S'), partition.seconds))
+    for result in results:
+        click.echo('Parser %d: removed %d records older than %s in %.2fs'
+                   % (result.parser_id, result.removed, result.cutoff.strftime('%Y-%m-%d %H:%M:%S'), result.seconds))
+    click.echo('Total: removed %d records in %.2fs'
+               % (sum(result.removed for result in results), sum(result.seconds for result in results)))
+
+
+def _convert_legacy_json(text, canonical_json):
+    # text - либо уже JSON, либо repr питоновского объекта (str(data['json']))
+    if text is None:
+        return None
+    try:
+        return canonical_json(text)
+    except ValueError:
+        pass
+    try:
+        return canonical_json(ast.literal_eval(text))
+    except (ValueError, SyntaxError, TypeError):
+        pass
+    # просто строка: str() от строки в JSON-запросе
+    return canonical_json(std_json.dumps(text))
 
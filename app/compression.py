@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+
+import time
+import zlib
+
+from flask import request
+
+
+# wbits для zlib.compressobj: gzip - заголовок gzip, deflate - формат zlib (RFC 1950)
+ENCODINGS = {
+    'gzip': 16 + zlib.MAX_WBITS,
+    'deflate': zlib.MAX_WBITS,
+}
+
+# Потоки, где каждый фрагмент должен сразу дойти до клиента
+IMMEDIATE_MIMETYPES = ('text/event-stream',)
+
+
+class Compression(object):
+    """Сжатие ответов gzip / deflate по Accept-Encoding.
+
+    Сжимаются ответы blueprint'ов из COMPRESSION_BLUEPRINTS (имя -> уровень
+    zlib) с типом из COMPRESSION_MIMETYPES. Обычный ответ сжимается целиком
+    в after_request, если он не меньше COMPRESSION_MIN_SIZE байт. Потоковый
+    ответ (NDJSON, SSE) сжимается по мере генерации: фрагменты проходят
+    через один compressobj, сжатые данные сбрасываются клиенту (Z_SYNC_FLUSH)
+    каждые COMPRESSION_STREAM_FLUSH байт исходных данных, для
+    text/event-stream - после каждого фрагмента. ETag сжатого ответа
+    становится слабым: условные GET (app/versions.py) сравнивают слабо.
+    Время сжатия и размеры до/после попадают в учет запроса
+    (app/instrumentation.py): заголовок Server-Timing, лог и sql_stats.
+    """
+
+    def __init__(self, app=None):
+        self.enabled = False
+        self.levels = {}
+        self.min_size = 1024
+        self.mimetypes = ()
+        self.stream_flush = 65536
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.enabled = app.config.get('COMPRESSION_ENABLED', True)
+        self.levels = dict(app.config.get('COMPRESSION_BLUEPRINTS', {}))
+        self.min_size = app.config.get('COMPRESSION_MIN_SIZE', self.min_size)
+        self.mimetypes = tuple(app.config.get('COMPRESSION_MIMETYPES', self.mimetypes))
+        self.stream_flush = app.config.get('COMPRESSION_STREAM_FLUSH', self.stream_flush)
+
+        if self.enabled:
+            # регистрируется после учета запросов и метрик: after_request
+            # вызываются в обратном порядке, сжатие идет раньше них
+            app.after_request(self._after_request)
+
+    def _after_request(self, response):
+        level = self.levels.get(request.blueprint)
+        if level is None or response.mimetype not in self.mimetypes:
+            return response
+        if response.status_code < 200 or response.status_code in (204, 304) or response.direct_passthrough \
+                or 'Content-Encoding' in response.headers or 'Content-Range' in response.headers:
+            return response
+
+        response.vary.add('Accept-Encoding')
+        encoding = request.accept_encodings.best_match(list(ENCODINGS))
+        if encoding is None:
+            return response
+
+        if response.is_streamed:
+            if response.mimetype in IMMEDIATE_MIMETYPES:
+                flush_every = 0
+            else:
+                flush_every = self.stream_flush
+            response.response = self._compress_stream(response.response, response.charset,
+                                                      _compressor(encoding, level), flush_every, _stats())
+            response.headers.pop('Content-Length', None)
+        else:
+            data = response.get_data()
+            if len(data) < self.min_size:
+                return response
+            started = time.time()
+            compressor = _compressor(encoding, level)
+            compressed = compressor.compress(data) + compressor.flush()
+            response.set_data(compressed)
+            _record(_stats(), time.time() - started, len(data), len(compressed))
+
+        response.headers['Content-Encoding'] = encoding
+        etag, weak = response.get_etag()
+        if etag and not weak:
+            response.set_etag(etag, weak=True)
+        return response
+
+    def _compress_stream(self, chunks, charset, compressor, flush_every, stats):
+        # chunks - исходный итератор ответа; close() передается ему же
+        pending = 0
+        try:
+            for chunk in chunks:
+                if not isinstance(chunk, bytes):
+                    chunk = chunk.encode(charset)
+                started = time.time()
+                data = compressor.compress(chunk)
+                pending += len(chunk)
+                if pending >= flush_every:
+                    data += compressor.flush(zlib.Z_SYNC_FLUSH)
+                    pending = 0
+                _record(stats, time.time() - started, len(chunk), len(data))
+                if data:
+                    yield data
+            # завершающий блок сжимается уже после teardown запроса
+            # (stream_with_context), в учет он не попадает
+            data = compressor.flush()
+            if data:
+                yield data
+        finally:
+            close = getattr(chunks, 'close', None)
+            if close is not None:
+                close()
+
+
+def _compressor(encoding, level):
+    return zlib.compressobj(level, zlib.DEFLATED, ENCODINGS[encoding])
+
+
+def _stats():
+    from app import sql_instrumentation
+
+    return sql_instrumentation.current()
+
+
+def _record(stats, elapsed, raw, sent):
+    if stats is not None:
+        stats.record_compression(elapsed, raw, sent)
@@ -12,6 +12,58 @@ class Config(object):
     SQLALCHEMY_TRACK_MODIFICATIONS = False
     SECURITY_TRACKABLE =True
     DEBUG = True
-    SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(basedir, 'app.db')
+    SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or 'sqlite:///' + os.path.join(basedir, 'app.db')
+    DB_PROFILE = os.environ.get('DB_PROFILE', 'concurrent')
+    DB_PRAGMAS = {}
+    DB_POOL = {}
     SECURITY_TRACKABLE = True
     REMEMBER_COOKIE_DURATION = 3600
+    PARSER_BATCH_MAX_RECORDS = 1000
+    INGEST_WRITE_BEHIND = False
+    INGEST_QUEUE_SIZE = 10000
+    INGEST_FLUSH_RECORDS = 500
+    INGEST_FLUSH_INTERVAL_MS = 200
+    INGEST_SPOOL_PATH = os.path.join(basedir, 'ingest.spool')
+    INGEST_SPOOL_FSYNC = False
+    INGEST_RETRY_AFTER = 1
+    TOKEN_CACHE_TTL = 60
+    TOKEN_CACHE_SIZE = 10000
+    BACKGROUND_JOBS = True
+    ACTIVITY_FLUSH_INTERVAL = 10
+    USER_TOKEN_TTL = 3600
+    USER_CREDENTIAL_CACHE_TTL = 300
+    CLIENT_DATA_DEFAULT_PAGE = 100
+    CLIENT_DATA_MAX_PAGE = 1000
+    CLIENT_DATA_MAX_STREAM = 100000
+    CLIENT_EXPORT_MAX_ROWS = 1000000
+    CLIENT_EXPORT_BATCH = 5000
+    STREAM_CHUNK_SIZE = 500
+    FEED_BATCH = 100
+    FEED_HEARTBEAT = 15
+    FEED_LONGPOLL_TIMEOUT = 25
+    FEED_SSE_MAX_DURATION = 300
+    PARSER_PAGE_SIZE = 50
+    PARSER_PAGE_MAX_SIZE = 500
+    PARSER_PAGE_PREVIEW = 300
+    DATA_PARTITIONING = None
+    RETENTION_DEFAULT_DAYS = None
+    RETENTION_INTERVAL = 3600
+    RETENTION_CHUNK = 5000
+    RETENTION_CHUNK_PAUSE_MS = 50
+    RETENTION_LOCK_PATH = os.path.join(basedir, 'retention.lock')
+    SQL_INSTRUMENTATION = True
+    SQL_STATS_WINDOW = 500
+    SQL_N_PLUS_ONE_THRESHOLD = 10
+    METRICS_ENABLED = True
+    METRICS_MAX_SERIES = 1000
+    ROLLUP_MINUTE_DAYS = 7
+    ROLLUP_HOUR_DAYS = 180
+    ROLLUP_MAX_BUCKETS = 5000
+    COMPRESSION_ENABLED = True
+    COMPRESSION_BLUEPRINTS = {'api': 6, 'dashboard': 6}
+    COMPRESSION_MIN_SIZE = 1024
+    COMPRESSION_MIMETYPES = ['application/json', 'application/x-ndjson', 'text/event-stream', 'text/plain',
+                             'text/html', 'text/css', 'application/javascript', 'text/csv',
+                             'application/x-msgpack', 'application/vnd.apache.arrow.stream']
+    COMPRESSION_STREAM_FLUSH = 65536
+    JSON_ENCODER = 'auto'
@@ -0,0 +1,276 @@
+# -*- coding: utf-8 -*-
+
+from sqlalchemy import bindparam, event
+from sqlalchemy.orm import attributes
+
+
+# Ключ счетчика - (scope, scope_id, name):
+#   ('all', 0, admins|moderators|parsers|clients|data)   - по всей базе (root)
+#   ('user', id, moderators|parsers|child_clients|data)  - по admin: его модераторы,
+#                                                          парсеры, клиенты модераторов,
+#                                                          записи его парсеров
+#   ('user', id, clients)                                - собственные клиенты пользователя
+#   ('parser', id, data)                                 - записи парсера
+GLOBAL = ('all', 0)
+
+
+def user_keys(user_id, parent_id, roles):
+    keys = []
+    if 'admin' in roles:
+        keys.append(GLOBAL + ('admins',))
+    if 'moderator' in roles:
+        keys.append(GLOBAL + ('moderators',))
+        if parent_id is not None and parent_id != user_id:
+            keys.append(('user', parent_id, 'moderators'))
+    return keys
+
+
+def parser_keys(user_id):
+    return [GLOBAL + ('parsers',), ('user', user_id, 'parsers')]
+
+
+def client_keys(user_id, parent_id):
+    keys = [GLOBAL + ('clients',), ('user', user_id, 'clients')]
+    if parent_id is not None and parent_id != user_id:
+        keys.append(('user', parent_id, 'child_clients'))
+    return keys
+
+
+def _values(obj, key, new):
+    # значения атрибута до (new=False) или после (new=True) flush
+    history = attributes.get_history(obj, key)
+    return list(history.unchanged or ()) + list((history.added if new else history.deleted) or ())
+
+
+def _scalar(obj, key, new):
+    values = _values(obj, key, new)
+    return values[0] if values else None
+
+
+def _changed(obj, keys):
+    return any(attributes.get_history(obj, key, passive=attributes.PASSIVE_NO_INITIALIZE).has_changes()
+               for key in keys)
+
+
+class Counters(object):
+    """Счетчики для сводок дашборда (таблица counters).
+
+    Пользователи, парсеры и клиенты учитываются в after_flush сессии: по
+    состоянию объектов до и после flush считается, какие счетчики
+    изменились, и они обновляются в той же транзакции. Записи data пишутся
+    и удаляются через Core, поэтому Data.insert_many и очистка данных
+    (app/retention.py) вызывают add_data сами. Эндпоинты get_*_counters
+    читают готовые значения одним запросом. Если счетчики разошлись с
+    данными (правка базы в обход приложения), их пересчитывает
+    flask system rebuild-counters.
+    """
+
+    def __init__(self, app=None):
+        self._listening = False
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        from app import db
+
+        if not self._listening:
+            event.listen(db.session, 'after_flush', self._after_flush)
+            self._listening = True
+
+    def get(self, scope, scope_id):
+        # {name: value} счетчиков одного владельца
+        from app import db
+        from app.models import Counter
+
+        table = Counter.__table__
+        rows = db.session.execute(db.select([table.c.name, table.c.value])
+                                  .where(table.c.scope == scope).where(table.c.scope_id == scope_id))
+        return dict((row[0], row[1]) for row in rows)
+
+    def add_data(self, counts):
+        # counts - {parser_id: изменение числа записей}; в текущей транзакции сессии
+        from app import db
+        from app.models import Counter, Parser
+
+        counts = dict((parser_id, count) for parser_id, count in counts.items() if count)
+        if not counts:
+            return
+        table = Counter.__table__
+        self._apply(db.session.execute, {GLOBAL + ('data',): sum(counts.values())})
+
+        params = [{'key_id': parser_id, 'delta': count} for parser_id, count in counts.items()
+                  if parser_id is not None]
+        if not params:
+            return
+        owner = db.select([Parser.__table__.c.user_id]) \
+            .where(Parser.__table__.c.id == bindparam('key_id')).as_scalar()
+        for scope, scope_id in (('parser', bindparam('key_id')), ('user', owner)):
+            db.session.execute(
+                table.update()
+                .where(table.c.scope == scope).where(table.c.scope_id == scope_id).where(table.c.name == 'data')
+                .values(value=table.c.value + bindparam('delta')), params)
+
+    def compute(self, conn):
+        # значения всех счетчиков по текущим данным
+        from app import db, data_partitions
+        from app.models import Client, Parser, Role, User, roles_users
+
+        values = {}
+
+        def add(key, count=1):
+            values[key] = values.get(key, 0) + count
+
+        users = User.__table__
+        rows = conn.execute(db.select([users.c.id, users.c.parent_id, Role.__table__.c.name])
+                            .select_from(users.join(roles_users).join(Role.__table__)))
+        for user_id, parent_id, role in rows:
+            for key in user_keys(user_id, parent_id, [role]):
+                add(key)
+
+        owners = {}
+        for parser_id, user_id in conn.execute(db.select([Parser.__table__.c.id, Parser.__table__.c.user_id])):
+            owners[parser_id] = user_id
+            for key in parser_keys(user_id):
+                add(key)
+            add(('parser', parser_id, 'data'), 0)
+            add(('user', user_id, 'data'), 0)
+
+        clients = Client.__table__
+        rows = conn.execute(db.select([clients.c.user_id, users.c.parent_id])
+                            .select_from(clients.outerjoin(users, users.c.id == clients.c.user_id)))
+        for user_id, parent_id in rows:
+            for key in client_keys(user_id, parent_id):
+                add(key)
+
+        partitions = [(0, 'data')]
+        if conn.engine.has_table('data_partitions'):
+            partitions += list(conn.execute('SELECT number, name FROM data_partitions WHERE number > 0'))
+        for number, name in partitions:
+            table = data_partitions.table(number, name)
+            for parser_id, count in conn.execute(db.select([table.c.parser_id, db.func.count()])
+                                                 .group_by(table.c.parser_id)):
+                add(GLOBAL + ('data',), count)
+                if parser_id in owners:
+                    add(('parser', parser_id, 'data'), count)
+                    add(('user', owners[parser_id], 'data'), count)
+
+        return values
+
+    def stored(self, conn):
+        from app.models import Counter
+
+        table = Counter.__table__
+        return dict(((row.scope, row.scope_id, row.name), row.value) for row in conn.execute(table.select()))
+
+    def rebuild(self, conn):
+        # пересчитать все счетчики; возвращает {ключ: (было, стало)} для разошедшихся
+        from app.models import Counter
+
+        table = Counter.__table__
+        values = self.compute(conn)
+        old = self.stored(conn)
+        conn.execute(table.delete())
+        if values:
+            conn.execute(table.insert(), [{'scope': key[0], 'scope_id': key[1], 'name': key[2], 'value': value}
+                                          for key, value in values.items()])
+        return _drift(old, values)
+
+    def check(self, conn):
+        # {ключ: (в таблице, по данным)} для разошедшихся счетчиков
+        return _drift(self.stored(conn), self.compute(conn))
+
+    def _apply(self, execute, deltas):
+        from app.models import Counter
+
+        table = Counter.__table__
+        for key, delta in sorted(deltas.items()):
+            scope, scope_id, name = key
+            result = execute(table.update()
+                             .where(table.c.scope == scope).where(table.c.scope_id == scope_id)
+                             .where(table.c.name == name)
+                             .values(value=table.c.value + delta))
+            if result.rowcount == 0:
+                execute(table.insert().values(scope=scope, scope_id=scope_id, name=name, value=delta))
+
+    def _after_flush(self, session, flush_context):
+        from app import db
+        from app.models import Client, Counter, Parser, User
+
+        deltas = {}
+        removed_parsers = []
+        removed_users = []
+        parents = {}
+        conn = session.connection()
+
+        def change(keys, delta):
+            for key in keys:
+                deltas[key] = deltas.get(key, 0) + delta
+
+        def parent_of(user_id):
+            if user_id not in parents:
+                parents[user_id] = conn.execute(db.select([User.__table__.c.parent_id])
+                                                .where(User.__table__.c.id == user_id)).scalar()
+            return parents[user_id]
+
+        def keys_of(obj, new):
+            if isinstance(obj, User):
+                return user_keys(obj.id, _scalar(obj, 'parent_id', new), [role.name for role in _values(obj, 'roles', new)])
+            if isinstance(obj, Parser):
+                return parser_keys(_scalar(obj, 'user_id', new))
+            if isinstance(obj, Client):
+                user_id = _scalar(obj, 'user_id', new)
+                return client_keys(user_id, parent_of(user_id))
+            return None
+
+        tracked = {User: ('parent_id', 'roles'), Parser: ('user_id',), Client: ('user_id',)}
+
+        for obj in session.new:
+            keys = keys_of(obj, True)
+            if keys is None:
+                continue
+            change(keys, 1)
+            if isinstance(obj, Parser):
+                # строки для add_data
+                change([('parser', obj.id, 'data'), ('user', obj.user_id, 'data')], 0)
+
+        for obj in session.deleted:
+            keys = keys_of(obj, False)
+            if keys is None:
+                continue
+            change(keys, -1)
+            if isinstance(obj, Parser):
+                removed_parsers.append((obj.id, _scalar(obj, 'user_id', False)))
+            elif isinstance(obj, User):
+                removed_users.append(obj.id)
+
+        for obj in session.dirty:
+            attrs = tracked.get(type(obj))
+            if attrs is None or not _changed(obj, attrs):
+                continue
+            change(keys_of(obj, False), -1)
+            change(keys_of(obj, True), 1)
+
+        if not deltas:
+            return
+
+        table = Counter.__table__
+        for parser_id, user_id in removed_parsers:
+            # записи удаленного парсера больше не относятся к его владельцу
+            count = conn.execute(db.select([table.c.value]).where(table.c.scope == 'parser')
+                                 .where(table.c.scope_id == parser_id).where(table.c.name == 'data')).scalar()
+            change([('user', user_id, 'data')], -(count or 0))
+
+        self._apply(conn.execute, dict((key, delta) for key, delta in deltas.items() if key[1] is not None))
+
+        for parser_id, user_id in removed_parsers:
+            conn.execute(table.delete().where(table.c.scope == 'parser').where(table.c.scope_id == parser_id))
+        for user_id in removed_users:
+            conn.execute(table.delete().where(table.c.scope == 'user').where(table.c.scope_id == user_id))
+
+
+def _drift(stored, computed):
+    result = {}
+    for key in set(stored) | set(computed):
+        if stored.get(key, 0) != computed.get(key, 0):
+            result[key] = (stored.get(key, 0), computed.get(key, 0))
+    return result
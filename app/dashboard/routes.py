@@ -2,11 +2,13 @@
 
 from flask import render_template, url_for, redirect, abort
 from . import dashboard
-from flask import jsonify, request, current_app
+from flask import request, current_app
 from flask_security import login_required, roles_required, roles_accepted, current_user
 from werkzeug.security import generate_password_hash, check_password_hash
-from app import db
+from app import db, token_cache, user_sessions, counters, rollups
 from app.models import Data, User, Parser, Client, Role
+from app.filters import get_data_filters, get_rollup_params
+from app.serialize import json_response
 
 
 
@@ -18,6 +20,12 @@ from app.models import Data, User, Parser, Client, Role
 #   /moderator/<id>     - Модератор                 root, admin, moderator             GET          #
 #   /client/<id>        - Клиент                    root, admin, moderator, client     GET          #
 #   /parser/<id>        - Парсер                    root, admin                        GET          #
+#   /dash/v1.0/parser_data/<id>[/<data_id>]                                                         #
+#                       - Данные парсера            владелец парсера, root             GET          #
+#   /dash/v1.0/parser_rollups/<id>                                                                  #
+#                       - Сводки приема парсера     владелец парсера, root             GET          #
+#   /dash/v1.0/get_<role>_counters                                                                  #
+#                       - Счетчики сводки           root / admin / moderator           GET          #
 #                                                                                                   #
 #####################################################################################################
 
@@ -40,33 +48,28 @@ def get_index_page():
 @roles_accepted('root', 'admin', 'moderator')
 def get_user_page(id):
 
+    # владельцы и роли загружаются теми же запросами, а не отдельно для каждой строки шаблона
     if current_user.has_role('root'):
         
-        users = User.query.all()
-        parsers = Parser.query.all()
-        clients = Client.query.all()
-        # clients_count = Client.query.count()
-        # parsers_count = Parser.query.count()
-        # admins_role = Role.query.filter_by(name='admin').first()
-        # admins_count = db.session.query(User).filter(User.roles.contains(admins_role)).count()
-        # moderators_role = Role.query.filter_by(name='moderator').first()
-        # moderators_count = db.session.query(User).filter(User.roles.contains(moderators_role)).count()
-
-        return render_template('common.html', users=users, parsers=parsers, clients=clients)
+        users = User.query.options(db.selectinload(User.roles)).all()
+        parsers = Parser.query.options(db.joinedload(Parser.owner)).all()
+        clients = Client.query.options(db.joinedload(Client.owner)).all()
+
+        return render_template('common.html', users=users, parsers=parsers, clients=clients,
+                               counters_url=url_for('dashboard.get_root_counters'), **user_counters(current_user))
     
     elif current_user.has_role('admin'):
-        users = User.query.filter_by(parent_id = current_user.id).all()
-        parsers = Parser.query.filter_by(owner = current_user).all()
-        clients = []
-
-        for client in Client.query.all():
-            if client.owner in users:
-                clients.append(client)
-        return render_template('common.html', users=users, parsers=parsers, clients=clients)
+        users = User.query.filter_by(parent_id = current_user.id).options(db.selectinload(User.roles)).all()
+        parsers = Parser.query.filter_by(owner = current_user).options(db.joinedload(Parser.owner)).all()
+        clients = Client.query.join(Client.owner).filter(User.parent_id == current_user.id) \
+            .options(db.contains_eager(Client.owner)).all()
+        return render_template('common.html', users=users, parsers=parsers, clients=clients,
+                               counters_url=url_for('dashboard.get_admin_counters'), **user_counters(current_user))
     
     elif current_user.has_role('moderator'):
-        clients = Client.query.filter_by(user_id = current_user.id).all()
-        return render_template('common.html', clients=clients)
+        clients = Client.query.filter_by(user_id = current_user.id).options(db.joinedload(Client.owner)).all()
+        return render_template('common.html', clients=clients,
+                               counters_url=url_for('dashboard.get_moderator_counters'), **user_counters(current_user))
     
     else:
         abort(404)
@@ -84,13 +87,10 @@ def get_parser_page(id):
         'title': u'<< Назад'
     }]
 
-    if parser:
-        parser_dict = parser.to_dict_with_data()
-    
-        if parser_dict is not None:
-            return render_template('parser.html', parser_dict=parser_dict, menu_list=menu_list)
-        else:
-            abort(404)
+    # сами данные страница подгружает постранично через /dash/v1.0/parser_data/<id>
+    if parser and parser.viewable_by(current_user):
+        return render_template('parser.html', parser_dict=parser.to_dict(), menu_list=menu_list,
+                               page_size=current_app.config['PARSER_PAGE_SIZE'])
     else:
         abort(404)
 
@@ -148,7 +148,7 @@ def add_user():
     if unique_test:
         api_resp['success'] = False
         api_resp['error'] = 'Такой пользователь уже есть в базе!'
-        return jsonify(api_resp)
+        return json_response(api_resp)
 
 
     user = current_app.user_datastore.create_user(name=username)
@@ -162,7 +162,7 @@ def add_user():
         api_resp['success'] = False
         api_resp['error'] = 'Ошибка добавления пользователя!'
 
-        return jsonify(api_resp)
+        return json_response(api_resp)
 
     role = Role.query.filter_by(name=form_role).first()
     
@@ -176,12 +176,12 @@ def add_user():
             api_resp['success'] = False
             api_resp['error'] = 'Ошибка добавления роли пользователю!'
         
-            return jsonify(api_resp)
+            return json_response(api_resp)
 
     api_resp['resp_data'] = user.to_dict()
     api_resp['success'] = True
     
-    return jsonify(api_resp)
+    return json_response(api_resp)
 
 
 
@@ -207,11 +207,11 @@ def del_user():
 
     if user is None:
         resp_data['error'] = 'Пользователь не найден в базе!'
-        return jsonify(api_resp)
+        return json_response(api_resp)
 
     if current_user.name != 'root' and user.parent_id != current_user.id:
         resp_data['error'] = 'Ошибка удаления пользователя!'
-        return jsonify(api_resp)
+        return json_response(api_resp)
     
     moderators = User.query.filter_by(parent_id=user.id).all()
     if moderators:
@@ -222,15 +222,17 @@ def del_user():
                     try:
                         db.session.delete(client)
                         db.session.commit()
+                        token_cache.invalidate(client.token)
                     except:
                         api_resp['error'] = 'Не удалось удалить клиентов удаляемого пользователя!'
-                        return jsonify(api_resp)
+                        return json_response(api_resp)
             try:
                 db.session.delete(moderator)
                 db.session.commit()
+                user_sessions.forget_user(moderator.id)
             except:
                 api_resp['error'] = 'Не удалось удалить засисимых пользователей удаляемого пользователя!'
-                return jsonify(api_resp)
+                return json_response(api_resp)
 
     parsers = Parser.query.filter_by(user_id=user.id).all()
     if parsers:
@@ -238,9 +240,10 @@ def del_user():
             try:
                 db.session.delete(parser)
                 db.session.commit()
+                token_cache.invalidate(parser.token)
             except:
                 api_resp['error'] = 'Не удалось удалить парсеры удаляемого пользователя!'
-                return jsonify(api_resp)
+                return json_response(api_resp)
     
     clients = Client.query.filter_by(user_id=user.id).all()
     if clients:
@@ -248,20 +251,22 @@ def del_user():
             try:
                 db.session.delete(client)
                 db.session.commit()
+                token_cache.invalidate(client.token)
             except:
                 db.session.rollback()
                 api_resp['error'] = 'Ошибка удаления клиента удаляемого пользователя!'
-                return jsonify(api_resp)
+                return json_response(api_resp)
 
     try:
         db.session.delete(user)
         db.session.commit()
+        user_sessions.forget_user(user.id)
         api_resp['success'] = True
     except:
         db.session.rollback()
         api_resp['error'] = 'Ошибка удаления пользователя!'
 
-    return jsonify(api_resp)
+    return json_response(api_resp)
 
 
 @dashboard.route('/dash/v1.0/activ_deactiv_user', methods=['POST'])
@@ -296,7 +301,7 @@ def activ_deactiv_user():
         api_resp['success'] = False
         api_resp['error'] = "Текущий пользователь не может быть деактивирован!"
 
-    return jsonify(api_resp)
+    return json_response(api_resp)
 
 
 @dashboard.route('/dash/v1.0/add_parser', methods=['POST'])
@@ -324,7 +329,7 @@ def add_parser():
         api_resp['success'] = False
         api_resp['error'] = 'Парсер с таким именем уже есть в базе!'
         
-        return jsonify(api_resp)
+        return json_response(api_resp)
 
     new_parser = Parser(name=parser_name)
     new_parser.get_token()
@@ -338,7 +343,7 @@ def add_parser():
     except:
         api_resp['success'] = False
         api_resp['error'] = 'Ошибка добавления парсера'
-        return jsonify(api_resp)
+        return json_response(api_resp)
     
     api_resp['resp_data'] = new_parser.to_dict_with_data()
 
@@ -346,7 +351,7 @@ def add_parser():
         api_resp['success'] = False
         api_resp['error'] = 'Не удалось получить данные!'
     
-    return jsonify(api_resp)
+    return json_response(api_resp)
 
 
 @dashboard.route('/dash/v1.0/del_parser', methods=['POST'])
@@ -373,12 +378,13 @@ def del_parser():
         try:
             db.session.delete(parser)
             db.session.commit()
+            token_cache.invalidate(parser.token)
             api_resp['success'] = True
         except:
             api_resp['success'] = False
             api_resp['error'] = 'Ошибка удаления парсера!'
     
-    return jsonify(api_resp)
+    return json_response(api_resp)
 
 
 @dashboard.route('/dash/v1.0/add_client', methods=['POST'])
@@ -410,11 +416,11 @@ def add_client():
         api_resp['resp_data'] = new_client.to_dict()
     except:
         api_resp['error'] = 'Ошибка добавления клиента!'
-        return jsonify(api_resp)
+        return json_response(api_resp)
     
     api_resp['success'] = True
     
-    return jsonify(api_resp)
+    return json_response(api_resp)
 
 
 @dashboard.route('/dash/v1.0/del_client', methods=['POST'])
@@ -441,12 +447,13 @@ def del_client():
         try:
             db.session.delete(client)
             db.session.commit()
+            token_cache.invalidate(client.token)
             api_resp['success'] = True
         except:
             api_resp['success'] = False
             api_resp['error'] = 'Ошибка удаления клиента!'
     
-    return jsonify(api_resp)
+    return json_response(api_resp)
 
 
 @dashboard.route('/dash/v1.0/update_client_token', methods=['POST'])
@@ -474,13 +481,14 @@ def update_client_token():
         client.update_token_expiration(int(count))
         try:
             db.session.commit()
+            token_cache.invalidate(client.token)
             api_resp['success'] = True
             api_resp['resp_data'] = {'token_expiration': client.token_expiration}
         except:
             api_resp['success'] = False
             api_resp['error'] = 'Ошибка продления токена!'
     
-    return jsonify(api_resp)
+    return json_response(api_resp)
 
 
 @dashboard.route('/dash/v1.0/activ_deactiv_client', methods=['POST'])
@@ -518,123 +526,207 @@ def activ_deactiv_client():
         api_resp['success'] = False
         api_resp['error'] = 'Клиент с таким ID не найден!'
 
-    return jsonify(api_resp)
+    return json_response(api_resp)
 
 
-# @dashboard.route('/dash/v1.0/get_moderator_counters', methods=['GET'])
-# @login_required
-# @roles_required('moderator')
-# def get_moderator_counters():
+#####################################################################################################
+#  Параметры parser_data (query string):                                                            #
+#     before_id=<id>          - записи старше id, по убыванию id (следующая страница)                #
+#     after_id=<id>           - записи новее id, по возрастанию id                                   #
+#     date_from, date_to      - диапазон datestamp, формат %Y-%m-%d %H:%M:%S                          #
+#     limit=<n>               - размер страницы, не больше PARSER_PAGE_MAX_SIZE                       #
+#  json в ответе обрезан до PARSER_PAGE_PREVIEW символов, целиком - parser_data/<id>/<data_id>      #
+#####################################################################################################
+@dashboard.route('/dash/v1.0/parser_data/<int:id>', methods=['GET'])
+@login_required
+@roles_accepted('root', 'admin', 'moderator')
+def get_parser_data(id):
 
-#     api_resp = {
-#         'url': '',     
-#         'method': '',                 
-#         'success': True,                 
-#         'resp_data': '',               
-#         'error': ''                
-#     }
+    api_resp = {
+        'url': '',     
+        'method': '',                 
+        'success': True,                 
+        'resp_data': '',               
+        'error': ''                
+    }
 
-#     api_resp['url'] = '/dash/v1.0/get_moderator_counters'
-#     api_resp['method'] = 'GET'
+    api_resp['url'] = '/dash/v1.0/parser_data/<id>'
+    api_resp['method'] = 'GET'
 
-#     try:
-#         clients_count = current_user.get_client_count()
-       
-#         resp_data = {
-#             'clients_count': clients_count
-#             }
-        
-#         api_resp['data'] = resp_data
-#         api_resp['success'] = True
-        
-#     except Exception as err:
-#         api_resp['success'] = False
-#         api_resp['error'] = 'Response data error'
+    parser = Parser.query.filter_by(id=id).first()
+    if parser is None or not parser.viewable_by(current_user):
+        api_resp['success'] = False
+        api_resp['error'] = 'Парсер не найден!'
+        return json_response(api_resp, 404)
 
-#     return jsonify(api_resp)
+    try:
+        filters = get_data_filters(request.args)
+        filters.pop('parser_ids', None)
+        limit = int(request.args.get('limit', current_app.config['PARSER_PAGE_SIZE']))
+    except ValueError:
+        api_resp['success'] = False
+        api_resp['error'] = 'Неверные параметры запроса!'
+        return json_response(api_resp, 400)
 
+    limit = max(1, min(limit, current_app.config['PARSER_PAGE_MAX_SIZE']))
+    rows = parser.data_page(preview=current_app.config['PARSER_PAGE_PREVIEW'], limit=limit, **filters)
 
-# @dashboard.route('/dash/v1.0/get_root_counters', methods=['GET'])
-# @login_required
-# @roles_required('root')
-# def get_root_counters():
-    
-#     api_resp = {
-#         'url': '',     
-#         'method': '',                 
-#         'success': True,                 
-#         'resp_data': '',               
-#         'error': ''                
-#     }
-
-#     api_resp['url'] = '/dash/v1.0/get_root_counters'
-#     api_resp['method'] = 'GET'
-    
-#     try:
-#         parsers_count = Parser.query.count()
-#         moderators_role = Role.query.filter_by(name='moderator').first()
-#         admins_role = Role.query.filter_by(name='admin').first()
-#         admins_count = db.session.query(User).filter(User.roles.contains(admins_role)).count()
-#         moderators_count = db.session.query(User).filter(User.roles.contains(moderators_role)).count()
-#         clients_count = Client.query.count()
-        
+    next_cursor = None
+    if len(rows) == limit:
+        if 'after_id' in filters:
+            next_cursor = {'after_id': rows[-1]['id']}
+        else:
+            next_cursor = {'before_id': rows[-1]['id']}
 
-#         resp_data = {
-#             'moderators_count': moderators_count,
-#             'parsers_count': parsers_count,
-#             'clients_count': clients_count,
-#             'admins_count': admins_count
-#         }
-        
-#         api_resp['data'] = resp_data
-#         api_resp['success'] = True
-        
-#     except Exception as err:
-#         api_resp['success'] = False
-#         api_resp['error'] = 'Ошибка получения счетчиков'
+    api_resp['resp_data'] = rows
+    api_resp['next_cursor'] = next_cursor
 
-#     return jsonify(api_resp)
+    return json_response(api_resp)
 
 
+@dashboard.route('/dash/v1.0/parser_data/<int:id>/<int:data_id>', methods=['GET'])
+@login_required
+@roles_accepted('root', 'admin', 'moderator')
+def get_parser_data_item(id, data_id):
 
+    api_resp = {
+        'url': '',     
+        'method': '',                 
+        'success': True,                 
+        'resp_data': '',               
+        'error': ''                
+    }
 
-# @dashboard.route('/dash/v1.0/get_admin_counters', methods=['GET'])
-# @login_required
-# @roles_required('admin')
-# def get_admin_counters():
-    
-#     api_resp = {
-#         'url': '',     
-#         'method': '',                 
-#         'success': True,                 
-#         'resp_data': '',               
-#         'error': ''                
-#     }
-
-#     api_resp['url'] = '/dash/v1.0/get_admin_counters'
-#     api_resp['method'] = 'GET'
-    
-#     try:
-#         parsers_count = Parser.query.count()
-#         moderators_role = Role.query.filter_by(name='moderator').first()
-#         admins_role = Role.query.filter_by(name='admin').first()
-#         admins_count = db.session.query(User).filter(User.roles.contains(admins_role)).count()
-#         moderators_count = db.session.query(User).filter(User.roles.contains(moderators_role)).count()
-#         clients_count = Client.query.count()
-        
+    api_resp['url'] = '/dash/v1.0/parser_data/<id>/<data_id>'
+    api_resp['method'] = 'GET'
 
-#         resp_data = {
-#             'moderators_count': moderators_count,
-#             'parsers_count': parsers_count,
-#             'clients_count': clients_count,
-#             'admins_count': admins_count
-#         }
-        
-#         api_resp['data'] = resp_data
-#         api_resp['success'] = True
-        
-#     except Exception as err:
-#         api_resp['success'] = False
-#         api_resp['error'] = 'Ошибка получения счетчиков'
+    parser = Parser.query.filter_by(id=id).first()
+    item = None
+    if parser is not None and parser.viewable_by(current_user):
+        item = parser.data_item(data_id)
+
+    if item is None:
+        api_resp['success'] = False
+        api_resp['error'] = 'Запись не найдена!'
+        return json_response(api_resp, 404)
+
+    api_resp['resp_data'] = {
+        'id': item.id,
+        'datestamp': item.datestamp,
+        'json': item.json
+    }
+
+    return json_response(api_resp)
+
+
+# Сводки приема для графика на странице парсера, параметры как у /api/v1.0/parsers/rollups/<id>
+@dashboard.route('/dash/v1.0/parser_rollups/<int:id>', methods=['GET'])
+@login_required
+@roles_accepted('root', 'admin', 'moderator')
+def get_parser_rollups(id):
 
-#     return jsonify(api_resp)
+    api_resp = {
+        'url': '',     
+        'method': '',                 
+        'success': True,                 
+        'resp_data': '',               
+        'error': ''                
+    }
+
+    api_resp['url'] = '/dash/v1.0/parser_rollups/<id>'
+    api_resp['method'] = 'GET'
+
+    parser = Parser.query.filter_by(id=id).first()
+    if parser is None or not parser.viewable_by(current_user):
+        api_resp['success'] = False
+        api_resp['error'] = 'Парсер не найден!'
+        return json_response(api_resp, 404)
+
+    try:
+        params = get_rollup_params(request.args)
+        api_resp['resp_data'] = {
+            'period': params['period'],
+            'buckets': rollups.series(parser.id, **params),
+            'summary': rollups.summary(parser.id)
+        }
+    except ValueError:
+        api_resp['success'] = False
+        api_resp['error'] = 'Неверные параметры запроса!'
+        return json_response(api_resp, 400)
+
+    return json_response(api_resp)
+
+
+#####################################################################################################
+#  Счетчики для сводки (app/counters.py), одно чтение таблицы counters:                             #
+#     root      - администраторы, модераторы, парсеры, клиенты и записи data по всей базе            #
+#     admin     - свои модераторы, парсеры, клиенты своих модераторов, записи своих парсеров         #
+#     moderator - свои клиенты                                                                      #
+#####################################################################################################
+def user_counters(user):
+
+    if user.has_role('root'):
+        values = counters.get('all', 0)
+        return {
+            'admins_count': values.get('admins', 0),
+            'moderators_count': values.get('moderators', 0),
+            'parsers_count': values.get('parsers', 0),
+            'clients_count': values.get('clients', 0),
+            'data_count': values.get('data', 0)
+        }
+
+    values = counters.get('user', user.id)
+
+    if user.has_role('admin'):
+        return {
+            'moderators_count': values.get('moderators', 0),
+            'parsers_count': values.get('parsers', 0),
+            'clients_count': values.get('child_clients', 0),
+            'data_count': values.get('data', 0)
+        }
+
+    return {'clients_count': values.get('clients', 0)}
+
+
+def get_counters(url):
+
+    api_resp = {
+        'url': '',     
+        'method': '',                 
+        'success': True,                 
+        'resp_data': '',               
+        'error': ''                
+    }
+
+    api_resp['url'] = url
+    api_resp['method'] = 'GET'
+
+    try:
+        api_resp['resp_data'] = user_counters(current_user)
+        api_resp['success'] = True
+    except:
+        api_resp['success'] = False
+        api_resp['error'] = 'Ошибка получения счетчиков'
+
+    return json_response(api_resp)
+
+
+@dashboard.route('/dash/v1.0/get_moderator_counters', methods=['GET'])
+@login_required
+@roles_required('moderator')
+def get_moderator_counters():
+    return get_counters('/dash/v1.0/get_moderator_counters')
+
+
+@dashboard.route('/dash/v1.0/get_root_counters', methods=['GET'])
+@login_required
+@roles_required('root')
+def get_root_counters():
+    return get_counters('/dash/v1.0/get_root_counters')
+
+
+@dashboard.route('/dash/v1.0/get_admin_counters', methods=['GET'])
+@login_required
+@roles_required('admin')
+def get_admin_counters():
+    return get_counters('/dash/v1.0/get_admin_counters')
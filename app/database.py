@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
+from sqlalchemy.pool import QueuePool
+
+
+# Профили базы: PRAGMA на каждое новое соединение (по порядку) и пул
+# соединений; pool None - без пула, соединение на каждый запрос (NullPool)
+PROFILES = {
+    # настройки SQLite по умолчанию, как до профилей
+    'legacy': {
+        'pragmas': [
+            ('journal_mode', 'DELETE'),
+            ('synchronous', 'FULL'),
+        ],
+        'pool': None,
+    },
+    # параллельные запись и чтение: WAL (читатели не ждут писателя),
+    # ожидание блокировки вместо ошибки, кэш и mmap на соединение
+    'concurrent': {
+        'pragmas': [
+            ('journal_mode', 'WAL'),
+            ('synchronous', 'NORMAL'),
+            ('busy_timeout', 10000),
+            ('cache_size', -16384),
+            ('mmap_size', 268435456),
+            ('temp_store', 'MEMORY'),
+        ],
+        'pool': {'size': 5, 'max_overflow': 10, 'timeout': 30},
+    },
+    # как concurrent, но каждый commit ждет fsync WAL
+    'durable': {
+        'pragmas': [
+            ('journal_mode', 'WAL'),
+            ('synchronous', 'FULL'),
+            ('busy_timeout', 10000),
+            ('cache_size', -16384),
+            ('mmap_size', 268435456),
+            ('temp_store', 'MEMORY'),
+        ],
+        'pool': {'size': 5, 'max_overflow': 10, 'timeout': 30},
+    },
+}
+
+# Запросы, которые меняют данные: первый из них в транзакции берет блокировку записи
+_WRITE_PREFIXES = ('INSERT', 'UPDATE', 'DELETE', 'REPLACE')
+
+
+def resolve_profile(config):
+    # (имя, [(pragma, значение)], параметры пула или None) по DB_PROFILE;
+    # DB_PRAGMAS и DB_POOL из конфигурации дополняют и заменяют значения профиля
+    name = config.get('DB_PROFILE') or 'concurrent'
+    if name not in PROFILES:
+        raise ValueError('DB_PROFILE: ожидается %s' % ', '.join(sorted(PROFILES)))
+    profile = PROFILES[name]
+
+    overrides = dict(config.get('DB_PRAGMAS') or {})
+    pragmas = [(pragma, overrides.pop(pragma, value)) for pragma, value in profile['pragmas']]
+    pragmas += sorted(overrides.items())
+
+    pool = profile['pool']
+    if pool is not None or config.get('DB_POOL'):
+        pool = dict(pool or PROFILES['concurrent']['pool'], **(config.get('DB_POOL') or {}))
+    return name, pragmas, pool
+
+
+def _in_memory(info):
+    return info.drivername.startswith('sqlite') and info.database in (None, '', ':memory:')
+
+
+class ProfiledSQLAlchemy(SQLAlchemy):
+    """SQLAlchemy с пулом соединений из профиля базы.
+
+    Flask-SQLAlchemy для файла SQLite включает NullPool (новое соединение
+    на каждый запрос); профиль с pool задает QueuePool нужного размера, и
+    PRAGMA соединения (app/database.py, DatabaseProfile) выполняются один
+    раз при его открытии, а не на каждый запрос.
+    """
+
+    def apply_driver_hacks(self, app, info, options):
+        name, pragmas, pool = resolve_profile(app.config)
+        if pool is not None and not _in_memory(info):
+            options.setdefault('poolclass', QueuePool)
+            options.setdefault('pool_size', pool['size'])
+            options.setdefault('max_overflow', pool['max_overflow'])
+            options.setdefault('pool_timeout', pool['timeout'])
+            if info.drivername.startswith('sqlite'):
+                # соединение из пула может достаться другому потоку
+                options.setdefault('connect_args', {})['check_same_thread'] = False
+        SQLAlchemy.apply_driver_hacks(self, app, info, options)
+
+
+class LockStats(object):
+    # ожидание блокировки записи и ошибки "database is locked"
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.acquired = 0
+            self.wait_time = 0.0
+            self.max_wait = 0.0
+            self.locked_errors = 0
+
+    def record_wait(self, elapsed):
+        with self._lock:
+            self.acquired += 1
+            self.wait_time += elapsed
+            self.max_wait = max(self.max_wait, elapsed)
+
+    def record_locked(self):
+        with self._lock:
+            self.locked_errors += 1
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                'acquired': self.acquired,
+                'wait_ms_total': self.wait_time * 1000,
+                'wait_ms_avg': self.wait_time * 1000 / self.acquired if self.acquired else 0.0,
+                'wait_ms_max': self.max_wait * 1000,
+                'locked_errors': self.locked_errors,
+            }
+
+
+class DatabaseProfile(object):
+    """Профиль базы: PRAGMA соединений SQLite, пул и учет блокировок.
+
+    Профиль выбирается DB_PROFILE (в Config - из переменной окружения
+    DB_PROFILE, по умолчанию concurrent), см. PROFILES; пул создает
+    ProfiledSQLAlchemy. Для каждого нового соединения SQLite выполняются
+    PRAGMA профиля. Учитывается время первого изменяющего запроса каждой
+    транзакции - в нем SQLite берет блокировку записи и при занятой базе
+    ждет до busy_timeout (время включает и само выполнение запроса), - и
+    ошибки "database is locked". Статистика и состояние пула - в stats()
+    (/api/v1.0/system/db_stats) и в /metrics.
+    """
+
+    def __init__(self, app=None):
+        self.name = None
+        self.pragmas = []
+        self.pool = None
+        self.lock_stats = LockStats()
+        self._engines = set()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        from app import db
+
+        self.name, self.pragmas, self.pool = resolve_profile(app.config)
+        with app.app_context():
+            engine = db.engine
+        if id(engine) in self._engines or not engine.url.drivername.startswith('sqlite'):
+            return
+        self._engines.add(id(engine))
+
+        pragmas = list(self.pragmas)
+        logger = app.logger
+
+        def connect(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            for pragma, value in pragmas:
+                try:
+                    cursor.execute('PRAGMA %s = %s' % (pragma, value))
+                except Exception as err:
+                    # journal_mode не меняется, пока базу держат другие соединения
+                    logger.warning('PRAGMA %s = %s: %s', pragma, value, err)
+            cursor.close()
+
+        event.listen(engine, 'connect', connect)
+        event.listen(engine, 'before_cursor_execute', self._before_cursor_execute)
+        event.listen(engine, 'after_cursor_execute', self._after_cursor_execute)
+        event.listen(engine, 'commit', self._end_transaction)
+        event.listen(engine, 'rollback', self._end_transaction)
+        event.listen(engine, 'handle_error', self._handle_error)
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if not conn.info.get('db_wrote') and statement.lstrip()[:7].upper().startswith(_WRITE_PREFIXES):
+            conn.info['db_write_started'] = time.time()
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        started = conn.info.pop('db_write_started', None)
+        if started is None:
+            return
+        conn.info['db_wrote'] = True
+        elapsed = time.time() - started
+        self.lock_stats.record_wait(elapsed)
+        from app import metrics
+
+        metrics.write_lock_acquired(elapsed)
+
+    def _end_transaction(self, conn):
+        conn.info.pop('db_wrote', None)
+        conn.info.pop('db_write_started', None)
+
+    def _handle_error(self, context):
+        if 'database is locked' in str(context.original_exception):
+            self.lock_stats.record_locked()
+            from app import metrics
+
+            metrics.database_locked()
+        if context.connection is not None:
+            context.connection.info.pop('db_write_started', None)
+
+    def pool_status(self, engine):
+        # состояние пула; для NullPool - только его класс
+        pool = engine.pool
+        status = {'class': type(pool).__name__}
+        if isinstance(pool, QueuePool):
+            status.update({
+                'size': pool.size(),
+                'checked_in': pool.checkedin(),
+                'checked_out': pool.checkedout(),
+                'overflow': pool.overflow(),
+                'timeout': pool._timeout,
+            })
+        return status
+
+    def stats(self, engine):
+        # профиль, фактические значения PRAGMA, пул и блокировки
+        current = {}
+        if engine.url.drivername.startswith('sqlite'):
+            with engine.connect() as conn:
+                for pragma, value in self.pragmas:
+                    current[pragma] = conn.execute('PRAGMA %s' % pragma).scalar()
+        return {
+            'profile': self.name,
+            'pragmas': current,
+            'pool': self.pool_status(engine),
+            'write_lock': self.lock_stats.to_dict(),
+        }
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+
+import csv
+import io
+import time
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+
+# Столбцы выгрузки; datestamp - UTC
+COLUMNS = ('id', 'parser_id', 'datestamp', 'json')
+
+DATESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+PY2 = bytes is str
+
+
+def _format_stamp(value):
+    return time.strftime(DATESTAMP_FORMAT, time.gmtime(value))
+
+
+def csv_chunks(batches):
+    # заголовок и по куску CSV (UTF-8) на пачку; datestamp - %Y-%m-%d %H:%M:%S
+    buffer = io.BytesIO() if PY2 else io.StringIO()
+    writer = csv.writer(buffer, lineterminator='\n')
+
+    def take():
+        data = buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+        return data if PY2 else data.encode('utf-8')
+
+    writer.writerow(COLUMNS)
+    yield take()
+    for rows in batches:
+        for row in rows:
+            text = row.json.encode('utf-8') if PY2 and row.json is not None else row.json
+            writer.writerow((row.id, row.parser_id, _format_stamp(row.datestamp), text))
+        yield take()
+
+
+def msgpack_chunks(batches):
+    # по объекту на запись: массив [id, parser_id, datestamp, json], datestamp -
+    # секунды от 1970-01-01 UTC, json - строка как в базе
+    packer = msgpack.Packer(use_bin_type=True)
+    for rows in batches:
+        yield b''.join(packer.pack([row.id, row.parser_id, row.datestamp, row.json]) for row in rows)
+
+
+class _Sink(object):
+    # файл для записи pyarrow: записанное забирается после каждой пачки
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data):
+        data = data.to_pybytes() if hasattr(data, 'to_pybytes') else bytes(data)
+        self.chunks.append(data)
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def take(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def arrow_schema():
+    return pyarrow.schema([
+        ('id', pyarrow.int64()),
+        ('parser_id', pyarrow.int64()),
+        ('datestamp', pyarrow.timestamp('s', tz='UTC')),
+        ('json', pyarrow.string()),
+    ])
+
+
+def arrow_chunks(batches):
+    # Arrow IPC stream: схема и по RecordBatch на пачку, столбцы строятся
+    # сразу из пачки строк
+    schema = arrow_schema()
+    sink = _Sink()
+    writer = pyarrow.ipc.new_stream(sink, schema)
+    yield sink.take()
+    for rows in batches:
+        ids, parser_ids, stamps, texts = list(zip(*rows))[:4]
+        arrays = [pyarrow.array(values, type=field.type)
+                  for values, field in zip((ids, parser_ids, stamps, texts), schema)]
+        writer.write_batch(pyarrow.RecordBatch.from_arrays(arrays, list(COLUMNS)))
+        yield sink.take()
+    writer.close()
+    yield sink.take()
+
+
+# формат -> (генератор кусков, mimetype, расширение файла, доступен ли)
+FORMATS = {
+    'csv': (csv_chunks, 'text/csv', 'csv', True),
+    'msgpack': (msgpack_chunks, 'application/x-msgpack', 'msgpack', msgpack is not None),
+    'arrow': (arrow_chunks, 'application/vnd.apache.arrow.stream', 'arrows', pyarrow is not None),
+}
+
+
+def available_formats():
+    return sorted(name for name, spec in FORMATS.items() if spec[3])
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+
+import threading
+
+
+class DataFeed(object):
+    """Уведомления о новых записях Data для /api/v1.0/clients/stream.
+
+    Код записи вызывает publish() после commit, ожидающие потоки
+    просыпаются и сами читают новые строки из базы по курсору id.
+    Уведомления работают внутри одного процесса, поэтому ожидание всегда
+    ограничено таймаутом: записи, сделанные другим процессом, будут
+    замечены при следующей проверке базы.
+    """
+
+    def __init__(self):
+        self.version = 0
+        self._condition = threading.Condition()
+
+    def publish(self):
+        with self._condition:
+            self.version += 1
+            self._condition.notify_all()
+
+    def wait(self, version, timeout):
+        # ждем, пока кто-нибудь опубликует запись после version;
+        # True - были новые записи, False - вышел таймаут
+        with self._condition:
+            if self.version == version:
+                self._condition.wait(timeout)
+            return self.version != version
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+
+from datetime import datetime
+
+
+DATESTAMP_FORMAT = r"%Y-%m-%d %H:%M:%S"
+
+
+def parse_datestamp(value):
+    # парсер присылает время вида 2019-01-01 12:00:00.123456, микросекунды отбрасываем
+    return datetime.strptime(value.split('.')[0], DATESTAMP_FORMAT)
+
+
+def get_data_filters(args):
+    # фильтры и курсоры выборки данных из query string; ValueError при ошибке
+    filters = {}
+
+    for name in ('after_id', 'before_id'):
+        if args.get(name):
+            filters[name] = int(args[name])
+
+    if args.get('parser_id'):
+        filters['parser_ids'] = [int(parser_id) for parser_id in args['parser_id'].split(',')]
+
+    for name in ('date_from', 'date_to'):
+        if args.get(name):
+            filters[name] = parse_datestamp(args[name])
+
+    return filters
+
+
+def get_rollup_params(args):
+    # параметры сводок приема из query string; ValueError при ошибке
+    params = {
+        'period': args.get('period', 'hour'),
+        'fill': args.get('fill') in ('1', 'true')
+    }
+    for name in ('date_from', 'date_to'):
+        if args.get(name):
+            params[name] = parse_datestamp(args[name])
+    return params
@@ -0,0 +1,289 @@
+# -*- coding: utf-8 -*-
+
+import atexit
+import json
+import os
+import re
+import threading
+import time
+from datetime import datetime
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+SPOOL_DATESTAMP_FORMAT = r"%Y-%m-%d %H:%M:%S.%f"
+
+
+class QueueFull(Exception):
+    pass
+
+
+class IngestQueue(object):
+    """Отложенная запись данных парсеров (write-behind).
+
+    Принятые записи сначала дописываются в spool-файл на диске и кладутся
+    в ограниченную очередь в памяти, а фоновый поток пишет их в базу
+    пачками: каждые INGEST_FLUSH_RECORDS записей или INGEST_FLUSH_INTERVAL_MS
+    миллисекунд, одним bulk insert и одним commit. После успешного commit
+    номер последней записанной записи сохраняется в checkpoint-файл; при
+    старте всё, что есть в spool после checkpoint, дописывается в базу.
+
+    У каждого процесса свой spool: INGEST_SPOOL_PATH.<pid>, занятый
+    блокировкой fcntl, пока процесс жив. При старте дописываются только
+    spool-файлы, которые никем не заняты (процесс-владелец завершился), после
+    чего файл удаляется. Если дописать не удалось, spool откладывается в
+    сторону (.failed.<время>) и приложение запускается без него.
+
+    Пока у базы есть непримененные миграции, очередь не запускается: это
+    делает первый запрос после flask system migrate, перезапуск не нужен.
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self.enabled = False
+        self._queue = None
+        self._lock = threading.Lock()
+        self._start_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._spool = None
+        self._seq = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.enabled = app.config.get('INGEST_WRITE_BEHIND', False)
+
+        if not self.enabled:
+            return
+
+        self.max_size = app.config['INGEST_QUEUE_SIZE']
+        self.flush_records = app.config['INGEST_FLUSH_RECORDS']
+        self.flush_interval = app.config['INGEST_FLUSH_INTERVAL_MS'] / 1000.0
+        self.spool_base = app.config['INGEST_SPOOL_PATH']
+        self.spool_path = '%s.%d' % (self.spool_base, os.getpid())
+        self.checkpoint_path = self.spool_path + '.checkpoint'
+        self.spool_fsync = app.config['INGEST_SPOOL_FSYNC']
+        self.retry_after = app.config['INGEST_RETRY_AFTER']
+
+        # spool дописывается в базу только по текущей схеме: пока есть
+        # непримененные миграции, запросы получают 503 (migrations.require_current),
+        # а очередь запускается первым запросом после flask system migrate
+        if getattr(app, 'pending_migrations', None):
+            app.logger.warning('Отложенная запись данных запустится после применения миграций')
+            app.before_request(self.start)
+        else:
+            self.start()
+
+    def start(self):
+        # дописывает брошенные spool-файлы и запускает фоновый поток;
+        # после запуска - сразу выход
+        if self._thread is not None:
+            return
+        with self._start_lock:
+            if self._thread is not None:
+                return
+            self._queue = queue.Queue(maxsize=self.max_size)
+            self._replay_orphans()
+            self._seq = 0
+            self._spool = open(self.spool_path, 'a')
+            if fcntl is not None:
+                fcntl.flock(self._spool.fileno(), fcntl.LOCK_EX)
+
+            self._thread = threading.Thread(target=self._run, name='ingest-flusher')
+            self._thread.daemon = True
+            self._thread.start()
+            atexit.register(self.stop)
+
+    def depth(self):
+        if self._queue is None:
+            return 0
+        return self._queue.qsize()
+
+    def put(self, parser_id, datestamp, json_data):
+        # запись подтверждается только после того, как попала в spool
+        with self._lock:
+            if self._queue.full():
+                raise QueueFull()
+            self._seq += 1
+            record = {
+                'seq': self._seq,
+                'parser_id': parser_id,
+                'datestamp': datestamp.strftime(SPOOL_DATESTAMP_FORMAT),
+                'json': json_data
+            }
+            self._spool.write(json.dumps(record) + '\n')
+            self._spool.flush()
+            if self.spool_fsync:
+                os.fsync(self._spool.fileno())
+            self._queue.put_nowait(record)
+        return self._seq
+
+    def stop(self):
+        if self._thread is None or self._stop.is_set():
+            return
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            if batch:
+                self._flush(batch)
+            elif self._stop.is_set():
+                break
+
+    def _collect(self):
+        # ждем первую запись, затем добираем пачку до лимита или таймаута
+        batch = []
+        try:
+            batch.append(self._queue.get(timeout=self.flush_interval))
+        except queue.Empty:
+            return batch
+        deadline = time.time() + self.flush_interval
+        while len(batch) < self.flush_records:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def _flush(self, batch):
+        # при ошибке базы повторяем; при остановке записи остаются в spool
+        # и будут дописаны при следующем старте
+        while not self._write(batch):
+            if self._stop.is_set():
+                return
+            time.sleep(self.flush_interval)
+
+        last_seq = batch[-1]['seq']
+        self._save_checkpoint(last_seq)
+
+        # spool обрезаем, только когда все подтвержденные записи уже в базе
+        with self._lock:
+            if self._queue.empty() and self._seq == last_seq:
+                self._spool.seek(0)
+                self._spool.truncate()
+
+    def _write(self, batch):
+        from app import db, data_feed
+        from app.models import Data
+
+        mappings = []
+        for record in batch:
+            mappings.append({
+                'parser_id': record['parser_id'],
+                'datestamp': datetime.strptime(record['datestamp'], SPOOL_DATESTAMP_FORMAT),
+                'json': record['json']
+            })
+
+        with self.app.app_context():
+            try:
+                Data.insert_many(mappings)
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                self.app.logger.exception('Ingest queue: ошибка записи пачки из %d записей', len(mappings))
+                return False
+        data_feed.publish()
+        return True
+
+    def _load_checkpoint(self, checkpoint_path):
+        if not os.path.exists(checkpoint_path):
+            return 0
+        with open(checkpoint_path) as f:
+            value = f.read().strip()
+        return int(value) if value else 0
+
+    def _save_checkpoint(self, seq, checkpoint_path=None):
+        checkpoint_path = checkpoint_path or self.checkpoint_path
+        tmp_path = checkpoint_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(str(seq))
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_path, checkpoint_path)
+
+    def _orphan_spools(self):
+        # spool-файлы процессов (<base>.<pid>) и общий spool прежних версий (<base>)
+        directory, base = os.path.split(os.path.abspath(self.spool_base))
+        if not os.path.isdir(directory):
+            return []
+        pattern = re.compile(re.escape(base) + r'(\.\d+)?$')
+        return sorted(os.path.join(directory, name) for name in os.listdir(directory) if pattern.match(name))
+
+    def _replay_orphans(self):
+        if fcntl is None:
+            self.app.logger.warning('Ingest queue: нет fcntl, spool-файлы прежних процессов не восстанавливаются')
+            return
+        for path in self._orphan_spools():
+            try:
+                spool = open(path)
+            except IOError:
+                continue
+            try:
+                if self._lock_orphan(path, spool):
+                    self._recover(path, spool)
+            finally:
+                spool.close()
+
+    def _lock_orphan(self, path, spool):
+        # True, если spool ничей: не занят работающим процессом и еще не
+        # восстановлен (и удален) другим процессом, пока мы ждали блокировку
+        try:
+            fcntl.flock(spool.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            return False
+        return os.path.exists(path) and os.stat(path).st_ino == os.fstat(spool.fileno()).st_ino
+
+    def _recover(self, path, spool):
+        # файлы удаляются (или откладываются) до снятия блокировки
+        checkpoint_path = path + '.checkpoint'
+        try:
+            self._replay_spool(spool, checkpoint_path)
+        except Exception:
+            failed = '%s.failed.%d' % (path, time.time())
+            self.app.logger.exception('Ingest queue: не удалось восстановить записи из spool-файла, '
+                                      'он перенесен в %s', failed)
+            os.rename(path, failed)
+            if os.path.exists(checkpoint_path):
+                os.rename(checkpoint_path, failed + '.checkpoint')
+            return
+        os.remove(path)
+        if os.path.exists(checkpoint_path):
+            os.remove(checkpoint_path)
+
+    def _replay_spool(self, spool, checkpoint_path):
+        # дописать в базу записи spool-файла после его checkpoint
+        checkpoint = self._load_checkpoint(checkpoint_path)
+
+        pending = []
+        for line in spool:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # недописанная последняя строка после падения процесса
+                continue
+            if record['seq'] > checkpoint:
+                pending.append(record)
+
+        for start in range(0, len(pending), self.flush_records):
+            batch = pending[start:start + self.flush_records]
+            if not self._write(batch):
+                raise RuntimeError('Не удалось записать пачку из spool-файла в базу')
+            self._save_checkpoint(batch[-1]['seq'], checkpoint_path)
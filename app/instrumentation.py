@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+
+import re
+import threading
+import time
+from collections import deque
+
+from flask import g, has_request_context, request
+from sqlalchemy import event
+
+
+# Пробелы и переводы строк не меняют форму запроса
+_WHITESPACE = re.compile(r'\s+')
+
+
+class RequestStats(object):
+    # запросы к базе в рамках одного HTTP-запроса
+
+    def __init__(self):
+        self.started = time.time()
+        self.queries = 0
+        self.db_time = 0.0
+        self.slowest = (0.0, None)
+        self.shapes = {}
+        self.compress_time = 0.0
+        self.compress_raw = 0
+        self.compress_sent = 0
+
+    def record(self, statement, elapsed):
+        self.queries += 1
+        self.db_time += elapsed
+        if elapsed > self.slowest[0]:
+            self.slowest = (elapsed, statement)
+        # параметры уже вынесены в плейсхолдеры: одинаковый текст - одинаковая форма
+        shape = _WHITESPACE.sub(' ', statement).strip()
+        self.shapes[shape] = self.shapes.get(shape, 0) + 1
+
+    def record_compression(self, elapsed, raw, sent):
+        # сжатие ответа (app/compression.py): время и байты до/после
+        self.compress_time += elapsed
+        self.compress_raw += raw
+        self.compress_sent += sent
+
+    def most_repeated(self):
+        # (число повторов, текст) самой частой формы запроса
+        if not self.shapes:
+            return 0, None
+        shape = max(self.shapes, key=self.shapes.get)
+        return self.shapes[shape], shape
+
+
+class SQLInstrumentation(object):
+    """Учет запросов к базе по HTTP-запросам.
+
+    Хуки SQLAlchemy (before/after_cursor_execute) считают для каждого
+    запроса число выполненных SQL, суммарное время в базе, самый медленный
+    запрос и повторы одинаковых по форме запросов: форма, повторенная не
+    меньше SQL_N_PLUS_ONE_THRESHOLD раз, помечается как N+1. Результат
+    уходит в заголовок Server-Timing, в строку лога и в скользящую сводку по
+    endpoint (последние SQL_STATS_WINDOW запросов), которую отдает
+    /api/v1.0/system/sql_stats. Запросы фоновых потоков не учитываются.
+    Для потоковых ответов заголовок содержит только запросы до начала
+    передачи тела, лог и сводка - все запросы. Также учитывается время
+    сжатия ответа (app/compression.py) и его размер до и после сжатия.
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self.enabled = False
+        self.window = 500
+        self.threshold = 10
+        self._summary = {}
+        self._lock = threading.Lock()
+        self._engines = set()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        from app import db
+
+        self.app = app
+        self.enabled = app.config.get('SQL_INSTRUMENTATION', True)
+        self.window = app.config.get('SQL_STATS_WINDOW', self.window)
+        self.threshold = app.config.get('SQL_N_PLUS_ONE_THRESHOLD', self.threshold)
+
+        if not self.enabled:
+            return
+
+        with app.app_context():
+            engine = db.engine
+        if id(engine) not in self._engines:
+            self._engines.add(id(engine))
+            event.listen(engine, 'before_cursor_execute', self._before_cursor_execute)
+            event.listen(engine, 'after_cursor_execute', self._after_cursor_execute)
+
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+        app.teardown_request(self._teardown_request)
+
+    def current(self):
+        # RequestStats текущего HTTP-запроса или None
+        if not self.enabled or not has_request_context():
+            return None
+        return getattr(g, 'sql_stats', None)
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info['query_started'] = time.time()
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        started = conn.info.pop('query_started', None)
+        if started is None:
+            return
+        if has_request_context():
+            stats = getattr(g, 'sql_stats', None)
+            if stats is not None:
+                stats.record(statement, time.time() - started)
+
+    def _before_request(self):
+        g.sql_stats = RequestStats()
+
+    def _after_request(self, response):
+        stats = getattr(g, 'sql_stats', None)
+        if stats is not None:
+            timing = 'db;dur=%.2f;desc="%d queries"' % (stats.db_time * 1000, stats.queries)
+            if stats.queries:
+                timing += ', db-max;dur=%.2f' % (stats.slowest[0] * 1000)
+            if stats.compress_raw:
+                timing += ', compress;dur=%.2f;desc="%d to %d bytes"' % (
+                    stats.compress_time * 1000, stats.compress_raw, stats.compress_sent)
+            timing += ', app;dur=%.2f' % ((time.time() - stats.started) * 1000)
+            response.headers.add('Server-Timing', timing)
+        return response
+
+    def _teardown_request(self, exc):
+        stats = getattr(g, 'sql_stats', None)
+        if stats is None:
+            return
+        g.sql_stats = None
+
+        endpoint = request.endpoint or 'unknown'
+        elapsed = time.time() - stats.started
+        repeated, shape = stats.most_repeated()
+        n_plus_one = repeated >= self.threshold
+
+        with self._lock:
+            entry = self._summary.get(endpoint)
+            if entry is None:
+                entry = self._summary[endpoint] = {
+                    'samples': deque(maxlen=self.window),
+                    'n_plus_one': 0,
+                    'n_plus_one_statement': None,
+                    'slowest': (0.0, None)
+                }
+            entry['samples'].append((stats.queries, stats.db_time, elapsed, stats.compress_time,
+                                     stats.compress_raw, stats.compress_sent))
+            if n_plus_one:
+                entry['n_plus_one'] += 1
+                entry['n_plus_one_statement'] = shape
+            if stats.slowest[0] > entry['slowest'][0]:
+                entry['slowest'] = stats.slowest
+
+        message = 'sql endpoint=%s method=%s queries=%d db_ms=%.2f slowest_ms=%.2f request_ms=%.2f repeated=%d'
+        args = (endpoint, request.method, stats.queries, stats.db_time * 1000, stats.slowest[0] * 1000,
+                elapsed * 1000, repeated)
+        if stats.compress_raw:
+            message += ' compress_ms=%.2f compress_raw=%d compress_sent=%d'
+            args += (stats.compress_time * 1000, stats.compress_raw, stats.compress_sent)
+        if n_plus_one:
+            self.app.logger.warning(message + ' n_plus_one=%s', *(args + (shape,)))
+        else:
+            self.app.logger.info(message, *args)
+
+    def summary(self):
+        # сводка по endpoint за последние window запросов
+        result = {}
+        with self._lock:
+            items = [(endpoint, list(entry['samples']), dict(entry)) for endpoint, entry in self._summary.items()]
+        for endpoint, samples, entry in items:
+            queries = sorted(sample[0] for sample in samples)
+            db_times = sorted(sample[1] for sample in samples)
+            times = sorted(sample[2] for sample in samples)
+            compress_raw = sum(sample[4] for sample in samples)
+            result[endpoint] = {
+                'requests': len(samples),
+                'queries_avg': float(sum(queries)) / len(queries),
+                'queries_max': queries[-1],
+                'db_ms_avg': sum(db_times) * 1000 / len(db_times),
+                'db_ms_p95': _percentile(db_times, 0.95) * 1000,
+                'request_ms_avg': sum(times) * 1000 / len(times),
+                'request_ms_p95': _percentile(times, 0.95) * 1000,
+                'compress_ms_avg': sum(sample[3] for sample in samples) * 1000 / len(samples),
+                'compress_ratio': (float(sum(sample[5] for sample in samples)) / compress_raw
+                                   if compress_raw else None),
+                'slowest_ms': entry['slowest'][0] * 1000,
+                'slowest_statement': entry['slowest'][1],
+                'n_plus_one': entry['n_plus_one'],
+                'n_plus_one_statement': entry['n_plus_one_statement']
+            }
+        return result
+
+    def reset(self):
+        with self._lock:
+            self._summary.clear()
+
+
+def _percentile(values, fraction):
+    # values отсортированы по возрастанию
+    return values[min(len(values) - 1, int(len(values) * fraction))]
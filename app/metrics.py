@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+
+import bisect
+import threading
+import time
+
+from flask import g, request
+
+
+# Значение метки для серий сверх METRICS_MAX_SERIES
+OVERFLOW_LABEL = '__other__'
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+CHECKOUT_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0)
+LOCK_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = ['%s="%s"' % (name, _escape(value)) for name, value in zip(names, values)]
+    if extra:
+        pairs.append('%s="%s"' % extra)
+    return '{%s}' % ','.join(pairs) if pairs else ''
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric(object):
+    # серии метрики по кортежу значений меток, не больше max_series;
+    # новые серии сверх лимита складываются в серию с метками OVERFLOW_LABEL
+
+    kind = None
+
+    def __init__(self, name, description, labelnames=(), max_series=1000):
+        self.name = name
+        self.description = description
+        self.labelnames = tuple(labelnames)
+        self.max_series = max_series
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        key = tuple(labels)
+        if key not in self._series and len(self._series) >= self.max_series:
+            key = (OVERFLOW_LABEL,) * len(self.labelnames)
+        return key
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.description), '# TYPE %s %s' % (self.name, self.kind)]
+        with self._lock:
+            series = sorted((key, self._copy(value)) for key, value in self._series.items())
+        for key, value in series:
+            lines.extend(self._render_series(key, value))
+        return lines
+
+    def _copy(self, value):
+        return value
+
+
+class Counter(Metric):
+
+    kind = 'counter'
+
+    def inc(self, labels=(), amount=1):
+        with self._lock:
+            key = self._key(labels)
+            self._series[key] = self._series.get(key, 0) + amount
+
+    def _render_series(self, key, value):
+        return ['%s%s %s' % (self.name, _format_labels(self.labelnames, key), _format_value(value))]
+
+
+class Gauge(Metric):
+
+    kind = 'gauge'
+
+    def set(self, value, labels=()):
+        with self._lock:
+            self._series[self._key(labels)] = value
+
+    def _render_series(self, key, value):
+        return ['%s%s %s' % (self.name, _format_labels(self.labelnames, key), _format_value(value))]
+
+
+class Histogram(Metric):
+
+    kind = 'histogram'
+
+    def __init__(self, name, description, buckets, labelnames=(), max_series=1000):
+        Metric.__init__(self, name, description, labelnames, max_series)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, labels=()):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            key = self._key(labels)
+            series = self._series.get(key)
+            if series is None:
+                # счетчики по корзинам (последняя - +Inf), сумма, количество
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def _copy(self, value):
+        return list(value[0]), value[1], value[2]
+
+    def _render_series(self, key, value):
+        counts, total, count = value
+        lines = []
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += bucket_count
+            labels = _format_labels(self.labelnames, key, ('le', _format_value(bound)))
+            lines.append('%s_bucket%s %d' % (self.name, labels, cumulative))
+        labels = _format_labels(self.labelnames, key)
+        lines.append('%s_sum%s %s' % (self.name, labels, _format_value(total)))
+        lines.append('%s_count%s %d' % (self.name, labels, count))
+        return lines
+
+
+class Metrics(object):
+    """Метрики приложения в текстовом формате Prometheus (/metrics).
+
+    Задержка и размер ответа по endpoint, принятые строки и байты по
+    парсерам, опросы get_data по клиентам, время получения соединения из
+    пула и состояние пула, ожидание блокировки записи SQLite и ошибки
+    "database is locked" (app/database.py). Каждая метрика хранит не больше METRICS_MAX_SERIES серий
+    (остальное - в серии __other__) и берет свою блокировку только на время
+    обновления пары чисел.
+    """
+
+    def __init__(self, app=None):
+        self.enabled = False
+        self.metrics = []
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        from app import db
+
+        self.enabled = app.config.get('METRICS_ENABLED', True)
+        max_series = app.config.get('METRICS_MAX_SERIES', 1000)
+
+        self.request_latency = Histogram(
+            'http_request_duration_seconds', 'Время обработки запроса, включая потоковую передачу тела',
+            LATENCY_BUCKETS, ('endpoint', 'method'), max_series)
+        self.response_size = Histogram(
+            'http_response_size_bytes', 'Размер ответа (кроме потоковых ответов)',
+            SIZE_BUCKETS, ('endpoint',), max_series)
+        self.ingested_rows = Counter(
+            'parser_ingested_rows_total', 'Принятые записи данных по парсерам', ('parser_id',), max_series)
+        self.ingested_bytes = Counter(
+            'parser_ingested_bytes_total', 'Принятые байты json по парсерам', ('parser_id',), max_series)
+        self.client_polls = Counter(
+            'client_polls_total', 'Запросы get_data по клиентам', ('client_id',), max_series)
+        self.pool_checkout = Histogram(
+            'db_pool_checkout_seconds', 'Время получения соединения из пула', CHECKOUT_BUCKETS)
+        self.pool_connections = Gauge(
+            'db_pool_connections', 'Соединения пула по состоянию (QueuePool)', ('state',))
+        self.write_lock = Histogram(
+            'db_write_lock_seconds', 'Первый изменяющий запрос транзакции, включая ожидание блокировки записи',
+            LOCK_BUCKETS)
+        self.locked_errors = Counter(
+            'db_locked_errors_total', 'Ошибки "database is locked" после busy_timeout')
+        self.metrics = [self.request_latency, self.response_size, self.ingested_rows,
+                        self.ingested_bytes, self.client_polls, self.pool_checkout,
+                        self.pool_connections, self.write_lock, self.locked_errors]
+
+        if not self.enabled:
+            return
+
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+        app.teardown_request(self._teardown_request)
+
+        with app.app_context():
+            self._wrap_pool(db.engine.pool)
+
+    def _wrap_pool(self, pool):
+        if getattr(pool, '_metrics_wrapped', False):
+            return
+        connect = pool.connect
+        histogram = self.pool_checkout
+
+        def timed_connect():
+            started = time.time()
+            try:
+                return connect()
+            finally:
+                histogram.observe(time.time() - started)
+
+        pool.connect = timed_connect
+        pool._metrics_wrapped = True
+
+    def _before_request(self):
+        g.metrics_started = time.time()
+
+    def _after_request(self, response):
+        if not response.is_streamed:
+            size = response.calculate_content_length()
+            if size is not None:
+                self.response_size.observe(size, (request.endpoint or 'unknown',))
+        return response
+
+    def _teardown_request(self, exc):
+        # для потоковых ответов teardown вызывается после передачи тела
+        started = getattr(g, 'metrics_started', None)
+        if started is not None:
+            g.metrics_started = None
+            self.request_latency.observe(time.time() - started, (request.endpoint or 'unknown', request.method))
+
+    def ingested(self, parser_id, rows, size):
+        if self.enabled and rows:
+            self.ingested_rows.inc((parser_id,), rows)
+            self.ingested_bytes.inc((parser_id,), size)
+
+    def client_polled(self, client_id):
+        if self.enabled:
+            self.client_polls.inc((client_id,))
+
+    def write_lock_acquired(self, elapsed):
+        if self.enabled:
+            self.write_lock.observe(elapsed)
+
+    def database_locked(self):
+        if self.enabled:
+            self.locked_errors.inc()
+
+    def render(self):
+        from app import db, db_profile
+
+        status = db_profile.pool_status(db.engine)
+        for state in ('checked_out', 'checked_in', 'overflow'):
+            if state in status:
+                self.pool_connections.set(status[state], (state,))
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
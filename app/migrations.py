@@ -0,0 +1,316 @@
+# -*- coding: utf-8 -*-
+
+"""Версионированные миграции схемы базы.
+
+Каждая миграция - номер, описание, функция upgrade(engine) и функция
+verify(engine), которая проверяет результат (в том числе что горячие
+запросы используют нужные индексы). Примененные версии хранятся в таблице
+schema_migrations. upgrade должен быть идемпотентным: на новой базе,
+созданной db.create_all() по текущим моделям, он не меняет схему, а только
+заполняет служебные таблицы; stamp выполняет все upgrade такой базы, после
+чего она проходит verify.
+
+Запуск: flask system migrate, flask system migrate-status,
+flask system verify-schema. Пока есть непримененные миграции, приложение
+отвечает 503 на все запросы и не запускает фоновые задачи (require_current).
+"""
+
+from datetime import datetime
+
+
+class Migration(object):
+
+    def __init__(self, version, description, upgrade, verify=None):
+        if isinstance(description, bytes):
+            description = description.decode('utf-8')
+        self.version = version
+        self.description = description
+        self.upgrade = upgrade
+        self.verify = verify
+
+
+class VerificationError(Exception):
+    pass
+
+
+MIGRATIONS = []
+
+
+def migration(version, description):
+    def decorator(upgrade):
+        MIGRATIONS.append(Migration(version, description, upgrade))
+        MIGRATIONS.sort(key=lambda m: m.version)
+        return upgrade
+    return decorator
+
+
+def verifies(version):
+    def decorator(verify):
+        for m in MIGRATIONS:
+            if m.version == version:
+                m.verify = verify
+        return verify
+    return decorator
+
+
+def _ensure_table(engine):
+    engine.execute(
+        'CREATE TABLE IF NOT EXISTS schema_migrations ('
+        'version INTEGER PRIMARY KEY, description VARCHAR, applied_at DATETIME)')
+
+
+def applied_versions(engine):
+    _ensure_table(engine)
+    return set(row[0] for row in engine.execute('SELECT version FROM schema_migrations'))
+
+
+def pending(engine):
+    applied = applied_versions(engine)
+    return [m for m in MIGRATIONS if m.version not in applied]
+
+
+def stamp(engine):
+    # база только что создана по моделям: схема уже текущая, upgrade только
+    # заполняют служебные таблицы (раздел 0 в data_partitions, счетчики).
+    # Выполняются все миграции, а не только непримененные: initdb пересоздает
+    # таблицы моделей, а schema_migrations остается
+    applied = applied_versions(engine)
+    for m in MIGRATIONS:
+        m.upgrade(engine)
+        if m.version not in applied:
+            _record(engine, m)
+
+
+def _record(engine, m):
+    with engine.begin() as conn:
+        conn.execute(
+            'INSERT INTO schema_migrations (version, description, applied_at) VALUES (?, ?, ?)',
+            (m.version, m.description, datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')))
+
+
+def upgrade(engine, target=None, echo=None):
+    done = []
+    for m in pending(engine):
+        if target is not None and m.version > target:
+            break
+        if echo:
+            echo('Migration %d: %s' % (m.version, m.description))
+        m.upgrade(engine)
+        _record(engine, m)
+        done.append(m)
+    return done
+
+
+def verify(engine):
+    # [(migration, ok, сообщение)] для всех примененных миграций с проверкой
+    applied = applied_versions(engine)
+    results = []
+    for m in MIGRATIONS:
+        if m.version not in applied or m.verify is None:
+            continue
+        try:
+            m.verify(engine)
+            results.append((m, True, 'OK'))
+        except VerificationError as err:
+            results.append((m, False, str(err)))
+    return results
+
+
+def require_current(app, engine):
+    # Модели уже описывают новую схему (parsers.retention_days, datestamp в
+    # секундах и т.д.), поэтому на базе со старой схемой запросы падают.
+    # Пока есть непримененные миграции, все запросы получают 503; после
+    # flask system migrate (в любом процессе) приложение начинает работать
+    # без перезапуска. Возвращает версии непримененных миграций.
+    app.pending_migrations = [m.version for m in pending(engine)]
+    if not app.pending_migrations:
+        return []
+
+    app.logger.warning('Есть непримененные миграции (%s), выполните: flask system migrate',
+                       ', '.join(str(version) for version in app.pending_migrations))
+
+    @app.before_request
+    def check_migrations():
+        from app.api.errors import error_response
+
+        if not app.pending_migrations:
+            return None
+        app.pending_migrations = [m.version for m in pending(engine)]
+        if not app.pending_migrations:
+            app.logger.info('Миграции применены, приложение работает')
+            return None
+        response = error_response(503, 'Схема базы устарела, выполните: flask system migrate')
+        response.headers['Retry-After'] = '60'
+        return response
+
+    return app.pending_migrations
+
+
+def query_plan(engine, sql, params=()):
+    return ' | '.join(row[-1] for row in engine.execute('EXPLAIN QUERY PLAN ' + sql, params))
+
+
+def assert_uses_index(engine, index_name, sql, params=()):
+    plan = query_plan(engine, sql, params)
+    if index_name not in plan:
+        raise VerificationError('%s не использует %s: %s' % (sql, index_name, plan))
+
+
+def index_exists(engine, name):
+    row = engine.execute("SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = ?", (name,)).first()
+    return row is not None
+
+
+def column_exists(engine, table, name):
+    return any(row[1] == name for row in engine.execute('PRAGMA table_info(%s)' % table))
+
+
+#####################################################################################################
+#                                           MIGRATIONS                                              #
+#####################################################################################################
+
+@migration(1, 'data: индексы (parser_id, id) и (parser_id, datestamp)')
+def _data_indexes(engine):
+    engine.execute('CREATE INDEX IF NOT EXISTS ix_data_parser_id_id ON data (parser_id, id)')
+    engine.execute('CREATE INDEX IF NOT EXISTS ix_data_parser_id_datestamp ON data (parser_id, datestamp)')
+
+
+@verifies(1)
+def _verify_data_indexes(engine):
+    for name in ('ix_data_parser_id_id', 'ix_data_parser_id_datestamp'):
+        if not index_exists(engine, name):
+            raise VerificationError('Нет индекса %s' % name)
+    # данные парсера (страница парсера, get_data с parser_id)
+    assert_uses_index(engine, 'ix_data_parser_id_id',
+                      'SELECT id FROM data WHERE parser_id = ? ORDER BY id DESC LIMIT 100', (1,))
+    # выборка и очистка данных парсера по времени
+    assert_uses_index(engine, 'ix_data_parser_id_datestamp',
+                      'SELECT id FROM data WHERE parser_id = ? AND datestamp >= ? AND datestamp < ?', (1, 0, 1))
+    assert_uses_index(engine, 'ix_data_parser_id_datestamp',
+                      'DELETE FROM data WHERE parser_id = ? AND datestamp < ?', (1, 0))
+
+
+@migration(2, 'data.datestamp: текст ISO -> целое число секунд UTC')
+def _data_datestamp_epoch(engine, chunk=10000):
+    # пачками, чтобы не держать блокировку записи на всю таблицу
+    while True:
+        with engine.begin() as conn:
+            result = conn.execute(
+                "UPDATE data SET datestamp = CAST(strftime('%s', datestamp) AS INTEGER) "
+                "WHERE id IN (SELECT id FROM data WHERE typeof(datestamp) = 'text' LIMIT ?)", (chunk,))
+        if result.rowcount < chunk:
+            break
+
+
+@verifies(2)
+def _verify_data_datestamp_epoch(engine):
+    count = engine.execute("SELECT count(*) FROM data WHERE typeof(datestamp) = 'text'").scalar()
+    if count:
+        raise VerificationError('%d записей data с datestamp в текстовом виде' % count)
+
+
+@migration(3, 'parsers.retention_days: срок хранения данных парсера')
+def _parsers_retention_days(engine):
+    if not column_exists(engine, 'parsers', 'retention_days'):
+        engine.execute('ALTER TABLE parsers ADD COLUMN retention_days INTEGER')
+
+
+@verifies(3)
+def _verify_parsers_retention_days(engine):
+    if not column_exists(engine, 'parsers', 'retention_days'):
+        raise VerificationError('Нет колонки parsers.retention_days')
+
+
+@migration(4, 'data_partitions: реестр разделов data, раздел 0 - таблица data')
+def _data_partitions(engine):
+    from app.models import DataPartition
+
+    DataPartition.__table__.create(bind=engine, checkfirst=True)
+    engine.execute(
+        "INSERT INTO data_partitions (number, name, min_datestamp, max_datestamp, created_at) "
+        "SELECT 0, 'data', min(datestamp), max(datestamp), ? FROM data "
+        "WHERE NOT EXISTS (SELECT 1 FROM data_partitions WHERE number = 0)",
+        (datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S'),))
+
+
+@verifies(4)
+def _verify_data_partitions(engine):
+    row = engine.execute('SELECT name FROM data_partitions WHERE number = 0').first()
+    if row is None or row[0] != 'data':
+        raise VerificationError('Нет раздела 0 (data) в data_partitions')
+    for number, name in engine.execute('SELECT number, name FROM data_partitions WHERE number > 0'):
+        if not engine.has_table(name):
+            raise VerificationError('Нет таблицы раздела %d: %s' % (number, name))
+
+
+@migration(5, 'counters: счетчики сводок дашборда, пересчет по текущим данным')
+def _counters(engine):
+    from app import counters
+    from app.models import Counter
+
+    Counter.__table__.create(bind=engine, checkfirst=True)
+    with engine.begin() as conn:
+        counters.rebuild(conn)
+
+
+@verifies(5)
+def _verify_counters(engine):
+    from app import counters
+
+    if not engine.has_table('counters'):
+        raise VerificationError('Нет таблицы counters')
+    with engine.connect() as conn:
+        drift = counters.check(conn)
+    if drift:
+        raise VerificationError('%d счетчиков расходятся с данными, выполните: flask system rebuild-counters'
+                                % len(drift))
+
+
+@migration(6, 'data_rollups: сводки приема данных по минутам, часам и дням')
+def _data_rollups(engine):
+    from app import rollups
+    from app.models import DataRollup
+
+    DataRollup.__table__.create(bind=engine, checkfirst=True)
+    with engine.begin() as conn:
+        rollups.rebuild(conn)
+
+
+@verifies(6)
+def _verify_data_rollups(engine):
+    if not engine.has_table('data_rollups'):
+        raise VerificationError('Нет таблицы data_rollups')
+    assert_uses_index(engine, 'sqlite_autoindex_data_rollups_1',
+                      'SELECT bucket, records FROM data_rollups WHERE parser_id = ? AND period = ? '
+                      'AND bucket >= ? AND bucket <= ? ORDER BY bucket', (1, 'hour', 0, 3600))
+
+
+@migration(7, 'parser_latest: последняя запись каждого парсера')
+def _parser_latest(engine):
+    from app import latest_snapshots
+    from app.models import ParserLatest
+
+    ParserLatest.__table__.create(bind=engine, checkfirst=True)
+    with engine.begin() as conn:
+        latest_snapshots.rebuild(conn)
+
+
+@verifies(7)
+def _verify_parser_latest(engine):
+    if not engine.has_table('parser_latest'):
+        raise VerificationError('Нет таблицы parser_latest')
+    assert_uses_index(engine, 'ix_data_parser_id_id',
+                      'SELECT id FROM data WHERE parser_id = ? ORDER BY id DESC LIMIT 1', (1,))
+
+
+@migration(8, 'change_versions: версии наборов данных для условных GET')
+def _change_versions(engine):
+    from app.models import ChangeVersion
+
+    ChangeVersion.__table__.create(bind=engine, checkfirst=True)
+
+
+@verifies(8)
+def _verify_change_versions(engine):
+    if not engine.has_table('change_versions'):
+        raise VerificationError('Нет таблицы change_versions')
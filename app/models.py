@@ -5,8 +5,13 @@ from wtforms import StringField, PasswordField, SubmitField
 from wtforms.validators import Required
 from werkzeug.security import generate_password_hash, check_password_hash
 from flask_security import RoleMixin, UserMixin, current_user
-from app import db, login
+from app import db, login, token_cache, activity_tracker, user_sessions, data_feed, data_partitions, counters, rollups, latest_snapshots, change_versions
+from app.partitions import make_id, split_id
+from app.serialize import stored_json
 import time
+import calendar
+from collections import namedtuple
+import numbers
 from datetime import datetime, timedelta
 import base64
 import os
@@ -57,15 +62,20 @@ class User(UserMixin, db.Model):
         db.session.commit()
         return new_client.token
 
+    # время входа/выхода копится в activity_tracker и пишется в базу пачками
     def _update_last_login_time(self, date):
-        self.last_login_at = date
-        db.session.add(self)
-        db.session.commit()
+        activity_tracker.touch('users', self.id, 'last_login_at', date)
 
     def _update_last_logout_time(self, date):
-        self.last_logout_at = date
-        db.session.add(self)
-        db.session.commit()        
+        activity_tracker.touch('users', self.id, 'last_logout_at', date)
+
+    @property
+    def last_login(self):
+        return activity_tracker.last_seen('users', self.id, 'last_login_at', self.last_login_at)
+
+    @property
+    def last_logout(self):
+        return activity_tracker.last_seen('users', self.id, 'last_logout_at', self.last_logout_at)
 
 
     def to_dict(self):
@@ -74,14 +84,15 @@ class User(UserMixin, db.Model):
             'name' : self.name,
             'active' : self.active,
             'role' : self.roles[0].name,
-            'last_login_at': self.last_login_at,
-            'last_logout_at': self.last_logout_at,
+            'last_login_at': self.last_login,
+            'last_logout_at': self.last_logout,
         }
         return data
 
 
     def set_password(self, password):
         self.password_hash = generate_password_hash(password)
+        user_sessions.forget_user(self.id)
 
     def check_password(self, password):
         return check_password_hash(self.password_hash, password)
@@ -92,16 +103,275 @@ class Role(db.Model, RoleMixin):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String, unique=True)
     description = db.Column(db.String(255))
-    users = db.relationship('User', secondary=roles_users, backref=db.backref('roles', lazy='dynamic'))
+    users = db.relationship('User', secondary=roles_users, backref='roles')
+
+class EpochDateTime(db.TypeDecorator):
+    # datetime (UTC, без микросекунд) хранится целым числом секунд:
+    # компактно и сортируется так же, как время
+    impl = db.Integer
+
+    def process_bind_param(self, value, dialect):
+        if not isinstance(value, datetime):
+            return value
+        return calendar.timegm(value.utctimetuple())
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        if isinstance(value, numbers.Number):
+            return datetime.utcfromtimestamp(value)
+        # строка в старом формате, до миграции 2
+        return datetime.strptime(value.split('.')[0], '%Y-%m-%d %H:%M:%S')
+
+
+def epoch_seconds(value):
+    # datestamp, прочитанный без EpochDateTime, - целым числом секунд;
+    # строки старого формата (до миграции 2 или записанные в обход модели)
+    # разбираются так же, как в EpochDateTime
+    if value is None or isinstance(value, numbers.Number):
+        return value
+    return calendar.timegm(datetime.strptime(value.split('.')[0], '%Y-%m-%d %H:%M:%S').utctimetuple())
+
+
+def data_to_dict(item):
+    return {
+        'id': item.id,
+        'parser_id': item.parser_id,
+        'datestamp': item.datestamp,
+        'json': stored_json(item.json)
+    }
+
+
+# Запись data, прочитанная из любого раздела; id - глобальный (см. app/partitions.py),
+# size - полная длина json, если прочитано только его начало
+class DataRow(namedtuple('DataRow', ['id', 'parser_id', 'datestamp', 'json', 'size'])):
+
+    __slots__ = ()
+
+    def to_dict(self):
+        return data_to_dict(self)
+
 
 class Data(db.Model):
 
     __tablename__ = 'data'
+    __table_args__ = (
+        db.Index('ix_data_parser_id_id', 'parser_id', 'id'),
+        db.Index('ix_data_parser_id_datestamp', 'parser_id', 'datestamp'),
+    )
 
     id = db.Column(db.Integer, primary_key = True, autoincrement=True)
-    datestamp = db.Column(db.DateTime)
+    datestamp = db.Column(EpochDateTime)
     json = db.Column(db.String)
     parser_id = db.Column(db.Integer, db.ForeignKey('parsers.id'))
+
+    def to_dict(self):
+        return data_to_dict(self)
+
+    # Записи читаются и пишутся через методы ниже, а не через Data.query:
+    # при DATA_PARTITIONING они лежат в таблицах разделов (app/partitions.py)
+
+    @staticmethod
+    def insert_many(mappings):
+        # mappings - список словарей {'parser_id', 'datestamp', 'json'};
+        # один insert в текущий раздел без commit, транзакцией управляет
+        # вызывающий код
+        if not mappings:
+            return 0
+        number, table = data_partitions.current()
+        db.session.execute(table.insert(), mappings)
+        data_partitions.extend_bounds(number, [mapping['datestamp'] for mapping in mappings])
+        parser_counts = {}
+        for mapping in mappings:
+            parser_counts[mapping['parser_id']] = parser_counts.get(mapping['parser_id'], 0) + 1
+        counters.add_data(parser_counts)
+        rollups.record(mappings)
+        latest_snapshots.record(number, table, parser_counts)
+        change_versions.bump(['data'])
+        return len(mappings)
+
+    @staticmethod
+    def iter_page(parser_ids=None, after_id=None, before_id=None, date_from=None, date_to=None,
+                  limit=None, preview=None, chunk_size=500):
+        # keyset-пагинация по id: after_id - новые записи по возрастанию id
+        # (инкрементальный опрос), иначе - записи по убыванию id, старше before_id.
+        # Разделы читаются по порядку, пока не набран limit; из курсора строки
+        # берутся пачками по chunk_size. preview - читать только начало json
+        for rows in Data.iter_batches(parser_ids, after_id, before_id, date_from, date_to,
+                                      limit, preview, chunk_size):
+            for row in rows:
+                yield row
+
+    @staticmethod
+    def iter_batches(parser_ids=None, after_id=None, before_id=None, date_from=None, date_to=None,
+                     limit=None, preview=None, chunk_size=500, epoch=False):
+        # то же, что iter_page, но списками DataRow по chunk_size строк или
+        # меньше (выгрузка строит из пачки столбцы); epoch - datestamp
+        # целым числом секунд, без преобразования в datetime
+        ascending = after_id is not None
+        cursor = after_id if ascending else before_id
+        start, local_cursor = split_id(cursor) if cursor is not None else (None, None)
+        remaining = limit
+
+        for number, table in data_partitions.select(date_from, date_to, start=start, ascending=ascending):
+            if epoch:
+                # datestamp - целое число секунд (миграция 2); оставшиеся
+                # строки старого формата переводятся в секунды ниже
+                columns = [table.c.id, table.c.parser_id, db.type_coerce(table.c.datestamp, db.Integer)]
+            else:
+                columns = [table.c.id, table.c.parser_id, table.c.datestamp]
+            if preview:
+                columns += [db.func.substr(table.c.json, 1, preview), db.func.length(table.c.json)]
+            else:
+                columns += [table.c.json]
+            query = db.select(columns)
+            if parser_ids:
+                query = query.where(table.c.parser_id.in_(parser_ids))
+            if date_from is not None:
+                query = query.where(table.c.datestamp >= date_from)
+            if date_to is not None:
+                query = query.where(table.c.datestamp <= date_to)
+            if number == start:
+                if ascending:
+                    query = query.where(table.c.id > local_cursor)
+                else:
+                    query = query.where(table.c.id < local_cursor)
+            query = query.order_by(table.c.id.asc() if ascending else table.c.id.desc())
+            if remaining is not None:
+                query = query.limit(remaining)
+
+            result = db.session.execute(query)
+            while True:
+                rows = result.fetchmany(chunk_size)
+                if not rows:
+                    break
+                yield [DataRow(make_id(number, row[0]), row[1], epoch_seconds(row[2]) if epoch else row[2],
+                               row[3], row[4] if preview else None)
+                       for row in rows]
+                if remaining is not None:
+                    remaining -= len(rows)
+            if remaining is not None and remaining <= 0:
+                break
+
+    @staticmethod
+    def page(**filters):
+        return list(Data.iter_page(**filters))
+
+    @staticmethod
+    def get(global_id, parser_id=None):
+        number, local_id = split_id(global_id)
+        for partition, table in data_partitions.select(start=number):
+            if partition != number:
+                break
+            query = db.select([table.c.id, table.c.parser_id, table.c.datestamp, table.c.json]) \
+                .where(table.c.id == local_id)
+            if parser_id is not None:
+                query = query.where(table.c.parser_id == parser_id)
+            row = db.session.execute(query).first()
+            if row is not None:
+                return DataRow(global_id, row[1], row[2], row[3], None)
+        return None
+
+    @staticmethod
+    def max_id():
+        # id самой новой записи во всех разделах, 0 - записей нет
+        for number, table in data_partitions.select():
+            value = db.session.execute(db.select([db.func.max(table.c.id)])).scalar()
+            if value:
+                return make_id(number, value)
+        return 0
+
+    @staticmethod
+    def add_records(parser_id, records):
+        # records - список словарей {'datestamp': datetime, 'json': str},
+        # пишутся одним bulk insert в одной транзакции
+        mappings = []
+        for record in records:
+            mappings.append({
+                'datestamp': record['datestamp'],
+                'json': record['json'],
+                'parser_id': parser_id
+            })
+        if not mappings:
+            return 0
+        try:
+            Data.insert_many(mappings)
+            db.session.commit()
+        except:
+            db.session.rollback()
+            raise
+        data_feed.publish()
+        return len(mappings)
+
+
+class DataPartition(db.Model):
+
+    __tablename__ = 'data_partitions'
+
+    number = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    name = db.Column(db.String, unique=True, nullable=False)
+    key = db.Column(db.String, unique=True)
+    # границы datestamp записей раздела; обе None - раздел пуст
+    min_datestamp = db.Column(EpochDateTime)
+    max_datestamp = db.Column(EpochDateTime)
+    created_at = db.Column(db.DateTime)
+
+
+class ParserLatest(db.Model):
+
+    # последняя запись парсера, см. app/snapshots.py
+    __tablename__ = 'parser_latest'
+
+    parser_id = db.Column(db.Integer, db.ForeignKey('parsers.id'), primary_key=True, autoincrement=False)
+    # глобальный id записи (app/partitions.py)
+    data_id = db.Column(db.Integer)
+    datestamp = db.Column(EpochDateTime)
+    json = db.Column(db.String)
+    updated_at = db.Column(db.DateTime)
+
+    def to_dict(self):
+        return {
+            'id': self.data_id,
+            'parser_id': self.parser_id,
+            'datestamp': self.datestamp,
+            'json': stored_json(self.json)
+        }
+
+
+class DataRollup(db.Model):
+
+    # сводки приема данных по интервалам, см. app/rollups.py
+    __tablename__ = 'data_rollups'
+
+    parser_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    period = db.Column(db.String(8), primary_key=True)
+    bucket = db.Column(EpochDateTime, primary_key=True)
+    records = db.Column(db.Integer, nullable=False, default=0)
+    size = db.Column(db.Integer, nullable=False, default=0)
+    first_datestamp = db.Column(EpochDateTime)
+    last_datestamp = db.Column(EpochDateTime)
+    last_received = db.Column(EpochDateTime)
+
+
+class ChangeVersion(db.Model):
+
+    # версии наборов данных для ETag / Last-Modified, см. app/versions.py
+    __tablename__ = 'change_versions'
+
+    name = db.Column(db.String(32), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+    changed_at = db.Column(db.DateTime)
+
+
+class Counter(db.Model):
+
+    # счетчики сводок дашборда, см. app/counters.py
+    __tablename__ = 'counters'
+
+    scope = db.Column(db.String(16), primary_key=True)
+    scope_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    name = db.Column(db.String(32), primary_key=True)
+    value = db.Column(db.Integer, nullable=False, default=0)
     
 
 class Parser(db.Model):
@@ -111,8 +381,11 @@ class Parser(db.Model):
     id = db.Column(db.Integer, primary_key = True)
     name = db.Column(db.String)
     data = db.relationship('Data', backref='parser', lazy='dynamic')
+    latest = db.relationship('ParserLatest', uselist=False, cascade='all, delete-orphan')
     token = db.Column(db.String(32), index=True, unique=True)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    # срок хранения данных в днях, None - RETENTION_DEFAULT_DAYS
+    retention_days = db.Column(db.Integer)
 
     def get_token(self, expires_in=432000):
         now = datetime.utcnow()
@@ -127,19 +400,16 @@ class Parser(db.Model):
             'id': self.id,
             'name': self.name,
             'token': self.token,
-            'owner': User.query.filter_by(id=self.user_id).first().name
+            'owner': self.owner.name
         }
         return data 
 
+    def viewable_by(self, user):
+        return self.user_id == user.id or user.name == 'root'
+
     def to_dict_with_data(self):
-        if self.user_id == current_user.id or current_user.name == 'root':
-            parser_data = []
-            for i in self.data:
-                parser_data.append({
-                    'id': i.id,
-                    'datestamp': i.datestamp,
-                    'json': i.json
-                })
+        if self.viewable_by(current_user):
+            parser_data = list(self.iter_data())
             data = {
                 'id': self.id,
                 'name': self.name,
@@ -152,14 +422,34 @@ class Parser(db.Model):
         
         return data
 
+    def iter_data(self, chunk_size=500):
+        # данные парсера по одной записи, из базы читаются пачками по chunk_size
+        for item in Data.iter_page(parser_ids=[self.id], after_id=0, chunk_size=chunk_size):
+            yield item.to_dict()
+
+    def data_page(self, preview=300, **filters):
+        # страница данных для таблицы парсера: из базы берется только начало
+        # json (preview символов) и его длина, полностью - по data_item()
+        rows = []
+        for item in Data.iter_page(parser_ids=[self.id], preview=preview, **filters):
+            rows.append({
+                'id': item.id,
+                'datestamp': item.datestamp,
+                'json': item.json,
+                'size': item.size,
+                'truncated': (item.size or 0) > preview
+            })
+        return rows
+
+    def data_item(self, data_id):
+        return Data.get(data_id, parser_id=self.id)
+
     def set_data(self, datestamp, json):
-        data = Data()
-        data.datestamp = datestamp
-        data.parser = self
-        data.json = json
-        db.session.add(data)
-        db.session.commit()
-        
+        Data.add_records(self.id, [{'datestamp': datestamp, 'json': json}])
+
+    def set_data_batch(self, records):
+        return Data.add_records(self.id, records)
+
 
 class Client(db.Model):
 
@@ -188,9 +478,11 @@ class Client(db.Model):
         self.token_expiration = now + timedelta(days=num)
 
     def update_last_login_time(self, date):
-        self.last_login_at = date
-        db.session.add(self)
-        db.session.commit()
+        activity_tracker.touch('clients', self.id, 'last_login_at', date)
+
+    @property
+    def last_login(self):
+        return activity_tracker.last_seen('clients', self.id, 'last_login_at', self.last_login_at)
 
     def to_dict(self):
         data = {
@@ -198,13 +490,14 @@ class Client(db.Model):
             'name': self.name,
             'active': self.active,
             'token': self.token,
-            'owner': User.query.filter_by(id=self.user_id).first().name,
+            'owner': self.owner.name,
             'token_expiration': self.token_expiration
         }
         return data
 
     def revoke_token(self):
         self.token_expiration = datetime.utcnow() - timedelta(seconds=1)
+        token_cache.invalidate(self.token)
 
     def activ_deactiv_client(self):
         if self.active == True:
@@ -215,6 +508,7 @@ class Client(db.Model):
             db.session.commit()
         except:
             db.session.rollback()
+        token_cache.invalidate(self.token)
 
 
 class LoginForm(FlaskForm):
@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+
+import calendar
+import threading
+from datetime import datetime
+
+
+# id записи в разделе n (n >= 1) для клиентов - (n << ID_SHIFT) | id в таблице раздела;
+# раздел 0 - исходная таблица data, ее id не меняются. Глобальные id остаются
+# меньше 2**53 и без потерь передаются в JSON/JavaScript.
+ID_SHIFT = 32
+
+KEY_FORMATS = {
+    'day': '%Y%m%d',
+    'month': '%Y%m',
+}
+
+
+def make_id(number, local_id):
+    return (number << ID_SHIFT) | local_id
+
+
+def split_id(global_id):
+    return global_id >> ID_SHIFT, global_id & ((1 << ID_SHIFT) - 1)
+
+
+def epoch(value):
+    if isinstance(value, datetime):
+        return calendar.timegm(value.utctimetuple())
+    return value
+
+
+class DataPartitions(object):
+    """Разделы (партиции) таблицы data по времени.
+
+    При DATA_PARTITIONING = 'day' или 'month' новые записи пишутся в таблицу
+    текущего раздела data_<ГГГГММДД> или data_<ГГГГММ>; раздел выбирается по
+    времени записи в базу, поэтому глобальные id (см. make_id) растут так же,
+    как раньше, и курсоры after_id/before_id работают без изменений. Разделы
+    учитываются в таблице data_partitions вместе с минимальным и
+    максимальным datestamp своих записей: чтение по диапазону времени
+    пропускает разделы, которые в него не попадают, а очистка удаляет
+    устаревший раздел целиком (DROP TABLE) вместо удаления строк.
+    Таблица data - раздел 0, она остается и при выключенном разделении.
+    """
+
+    def __init__(self, app=None):
+        self.mode = None
+        self._metadata = None
+        self._current = None
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.mode = app.config.get('DATA_PARTITIONING')
+        if self.mode is not None and self.mode not in KEY_FORMATS:
+            raise ValueError('DATA_PARTITIONING: ожидается %s' % ', '.join(sorted(KEY_FORMATS)))
+        self._current = None
+
+    def table(self, number, name):
+        # Table раздела; для раздела 0 - таблица модели Data
+        from app import db
+        from app.models import Data, EpochDateTime
+
+        if number == 0:
+            return Data.__table__
+        with self._lock:
+            if self._metadata is None:
+                self._metadata = db.MetaData()
+            table = self._metadata.tables.get(name)
+            if table is None:
+                table = db.Table(
+                    name, self._metadata,
+                    db.Column('id', db.Integer, primary_key=True, autoincrement=True),
+                    db.Column('datestamp', EpochDateTime),
+                    db.Column('json', db.String),
+                    db.Column('parser_id', db.Integer),
+                    db.Index('ix_%s_parser_id_id' % name, 'parser_id', 'id'),
+                    db.Index('ix_%s_parser_id_datestamp' % name, 'parser_id', 'datestamp'),
+                )
+            return table
+
+    def current(self, now=None):
+        # (номер, Table) раздела для записи; вызывать до записи в сессии,
+        # новый раздел создается отдельным соединением
+        if self.mode is None:
+            return 0, self.table(0, 'data')
+
+        key = (now or datetime.utcnow()).strftime(KEY_FORMATS[self.mode])
+        current = self._current
+        if current is not None and current[0] == key:
+            return current[1], current[2]
+
+        number, name = self._create(key)
+        self._current = (key, number, self.table(number, name))
+        return number, self._current[2]
+
+    def _create(self, key):
+        from app import db
+
+        name = 'data_' + key
+        engine = db.engine
+        # таблица создается раньше записи в реестре, чтобы читатели не увидели
+        # раздел без таблицы; несколько процессов могут создавать раздел
+        # одновременно - CREATE IF NOT EXISTS и INSERT ... WHERE NOT EXISTS идемпотентны
+        self.table(None, name).create(bind=engine, checkfirst=True)
+        with engine.begin() as conn:
+            conn.execute(
+                'INSERT INTO data_partitions (number, name, key, created_at) '
+                'SELECT coalesce(max(number), 0) + 1, ?, ?, ? FROM data_partitions '
+                'WHERE NOT EXISTS (SELECT 1 FROM data_partitions WHERE key = ?)',
+                (name, key, datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S'), key))
+            number = conn.execute('SELECT number FROM data_partitions WHERE key = ?', (key,)).scalar()
+        return number, name
+
+    def extend_bounds(self, number, datestamps):
+        # расширить границы раздела в текущей транзакции сессии
+        from app import db
+        from app.models import DataPartition
+
+        if not datestamps:
+            return
+        low, high = epoch(min(datestamps)), epoch(max(datestamps))
+        column = DataPartition.__table__.c
+        db.session.execute(
+            DataPartition.__table__.update().where(column.number == number).values(
+                min_datestamp=db.func.min(db.func.coalesce(column.min_datestamp, low), low),
+                max_datestamp=db.func.max(db.func.coalesce(column.max_datestamp, high), high)))
+
+    def registry(self):
+        # {номер: (имя, min_datestamp, max_datestamp)} по data_partitions
+        from app import db
+        from app.models import DataPartition
+
+        return dict((row.number, (row.name, row.min_datestamp, row.max_datestamp)) for row in db.session.query(
+            DataPartition.number, DataPartition.name, DataPartition.min_datestamp, DataPartition.max_datestamp))
+
+    def select(self, date_from=None, date_to=None, start=None, ascending=False):
+        # [(номер, Table)] разделов, где могут быть записи из диапазона времени,
+        # по порядку id; start - номер раздела, с которого начинать
+        registry = self.registry()
+        numbers = set(registry)
+        # раздел 0 без записи в реестре (база без миграции 4) - границы неизвестны
+        numbers.add(0)
+
+        result = []
+        for number in sorted(numbers, reverse=not ascending):
+            if start is not None and (number < start if ascending else number > start):
+                continue
+            name = 'data'
+            if number in registry:
+                name, low, high = registry[number]
+                if low is None and high is None:
+                    # пустой раздел
+                    continue
+                if date_from is not None and high is not None and high < date_from:
+                    continue
+                if date_to is not None and low is not None and low > date_to:
+                    continue
+            result.append((number, self.table(number, name)))
+        return result
+
+    def drop(self, number):
+        from app import db
+        from app.models import DataPartition
+
+        if number == 0:
+            raise ValueError('Раздел 0 (таблица data) не удаляется')
+        table = self.table(number, self.registry()[number][0])
+        # сначала запись в реестре: читатели перестают видеть раздел до DROP
+        DataPartition.query.filter_by(number=number).delete()
+        db.session.commit()
+        table.drop(bind=db.engine, checkfirst=True)
+        with self._lock:
+            self._metadata.remove(table)
+        if self._current is not None and self._current[1] == number:
+            self._current = None
+
+    def drop_all(self):
+        from app import db
+
+        if not db.engine.has_table('data_partitions'):
+            return
+        for number in sorted(self.registry()):
+            if number != 0:
+                self.drop(number)
@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+
+import atexit
+import threading
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+# Итог очистки данных одного парсера
+RetentionResult = namedtuple('RetentionResult', ['parser_id', 'cutoff', 'removed', 'seconds'])
+
+# Раздел data, удаленный целиком (newest - самая новая запись в нем)
+DroppedPartition = namedtuple('DroppedPartition', ['name', 'newest', 'seconds'])
+
+
+class RetentionBusy(Exception):
+    pass
+
+
+class Retention(object):
+    """Удаление устаревших данных парсеров.
+
+    Срок хранения задается парсеру в днях (Parser.retention_days), для
+    парсеров без своего срока действует RETENTION_DEFAULT_DAYS (None -
+    хранить всегда). Раздел data (app/partitions.py), в котором устарели
+    все записи, удаляется целиком. В остальных записи удаляются по индексу
+    (parser_id, datestamp) пачками по RETENTION_CHUNK, каждая пачка -
+    отдельная короткая транзакция, между пачками пауза
+    RETENTION_CHUNK_PAUSE_MS, чтобы запись новых данных не ждала долго.
+    Фоновый поток запускает очистку раз в RETENTION_INTERVAL секунд
+    (0 - только вручную, flask system retention); он запускается первым
+    обслуженным запросом (после того как применены миграции,
+    app/migrations.py) и только при BACKGROUND_JOBS, поэтому flask-команды
+    (remove-data, seed и другие) очистку не запускают.
+
+    Поток есть в каждом процессе (воркере), а разделы и счетчики общие,
+    поэтому очистка идет только под блокировкой fcntl файла
+    RETENTION_LOCK_PATH: если ее держит другой процесс, очередной запуск
+    пропускается (RetentionBusy).
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self.interval = 0
+        self.default_days = None
+        self.chunk = 5000
+        self.pause = 0.05
+        self.lock_path = None
+        self._lock = threading.Lock()
+        self._start_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.interval = app.config.get('RETENTION_INTERVAL', self.interval)
+        self.default_days = app.config.get('RETENTION_DEFAULT_DAYS', self.default_days)
+        self.chunk = app.config.get('RETENTION_CHUNK', self.chunk)
+        self.pause = app.config.get('RETENTION_CHUNK_PAUSE_MS', self.pause * 1000) / 1000.0
+        self.lock_path = app.config.get('RETENTION_LOCK_PATH')
+
+        if self.interval and app.config.get('BACKGROUND_JOBS', True):
+            app.before_request(self.start)
+
+    def start(self):
+        # вызывается перед каждым запросом; после запуска потока - сразу выход
+        if self._thread is not None:
+            return
+        with self._start_lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name='retention')
+            self._thread.daemon = True
+            self._thread.start()
+            atexit.register(self.stop)
+
+    @contextmanager
+    def exclusive(self):
+        # очистка в одном потоке одного процесса; занято - RetentionBusy
+        if not self._lock.acquire(False):
+            raise RetentionBusy()
+        lock_file = None
+        try:
+            if fcntl is not None and self.lock_path:
+                lock_file = open(self.lock_path, 'a')
+                try:
+                    fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except IOError:
+                    raise RetentionBusy()
+            yield
+        finally:
+            if lock_file is not None:
+                lock_file.close()
+            self._lock.release()
+
+    def policies(self):
+        # {parser_id: days} для всех парсеров с ограниченным сроком хранения
+        from app import db
+        from app.models import Parser
+
+        result = {}
+        for parser_id, days in db.session.query(Parser.id, Parser.retention_days):
+            if days is None:
+                days = self.default_days
+            if days is not None:
+                result[parser_id] = days
+        return result
+
+    def run(self, now=None):
+        # очистка по всем политикам: сначала целиком удаляются разделы, где
+        # устарели все записи, затем чанками - строки в остальных, затем
+        # старые минутные и часовые сводки приема;
+        # возвращает (список DroppedPartition, список RetentionResult)
+        if now is None:
+            now = datetime.utcnow()
+        from app import db, rollups
+
+        with self.exclusive():
+            cutoffs = dict((parser_id, now - timedelta(days=days)) for parser_id, days in self.policies().items())
+            dropped = self.drop_partitions(cutoffs)
+            results = [self.purge(parser_id, cutoffs[parser_id]) for parser_id in sorted(cutoffs)]
+            # сводки приема (app/rollups.py) хранятся по своим срокам
+            rollups.prune(now)
+            db.session.commit()
+        return dropped, results
+
+    def drop_partitions(self, cutoffs):
+        # раздел удаляется, если для каждого парсера с данными в нем задан срок
+        # хранения и самая новая запись раздела старше этого срока
+        from app import db, data_partitions, counters, change_versions
+
+        dropped = []
+        registry = data_partitions.registry()
+        for number, table in data_partitions.select(ascending=True):
+            high = registry[number][2] if number in registry else None
+            if number == 0 or high is None:
+                continue
+            parser_counts = dict(db.session.execute(
+                db.select([table.c.parser_id, db.func.count()]).group_by(table.c.parser_id)).fetchall())
+            if all(parser_id in cutoffs and high < cutoffs[parser_id] for parser_id in parser_counts):
+                started = time.time()
+                # счетчики уменьшаются в одной транзакции с удалением раздела из реестра
+                counters.add_data(dict((parser_id, -count) for parser_id, count in parser_counts.items()))
+                change_versions.bump(['data'])
+                data_partitions.drop(number)
+                dropped.append(DroppedPartition(table.name, high, time.time() - started))
+        db.session.rollback()
+        return dropped
+
+    def purge(self, parser_id, cutoff, chunk=None):
+        # удалить данные парсера с datestamp < cutoff во всех разделах
+        from app import db, data_partitions, counters, change_versions
+
+        chunk = chunk or self.chunk
+        started = time.time()
+        removed = 0
+
+        for number, table in data_partitions.select(date_to=cutoff):
+            while not self._stop.is_set():
+                ids = db.select([table.c.id]) \
+                    .where(table.c.parser_id == parser_id) \
+                    .where(table.c.datestamp < cutoff) \
+                    .limit(chunk)
+                try:
+                    result = db.session.execute(table.delete().where(table.c.id.in_(ids)))
+                    counters.add_data({parser_id: -result.rowcount})
+                    if result.rowcount:
+                        change_versions.bump(['data'])
+                    db.session.commit()
+                except:
+                    db.session.rollback()
+                    raise
+                removed += result.rowcount
+                if result.rowcount < chunk:
+                    break
+                if self.pause:
+                    time.sleep(self.pause)
+
+        return RetentionResult(parser_id, cutoff, removed, time.time() - started)
+
+    def stop(self):
+        if self._stop.is_set():
+            return
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        from app import db
+
+        while not self._stop.wait(self.interval):
+            with self.app.app_context():
+                try:
+                    dropped, results = self.run()
+                except RetentionBusy:
+                    self.app.logger.info('Retention: очистка уже идет, запуск пропущен')
+                    continue
+                except Exception:
+                    self.app.logger.exception('Retention: ошибка очистки данных')
+                    continue
+                finally:
+                    db.session.remove()
+            for partition in dropped:
+                self.app.logger.info('Retention: удален раздел %s за %.2f с', partition.name, partition.seconds)
+            removed = sum(result.removed for result in results)
+            if removed:
+                self.app.logger.info('Retention: удалено %d записей за %.2f с', removed,
+                                     sum(result.seconds for result in results))
@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+
+from datetime import datetime, timedelta
+
+from sqlalchemy import bindparam, func
+
+from app.partitions import epoch
+
+
+# Длина интервала в секундах
+PERIODS = {
+    'minute': 60,
+    'hour': 3600,
+    'day': 86400,
+}
+
+# Интервалов в ответе, если date_from не задан
+DEFAULT_BUCKETS = {
+    'minute': 60,
+    'hour': 168,
+    'day': 30,
+}
+
+
+def json_size(text):
+    # размер json в байтах UTF-8
+    if isinstance(text, bytes):
+        return len(text)
+    return len(text.encode('utf-8'))
+
+
+class Rollups(object):
+    """Сводки приема данных по парсерам (таблица data_rollups).
+
+    Для каждого парсера и интервала minute/hour/day по datestamp записей
+    хранятся число записей, их размер в байтах, первый и последний datestamp
+    и время последней записи в базу (last_received). Сводки обновляются в
+    Data.insert_many в одной транзакции с самими записями: два запроса
+    (INSERT OR IGNORE и UPDATE) на пачку записей независимо от ее размера.
+    Выборка за любой диапазон читает только интервалы по первичному ключу
+    (parser_id, period, bucket), без обращения к data. Очистка данных
+    сводки не меняет - это история приема; минутные и часовые интервалы
+    старше ROLLUP_MINUTE_DAYS / ROLLUP_HOUR_DAYS удаляет Retention.run.
+    """
+
+    def __init__(self, app=None):
+        self.keep_days = {'minute': 7, 'hour': 180, 'day': None}
+        self.max_buckets = 5000
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.keep_days = {
+            'minute': app.config.get('ROLLUP_MINUTE_DAYS', self.keep_days['minute']),
+            'hour': app.config.get('ROLLUP_HOUR_DAYS', self.keep_days['hour']),
+            'day': None,
+        }
+        self.max_buckets = app.config.get('ROLLUP_MAX_BUCKETS', self.max_buckets)
+
+    def record(self, mappings, received=None):
+        # учесть записи {'parser_id', 'datestamp', 'json'} в текущей транзакции сессии
+        from app import db
+
+        groups = {}
+        for mapping in mappings:
+            stamp = epoch(mapping['datestamp'])
+            size = json_size(mapping['json'])
+            for period, length in PERIODS.items():
+                key = (mapping['parser_id'], period, stamp - stamp % length)
+                group = groups.get(key)
+                if group is None:
+                    groups[key] = [1, size, stamp, stamp]
+                else:
+                    group[0] += 1
+                    group[1] += size
+                    group[2] = min(group[2], stamp)
+                    group[3] = max(group[3], stamp)
+        self._add(db.session.execute, groups, epoch(received or datetime.utcnow()))
+
+    def _add(self, execute, groups, received):
+        # groups - {(parser_id, period, bucket): [records, size, first, last]}
+        from app.models import DataRollup
+
+        if not groups:
+            return
+        table = DataRollup.__table__
+        execute(table.insert().prefix_with('OR IGNORE'), [
+            {'parser_id': key[0], 'period': key[1], 'bucket': key[2], 'records': 0, 'size': 0}
+            for key in groups])
+
+        first = bindparam('d_first')
+        last = bindparam('d_last')
+        stamp = bindparam('d_received')
+        execute(
+            table.update()
+            .where(table.c.parser_id == bindparam('k_parser'))
+            .where(table.c.period == bindparam('k_period'))
+            .where(table.c.bucket == bindparam('k_bucket'))
+            .values(records=table.c.records + bindparam('d_records'),
+                    size=table.c.size + bindparam('d_size'),
+                    first_datestamp=_least(table.c.first_datestamp, first),
+                    last_datestamp=_greatest(table.c.last_datestamp, last),
+                    last_received=_greatest(table.c.last_received, stamp)),
+            [{'k_parser': key[0], 'k_period': key[1], 'k_bucket': key[2], 'd_records': group[0],
+              'd_size': group[1], 'd_first': group[2], 'd_last': group[3], 'd_received': received}
+             for key, group in groups.items()])
+
+    def bounds(self, period, date_from=None, date_to=None):
+        # (начало первого, начало последнего интервала) для запроса; ValueError,
+        # если период неизвестен или интервалов больше ROLLUP_MAX_BUCKETS
+        if period not in PERIODS:
+            raise ValueError('period: ожидается %s' % ', '.join(sorted(PERIODS)))
+        length = PERIODS[period]
+        high = epoch(date_to or datetime.utcnow())
+        high -= high % length
+        if date_from is None:
+            low = high - (DEFAULT_BUCKETS[period] - 1) * length
+        else:
+            low = epoch(date_from)
+            low -= low % length
+        if low > high:
+            raise ValueError('date_from позже date_to')
+        if (high - low) // length + 1 > self.max_buckets:
+            raise ValueError('Больше %d интервалов, уменьшите диапазон или возьмите период крупнее'
+                             % self.max_buckets)
+        return low, high
+
+    def series(self, parser_id, period, date_from=None, date_to=None, fill=False):
+        # интервалы парсера по возрастанию; fill - добавить пустые интервалы
+        from app import db
+        from app.models import DataRollup
+
+        low, high = self.bounds(period, date_from, date_to)
+        table = DataRollup.__table__
+        rows = db.session.execute(
+            db.select([table.c.bucket, table.c.records, table.c.size, table.c.first_datestamp,
+                       table.c.last_datestamp])
+            .where(table.c.parser_id == parser_id).where(table.c.period == period)
+            .where(table.c.bucket >= low).where(table.c.bucket <= high)
+            .order_by(table.c.bucket))
+        buckets = [{
+            'bucket': row[0],
+            'records': row[1],
+            'size': row[2],
+            'first_datestamp': row[3],
+            'last_datestamp': row[4]
+        } for row in rows]
+
+        if fill:
+            present = dict((epoch(item['bucket']), item) for item in buckets)
+            buckets = []
+            for stamp in range(low, high + 1, PERIODS[period]):
+                buckets.append(present.get(stamp) or {
+                    'bucket': datetime.utcfromtimestamp(stamp),
+                    'records': 0,
+                    'size': 0,
+                    'first_datestamp': None,
+                    'last_datestamp': None
+                })
+        return buckets
+
+    def summary(self, parser_id):
+        # итог по дневным интервалам: всего записей и байт, первый и последний
+        # datestamp, время последней записи в базу
+        from app import db
+        from app.models import DataRollup, EpochDateTime
+
+        table = DataRollup.__table__
+        row = db.session.execute(
+            db.select([db.func.coalesce(db.func.sum(table.c.records), 0),
+                       db.func.coalesce(db.func.sum(table.c.size), 0),
+                       db.func.min(table.c.first_datestamp, type_=EpochDateTime),
+                       db.func.max(table.c.last_datestamp, type_=EpochDateTime),
+                       db.func.max(table.c.last_received, type_=EpochDateTime)])
+            .where(table.c.parser_id == parser_id).where(table.c.period == 'day')).first()
+        return {
+            'records': row[0],
+            'size': row[1],
+            'first_datestamp': row[2],
+            'last_datestamp': row[3],
+            'last_received': row[4]
+        }
+
+    def prune(self, now=None):
+        # удалить минутные и часовые интервалы старше срока хранения; без commit
+        from app import db
+        from app.models import DataRollup
+
+        now = now or datetime.utcnow()
+        table = DataRollup.__table__
+        removed = 0
+        for period, days in self.keep_days.items():
+            if days is None:
+                continue
+            result = db.session.execute(table.delete().where(table.c.period == period)
+                                        .where(table.c.bucket < epoch(now - timedelta(days=days))))
+            removed += result.rowcount
+        return removed
+
+    def rebuild(self, conn):
+        # пересчитать сводки по всем записям data (все разделы)
+        from app import db, data_partitions
+        from app.models import DataRollup
+
+        conn.execute(DataRollup.__table__.delete())
+        partitions = [(0, 'data')]
+        if conn.engine.has_table('data_partitions'):
+            partitions += list(conn.execute('SELECT number, name FROM data_partitions WHERE number > 0'))
+
+        total = 0
+        for number, name in partitions:
+            table = data_partitions.table(number, name)
+            # datestamp - целое число секунд (миграция 2), без преобразования типа
+            stamp = db.type_coerce(table.c.datestamp, db.Integer)
+            for period, length in PERIODS.items():
+                bucket = (stamp - stamp % length).label('bucket')
+                rows = conn.execute(
+                    db.select([table.c.parser_id, bucket, db.func.count(),
+                               db.func.sum(db.func.length(db.cast(table.c.json, db.LargeBinary))),
+                               db.func.min(stamp), db.func.max(stamp)])
+                    .where(table.c.parser_id.isnot(None))
+                    .group_by(table.c.parser_id, bucket))
+                groups = dict(((row[0], period, row[1]), [row[2], row[3] or 0, row[4], row[5]]) for row in rows)
+                self._add(conn.execute, groups, None)
+                if period == 'day':
+                    total += sum(group[0] for group in groups.values())
+        return total
+
+
+def _least(column, value):
+    return func.min(func.coalesce(column, value), value)
+
+
+def _greatest(column, value):
+    return func.max(func.coalesce(column, value), value)
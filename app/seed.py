@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+
+"""Генератор тестовых данных: пользователи, парсеры, клиенты и записи Data
+с содержимым, похожим на проекты биржи kwork. Один и тот же random_seed
+дает одинаковые данные. Используется командой flask system seed и
+бенчмарками (benchmarks/)."""
+
+import base64
+import random
+from datetime import datetime, timedelta
+
+from werkzeug.security import generate_password_hash
+
+
+CATEGORIES = [
+    u'Дизайн', u'Разработка и IT', u'Тексты и переводы', u'SEO и трафик',
+    u'Соцсети и маркетинг', u'Аудио, видео, съемка', u'Бизнес и жизнь'
+]
+
+WORDS = [
+    u'сайт', u'логотип', u'парсер', u'лендинг', u'бот', u'telegram', u'верстка', u'статья',
+    u'перевод', u'баннер', u'wordpress', u'django', u'интернет-магазин', u'копирайтинг',
+    u'монтаж', u'видео', u'таблица', u'excel', u'дизайн', u'доработка', u'срочно', u'нужен',
+    u'сделать', u'настроить', u'исправить', u'под ключ', u'адаптив', u'api', u'1С', u'реклама'
+]
+
+PRICES = [500, 1000, 1500, 2000, 3000, 5000, 10000, 20000, 50000]
+
+
+def kwork_payload(rng, project_id):
+    # словарь в духе карточки проекта kwork.ru/projects
+    price = rng.choice(PRICES)
+    return {
+        'project_id': project_id,
+        'title': u' '.join(rng.choice(WORDS) for _ in range(rng.randint(3, 7))).capitalize(),
+        'description': u' '.join(rng.choice(WORDS) for _ in range(rng.randint(20, 120))),
+        'category': rng.choice(CATEGORIES),
+        'price': price,
+        'price_max': price * rng.choice([1, 2, 3]),
+        'offers': rng.randint(0, 40),
+        'hours_left': rng.randint(1, 72),
+        'buyer': {
+            'name': 'user%d' % rng.randint(1, 50000),
+            'projects': rng.randint(1, 200),
+            'hired_percent': rng.randint(0, 100)
+        },
+        'url': 'https://kwork.ru/projects/%d' % project_id
+    }
+
+
+def _token(rng):
+    return base64.b64encode(bytes(bytearray(rng.getrandbits(8) for _ in range(24)))).decode('utf-8')
+
+
+def seed_database(app, admins=2, moderators=10, parsers=10, clients=1000, rows=100000, days=30,
+                  password='seed', random_seed=1, chunk=10000, now=None, echo=None):
+    """Добавить в базу тестовые данные; роли root/admin/moderator должны
+    уже существовать (flask system initdb). Записи равномерно распределены
+    по days дням до now. Возвращает словарь с именами пользователей,
+    токенами парсеров и клиентов."""
+
+    from app import db
+    from app.models import Client, Data, Parser, Role, User
+    from app.serialize import canonical_json
+
+    if admins < 1 or (moderators < 1 and clients) or (parsers < 1 and rows):
+        raise ValueError('Нужен хотя бы один admin, moderator для клиентов и парсер для данных')
+
+    rng = random.Random(random_seed)
+    echo = echo or (lambda message: None)
+    password_hash = generate_password_hash(password)
+    now = (now or datetime.utcnow()).replace(microsecond=0)
+
+    roles = dict((role.name, role) for role in Role.query.all())
+    if 'admin' not in roles or 'moderator' not in roles:
+        raise RuntimeError('Нет ролей admin/moderator, сначала выполните flask system initdb')
+    root = User.query.filter_by(name='root').first()
+
+    # пользователи - через datastore, их немного
+    admin_users = []
+    for index in range(admins):
+        user = app.user_datastore.create_user(name='seed_admin_%d' % index, password_hash=password_hash)
+        app.user_datastore.add_role_to_user(user, roles['admin'])
+        admin_users.append(user)
+    db.session.flush()
+    for user in admin_users:
+        user.parent_id = root.id if root else user.id
+
+    moderator_users = []
+    for index in range(moderators):
+        parent = admin_users[index % len(admin_users)]
+        user = app.user_datastore.create_user(name='seed_moderator_%d' % index, password_hash=password_hash,
+                                              parent_id=parent.id)
+        app.user_datastore.add_role_to_user(user, roles['moderator'])
+        moderator_users.append(user)
+
+    parser_objects = []
+    for index in range(parsers):
+        parser = Parser(name='seed_parser_%d' % index, token=_token(rng), user_id=admin_users[index % len(admin_users)].id)
+        db.session.add(parser)
+        parser_objects.append(parser)
+    db.session.commit()
+    echo('Users: %d admins, %d moderators; parsers: %d' % (admins, moderators, parsers))
+
+    # клиенты и данные - пачками через core insert
+    client_tokens = []
+    expiration = now + timedelta(days=365)
+    for start in range(0, clients, chunk):
+        mappings = []
+        for index in range(start, min(start + chunk, clients)):
+            token = _token(rng)
+            client_tokens.append(token)
+            mappings.append({
+                'name': 'seed_client_%d' % index,
+                'active': True,
+                'user_id': moderator_users[index % len(moderator_users)].id,
+                'token': token,
+                'token_expiration': expiration
+            })
+        db.session.execute(Client.__table__.insert(), mappings)
+        db.session.commit()
+    echo('Clients: %d' % clients)
+
+    parser_ids = [parser.id for parser in parser_objects]
+    first = now - timedelta(days=days)
+    step = float(days * 86400) / max(rows, 1)
+    for start in range(0, rows, chunk):
+        mappings = []
+        for index in range(start, min(start + chunk, rows)):
+            mappings.append({
+                'parser_id': rng.choice(parser_ids),
+                'datestamp': first + timedelta(seconds=int(index * step)),
+                'json': canonical_json(kwork_payload(rng, 1000000 + index))
+            })
+        Data.insert_many(mappings)
+        db.session.commit()
+        echo('Data: %d / %d' % (start + len(mappings), rows))
+
+    return {
+        'password': password,
+        'admins': [user.name for user in admin_users],
+        'moderators': [user.name for user in moderator_users],
+        'parsers': [{'id': parser.id, 'token': parser.token} for parser in parser_objects],
+        'client_tokens': client_tokens,
+        'rows': rows,
+        'first': first.strftime('%Y-%m-%d %H:%M:%S'),
+        'last': now.strftime('%Y-%m-%d %H:%M:%S')
+    }
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+
+import binascii
+import json as std_json
+import os
+import re
+import uuid
+from datetime import date, datetime
+
+from flask import Response
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+try:
+    string_types = basestring
+    text_type = unicode
+except NameError:
+    string_types = str
+    text_type = str
+
+
+class RawJSON(text_type):
+    """Уже сериализованный JSON, который вставляется в ответ как есть."""
+
+
+def canonical_json(value):
+    # канонический компактный JSON для хранения в Data.json;
+    # строка считается JSON-текстом и должна разбираться, иначе ValueError
+    if isinstance(value, string_types):
+        value = std_json.loads(value)
+    text = std_json.dumps(value, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+    if isinstance(text, bytes):
+        text = text.decode('utf-8')
+    return text
+
+
+# Быстрый отсев: с чего может начинаться канонический JSON
+_JSON_START = re.compile(r'^(?:[{]["}]|\[[\]\[{"\-0-9tfn]|["\-0-9]|true$|false$|null$)')
+
+
+def _reject_constant(name):
+    raise ValueError('%s - not valid JSON' % name)
+
+
+def is_json(text):
+    # text - целый корректный JSON-документ; NaN и Infinity, которые
+    # принимает json.loads, в JSON недопустимы
+    try:
+        if orjson is not None:
+            orjson.loads(text)
+        else:
+            std_json.loads(text, parse_constant=_reject_constant)
+    except ValueError:
+        return False
+    return True
+
+
+def stored_json(text):
+    # Data.json в каноническом виде вставляется в ответ без повторной
+    # сериализации, но только после проверки, что это целый JSON: старые
+    # записи (repr питоновского объекта до system convert_data) вроде
+    # [1, None] или 123abc начинаются как JSON, но отдаются строкой, как раньше
+    if text and _JSON_START.match(text) and is_json(text):
+        return RawJSON(text)
+    return text
+
+
+# Дата и время в ответах - всегда в формате HTTP-date (RFC 1123, UTC), как
+# раньше отдавал jsonify: Sun, 18 Oct 2026 13:28:40 GMT
+_WEEKDAYS = ('Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun')
+_MONTHS = ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec')
+
+
+def format_datetime(value):
+    # datetime без tzinfo считается UTC; date - полночь
+    t = value.utctimetuple() if isinstance(value, datetime) else value.timetuple()
+    return u'%s, %02d %s %04d %02d:%02d:%02d GMT' % (
+        _WEEKDAYS[t.tm_wday], t.tm_mday, _MONTHS[t.tm_mon - 1], t.tm_year, t.tm_hour, t.tm_min, t.tm_sec)
+
+
+def _std_dumps(obj):
+    return std_json.dumps(obj, separators=(',', ':'), ensure_ascii=False)
+
+
+def _ujson_dumps(obj):
+    return ujson.dumps(obj, ensure_ascii=False, escape_forward_slashes=False)
+
+
+def _orjson_dumps(obj):
+    return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode('utf-8')
+
+
+# Кодировщики по убыванию скорости; auto - первый установленный
+ENCODERS = [
+    ('orjson', _orjson_dumps, orjson is not None),
+    ('ujson', _ujson_dumps, ujson is not None),
+    ('std', _std_dumps, True),
+]
+
+_encoder = {}
+
+
+def available_encoders():
+    return [name for name, func, installed in ENCODERS if installed]
+
+
+def set_encoder(name='auto'):
+    # JSON_ENCODER: auto, orjson, ujson или std; ValueError, если не установлен
+    if name == 'auto':
+        name = available_encoders()[0]
+    for encoder_name, func, installed in ENCODERS:
+        if encoder_name == name:
+            if not installed:
+                raise ValueError('JSON_ENCODER: %s не установлен' % name)
+            _encoder['name'] = name
+            _encoder['dumps'] = func
+            return name
+    raise ValueError('JSON_ENCODER: ожидается auto, %s' % ', '.join(name for name, _, _ in ENCODERS))
+
+
+def encoder_name():
+    return _encoder['name']
+
+
+set_encoder()
+
+
+# Место RawJSON-фрагмента в тексте; nonce сверяется при замене (одно
+# регулярное выражение на все вызовы, а не компиляция на каждый)
+_PLACEHOLDER = re.compile(r'"\\u0000raw:([0-9a-f]{8}):(\d+)"', re.IGNORECASE)
+
+
+def dumps(obj, encoder=None):
+    # компактный JSON текущим кодировщиком (encoder - имя другого) с датами
+    # в формате format_datetime и вставкой RawJSON-фрагментов как есть
+    fragments = []
+    nonce = binascii.hexlify(os.urandom(4)).decode('ascii')
+
+    def prepare(value):
+        if isinstance(value, RawJSON):
+            fragments.append(value)
+            return u'\x00raw:%s:%d' % (nonce, len(fragments) - 1)
+        if isinstance(value, string_types) or value is None or isinstance(value, (bool, int, float)):
+            return value
+        if isinstance(value, dict):
+            return dict((key, prepare(item)) for key, item in value.items())
+        if isinstance(value, (list, tuple)):
+            return [prepare(item) for item in value]
+        if isinstance(value, date):
+            return format_datetime(value)
+        if isinstance(value, uuid.UUID):
+            return str(value)
+        if hasattr(value, '__html__'):
+            return text_type(value.__html__())
+        return value
+
+    if encoder is None:
+        func = _encoder['dumps']
+    else:
+        func = dict((name, func) for name, func, installed in ENCODERS if installed)[encoder]
+    text = func(prepare(obj))
+    if isinstance(text, bytes):
+        text = text.decode('utf-8')
+    if not fragments:
+        return text
+
+    def insert(match):
+        if match.group(1).lower() != nonce:
+            return match.group(0)
+        return fragments[int(match.group(2))]
+
+    return _PLACEHOLDER.sub(insert, text)
+
+
+def json_response(obj, status=200):
+    # ответ всех JSON-эндпоинтов вместо jsonify: компактно и в любом режиме DEBUG
+    return Response(dumps(obj) + '\n', status=status, mimetype='application/json')
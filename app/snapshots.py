@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+
+from datetime import datetime
+
+from sqlalchemy import bindparam, literal
+
+from app.partitions import ID_SHIFT
+
+
+class LatestSnapshots(object):
+    """Последняя запись каждого парсера (таблица parser_latest).
+
+    Data.insert_many после вставки пачки копирует в parser_latest самую
+    новую (по id, то есть по времени записи) запись каждого парсера из
+    пачки - одним INSERT OR REPLACE ... SELECT по индексу (parser_id, id), в
+    той же транзакции. /api/v1.0/clients/latest читает по строке на парсер
+    без обращения к data. Снимок хранит копию json и остается, даже если
+    сама запись позже удалена очисткой; при удалении парсера удаляется
+    вместе с ним.
+    """
+
+    def record(self, number, table, parser_ids):
+        # обновить снимки парсеров parser_ids по разделу number в текущей транзакции сессии
+        from app import db
+
+        parser_ids = [parser_id for parser_id in set(parser_ids) if parser_id is not None]
+        if not parser_ids:
+            return
+        newest = db.select([table.c.id]).where(table.c.parser_id == bindparam('key_id')) \
+            .order_by(table.c.id.desc()).limit(1).as_scalar()
+        db.session.execute(self._copy(number, table, table.c.id == newest),
+                           [{'key_id': parser_id} for parser_id in parser_ids])
+
+    def rebuild(self, conn):
+        # заполнить снимки по всем разделам data; возвращает число снимков
+        from app import db, data_partitions
+        from app.models import Parser, ParserLatest
+
+        conn.execute(ParserLatest.__table__.delete())
+        partitions = [(0, 'data')]
+        if conn.engine.has_table('data_partitions'):
+            partitions += list(conn.execute('SELECT number, name FROM data_partitions WHERE number > 0 '
+                                            'ORDER BY number'))
+        # разделы по возрастанию: снимок из более нового раздела заменяет старый
+        for number, name in partitions:
+            table = data_partitions.table(number, name)
+            newest = db.select([db.func.max(table.c.id)]) \
+                .where(table.c.parser_id.in_(db.select([Parser.__table__.c.id]))) \
+                .group_by(table.c.parser_id)
+            conn.execute(self._copy(number, table, table.c.id.in_(newest)))
+        return conn.execute(db.select([db.func.count()]).select_from(ParserLatest.__table__)).scalar()
+
+    def _copy(self, number, table, condition):
+        from app import db
+        from app.models import ParserLatest
+
+        received = datetime.utcnow().replace(microsecond=0)
+        columns = [table.c.parser_id, (literal(number << ID_SHIFT) + table.c.id).label('data_id'),
+                   table.c.datestamp, table.c.json, literal(received, db.DateTime).label('updated_at')]
+        return ParserLatest.__table__.insert().prefix_with('OR REPLACE').from_select(
+            ['parser_id', 'data_id', 'datestamp', 'json', 'updated_at'], db.select(columns).where(condition))
+
+    def latest(self, parser_ids=None):
+        # [ParserLatest] по возрастанию parser_id
+        from app.models import ParserLatest
+
+        query = ParserLatest.query
+        if parser_ids:
+            query = query.filter(ParserLatest.parser_id.in_(parser_ids))
+        return query.order_by(ParserLatest.parser_id).all()
@@ -161,37 +161,28 @@ function del_parser(id) {
 
 
 function update_counters() {
+    counters = $('#dc-counters')
+
+    if (counters.length === 0) {
+        return
+    }
+
     $.get({
-        url: '/dash/v1.0/get_admin_counters',
+        url: counters.data('url'),
         dataType: 'json'
     }).done(
         function (data) {
 
-            el_admins = $('#admins_count')
-            el_moderators = $('#moderators_count')
-            el_parsers = $('#parsers_count')
-            el_clients = $('#clients_count')
-
-
-            console.log(data['data'])
+            console.log(data['resp_data'])
 
             if (data['success'] === true) {
 
-                if (el_admins[0].innerText != data['data'].admins_count) {
-                    el_admins[0].innerText = data['data'].admins_count
-                }
-
-                if (el_moderators[0].innerText != data['data'].moderators_count) {
-                    el_moderators[0].innerText = data['data'].moderators_count
-                }
-
-                if (el_parsers[0].innerText != data['data'].parsers_count) {
-                    el_parsers[0].innerText = data['data'].parsers_count
-                }
-
-                if (el_clients[0].innerText != data['data'].clients_count) {
-                    el_clients[0].innerText = data['data'].clients_count
-                }
+                $.each(data['resp_data'], function (name, value) {
+                    el = $('#' + name)
+                    if (el.length && el[0].innerText != value) {
+                        el[0].innerText = value
+                    }
+                })
 
             } else {
                 console.log(data['error'])
@@ -329,33 +320,6 @@ function update_token_expiration(id) {
 }
 
 
-function update_counters() {
-    $.get({
-        url: '/dash/v1.0/get_moderator_counters',
-        dataType: 'json'
-    }).done(
-        function (data) {
-
-            el_clients = $('#clients_count')
-
-            console.log(data['data'])
-
-            if (data['success'] === true) {
-
-                if (el_clients[0].innerText != data['data'].clients_count) {
-                    el_clients[0].innerText = data['data'].clients_count
-                }
-
-            } else {
-                console.log(data['error'])
-            }
-
-        }
-
-    )
-} 
-
-
 function convert_date(date_from_server){
 
     let arr, result
@@ -0,0 +1,93 @@
+var parser_table = $('#dc-parser-data-table')
+var parser_id = parser_table.data('parser-id')
+var page_size = parser_table.data('page-size')
+var next_cursor = null
+
+
+function escape_html(text) {
+    return $('<div>').text(text).html()
+}
+
+
+function parser_data_filters() {
+    var filters = {limit: page_size}
+    var date_from = $('#input_date_from')[0].value
+    var date_to = $('#input_date_to')[0].value
+
+    if (date_from !== "") {
+        filters['date_from'] = date_from
+    }
+    if (date_to !== "") {
+        filters['date_to'] = date_to
+    }
+    if (next_cursor !== null) {
+        $.extend(filters, next_cursor)
+    }
+    return filters
+}
+
+
+function append_parser_data_row(row) {
+    var json = escape_html(row['json'])
+
+    if (row['truncated'] === true) {
+        json += '… <a href="#" onclick="expand_parser_data(' + row['id'] + '); return false;">полностью (' + row['size'] + ')</a>'
+    }
+
+    parser_table.append('<tr id="data_row_' + row['id'] + '"> \
+        <th scope="row">' + row['id'] + '</th> \
+        <td class="text-nowrap">' + moment(row['datestamp']).format('LLL') + '</td> \
+        <td class="dc_data_json">' + json + '</td> \
+    </tr>')
+}
+
+
+function load_parser_data() {
+    $.ajax({
+        data: parser_data_filters(),
+        type: 'GET',
+        url: '/dash/v1.0/parser_data/' + parser_id
+    }).done(
+        function (data) {
+            if (data['success'] === true) {
+                $.each(data['resp_data'], function (index, row) {
+                    append_parser_data_row(row)
+                })
+                next_cursor = data['next_cursor']
+                $('#load_more_btn').toggle(next_cursor !== null)
+            } else {
+                alert(data['error'])
+            }
+        }
+    ).fail(
+        function (xhr) {
+            alert(xhr.responseJSON ? xhr.responseJSON['error'] : 'Ошибка получения данных!')
+        }
+    )
+}
+
+
+function reload_parser_data() {
+    next_cursor = null
+    parser_table.empty()
+    load_parser_data()
+}
+
+
+function expand_parser_data(id) {
+    $.ajax({
+        type: 'GET',
+        url: '/dash/v1.0/parser_data/' + parser_id + '/' + id
+    }).done(
+        function (data) {
+            if (data['success'] === true) {
+                $('#data_row_' + id).children('.dc_data_json').text(data['resp_data']['json'])
+            } else {
+                alert(data['error'])
+            }
+        }
+    )
+}
+
+
+load_parser_data()
@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+
+from flask import Response, request, stream_with_context
+from app.serialize import dumps
+
+
+NDJSON_MIMETYPE = 'application/x-ndjson'
+
+
+def wants_ndjson():
+    # потоковый режим: ?stream=1 или Accept: application/x-ndjson
+    if request.args.get('stream') in ('1', 'true'):
+        return True
+    best = request.accept_mimetypes.best_match(['application/json', NDJSON_MIMETYPE])
+    return best == NDJSON_MIMETYPE
+
+
+def ndjson_response(rows):
+    # rows - итератор словарей, каждый уходит клиенту отдельной строкой
+    # сразу после сериализации
+    def generate():
+        for row in rows:
+            yield dumps(row) + '\n'
+
+    return Response(stream_with_context(generate()), mimetype=NDJSON_MIMETYPE)
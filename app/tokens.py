@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+import hmac
+import os
+import threading
+import time
+from collections import namedtuple, OrderedDict
+from datetime import datetime
+
+from itsdangerous import BadSignature, TimedJSONWebSignatureSerializer
+
+
+# Что известно о владельце токена без запроса к базе
+TokenIdentity = namedtuple('TokenIdentity', ['kind', 'id', 'active', 'expiration'])
+
+
+class TokenCache(object):
+    """Кэш проверенных токенов клиентов и парсеров.
+
+    Ограничен по времени жизни записи (TOKEN_CACHE_TTL, секунды) и по
+    количеству записей (TOKEN_CACHE_SIZE, вытесняются давно не
+    использованные). Код, меняющий токен, срок его действия или статус
+    владельца, должен вызывать invalidate(token).
+    """
+
+    kinds = ('client', 'parser')
+
+    def __init__(self, app=None):
+        self.ttl = 60
+        self.max_size = 10000
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.ttl = app.config.get('TOKEN_CACHE_TTL', self.ttl)
+        self.max_size = app.config.get('TOKEN_CACHE_SIZE', self.max_size)
+        self.clear()
+
+    def get(self, kind, token):
+        key = (kind, token)
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return None
+            identity, cached_at = entry
+            if time.time() - cached_at > self.ttl:
+                return None
+            # переставляем в конец: самые старые по использованию в начале
+            self._entries[key] = entry
+            return identity
+
+    def set(self, token, identity):
+        if not self.ttl or not self.max_size:
+            return
+        key = (identity.kind, token)
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (identity, time.time())
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, token):
+        if not token:
+            return
+        with self._lock:
+            for kind in self.kinds:
+                self._entries.pop((kind, token), None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class UserSessions(object):
+    """Короткоживущие токены пользователей API и кэш проверенных паролей.
+
+    Токен выдается по /api/v1.0/auth/token после проверки Basic-авторизации
+    и действует USER_TOKEN_TTL секунд. Токен подписан SECRET_KEY
+    (TimedJSONWebSignatureSerializer) и содержит id пользователя и отпечаток
+    его password_hash, поэтому его принимает любой процесс приложения и после
+    перезапуска, а смена пароля отзывает все выданные токены. Проверенные
+    токены кэшируются в памяти процесса. Успешно проверенная пара
+    логин/пароль запоминается на USER_CREDENTIAL_CACHE_TTL секунд (в памяти
+    хранится только HMAC пароля), чтобы повторные Basic-запросы не считали
+    PBKDF2 заново.
+    """
+
+    salt = 'user-token'
+
+    def __init__(self, app=None):
+        self.token_ttl = 3600
+        self.credential_ttl = 300
+        self._secret = None
+        self._tokens = {}
+        self._credentials = {}
+        self._key = os.urandom(32)
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.token_ttl = app.config.get('USER_TOKEN_TTL', self.token_ttl)
+        self.credential_ttl = app.config.get('USER_CREDENTIAL_CACHE_TTL', self.credential_ttl)
+        self._secret = app.config['SECRET_KEY']
+        with self._lock:
+            self._tokens.clear()
+
+    def issue_token(self, user):
+        serializer = TimedJSONWebSignatureSerializer(self._secret, expires_in=self.token_ttl, salt=self.salt)
+        token = serializer.dumps({'id': user.id, 'stamp': self._stamp(user)}).decode('ascii')
+        expires_at = serializer.loads(token, return_header=True)[1]['exp']
+        return token, datetime.utcfromtimestamp(expires_at)
+
+    def verify_token(self, token, load_user):
+        # пользователь по токену или None; load_user(id) - пользователь из базы
+        with self._lock:
+            entry = self._tokens.get(token)
+        if entry is None or entry[2] < time.time():
+            serializer = TimedJSONWebSignatureSerializer(self._secret, salt=self.salt)
+            try:
+                payload, header = serializer.loads(token, return_header=True)
+                entry = (int(payload['id']), payload['stamp'], header['exp'])
+            except (BadSignature, KeyError, TypeError, ValueError):
+                with self._lock:
+                    self._tokens.pop(token, None)
+                return None
+            with self._lock:
+                self._purge(self._tokens, index=2)
+                self._tokens[token] = entry
+
+        user = load_user(entry[0])
+        # пароль сменили (в любом процессе) - токен больше не действует
+        if user is None or self._stamp(user) != entry[1]:
+            return None
+        return user
+
+    def _stamp(self, user):
+        password_hash = user.password_hash or ''
+        if not isinstance(password_hash, bytes):
+            password_hash = password_hash.encode('utf-8')
+        secret = self._secret if isinstance(self._secret, bytes) else self._secret.encode('utf-8')
+        return hmac.new(secret, password_hash, hashlib.sha256).hexdigest()[:16]
+
+    def remember_credentials(self, username, password, user_id):
+        if not self.credential_ttl:
+            return
+        key = self._credential_key(username, password)
+        with self._lock:
+            self._purge(self._credentials)
+            self._credentials[key] = (user_id, time.time() + self.credential_ttl)
+
+    def check_credentials(self, username, password):
+        key = self._credential_key(username, password)
+        with self._lock:
+            entry = self._credentials.get(key)
+            if entry is None:
+                return None
+            if entry[1] < time.time():
+                del self._credentials[key]
+                return None
+            return entry[0]
+
+    def forget_user(self, user_id):
+        # кэш этого процесса; в остальных токены отзывает отпечаток пароля,
+        # удаленного или отключенного пользователя отклоняет сама авторизация
+        with self._lock:
+            for store in (self._tokens, self._credentials):
+                for key in [key for key, entry in store.items() if entry[0] == user_id]:
+                    del store[key]
+
+    def _credential_key(self, username, password):
+        if not isinstance(password, bytes):
+            password = password.encode('utf-8')
+        return username, hmac.new(self._key, password, hashlib.sha256).digest()
+
+    def _purge(self, store, index=1):
+        now = time.time()
+        for key in [key for key, entry in store.items() if entry[index] < now]:
+            del store[key]
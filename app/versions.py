@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+from datetime import datetime, timedelta
+
+from flask import request
+from sqlalchemy import event
+from sqlalchemy.orm import attributes
+
+
+class Validator(object):
+    # ETag / Last-Modified для ответа и результат проверки условного запроса
+
+    def __init__(self, etag, last_modified, not_modified):
+        self.etag = etag
+        self.last_modified = last_modified
+        self.not_modified = not_modified
+
+    def apply(self, response):
+        response.set_etag(self.etag)
+        if self.last_modified is not None:
+            response.last_modified = self.last_modified
+        return response
+
+    def response(self):
+        from flask import current_app
+
+        return self.apply(current_app.response_class(status=304))
+
+
+class ChangeVersions(object):
+    """Версии таблиц для условных GET (таблица change_versions).
+
+    У каждого набора данных (data, users, parsers, clients) есть номер
+    версии и время последнего изменения. Пользователи, парсеры и клиенты
+    отмечаются в after_flush сессии, записи data - в Data.insert_many и при
+    очистке (app/retention.py), в той же транзакции, что и само изменение.
+    validator() до выполнения основного запроса эндпоинта читает нужные
+    версии одним запросом и строит ETag (версии + путь с параметрами +
+    область видимости пользователя) и Last-Modified; при совпадении с
+    If-None-Match / If-Modified-Since эндпоинт сразу отвечает 304.
+    """
+
+    # атрибуты пользователя, которые видны в ответах; вход и выход не меняют версию
+    USER_ATTRIBUTES = ('name', 'active', 'parent_id', 'roles')
+
+    def __init__(self, app=None):
+        self._listening = False
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        from app import db
+
+        if not self._listening:
+            event.listen(db.session, 'after_flush', self._after_flush)
+            self._listening = True
+
+    def bump(self, names, execute=None):
+        # новая версия наборов names в текущей транзакции сессии
+        from app import db
+        from app.models import ChangeVersion
+
+        execute = execute or db.session.execute
+        table = ChangeVersion.__table__
+        now = datetime.utcnow().replace(microsecond=0)
+        for name in sorted(set(names)):
+            result = execute(table.update().where(table.c.name == name)
+                             .values(version=table.c.version + 1, changed_at=now))
+            if result.rowcount == 0:
+                execute(table.insert().values(name=name, version=1, changed_at=now))
+
+    def get(self, names):
+        # {name: (version, changed_at)}; набор без изменений - (0, None)
+        from app import db
+        from app.models import ChangeVersion
+
+        result = dict((name, (0, None)) for name in names)
+        rows = db.session.query(ChangeVersion.name, ChangeVersion.version, ChangeVersion.changed_at) \
+            .filter(ChangeVersion.name.in_(names))
+        for name, version, changed_at in rows:
+            result[name] = (version, changed_at)
+        return result
+
+    def validator(self, names, *scope):
+        # Validator для текущего запроса; scope - то, от чего еще зависит ответ
+        # (например, id пользователя, для которого фильтруются строки)
+        versions = self.get(names)
+        key = [request.full_path] + ['%s:%d' % (name, versions[name][0]) for name in sorted(versions)]
+        key += [str(part) for part in scope]
+        etag = hashlib.sha1('|'.join(key).encode('utf-8')).hexdigest()[:20]
+
+        stamps = [changed_at for version, changed_at in versions.values() if changed_at is not None]
+        last_modified = max(stamps) if stamps else None
+
+        if request.if_none_match:
+            not_modified = request.if_none_match.contains_weak(etag)
+        elif request.if_modified_since and last_modified is not None:
+            # Last-Modified с точностью до секунды: изменение в текущую секунду
+            # может быть еще не видно клиенту, такой запрос выполняется полностью
+            since = request.if_modified_since.replace(tzinfo=None)
+            not_modified = last_modified <= since and datetime.utcnow() - last_modified >= timedelta(seconds=1)
+        else:
+            not_modified = False
+        return Validator(etag, last_modified, not_modified)
+
+    def _after_flush(self, session, flush_context):
+        from app.models import Client, Parser, User
+
+        names = set()
+        for obj in list(session.new) + list(session.deleted):
+            if isinstance(obj, User):
+                names.add('users')
+            elif isinstance(obj, Parser):
+                names.add('parsers')
+            elif isinstance(obj, Client):
+                names.add('clients')
+        for obj in session.dirty:
+            if isinstance(obj, User):
+                if any(_changed(obj, key) for key in self.USER_ATTRIBUTES):
+                    names.add('users')
+            elif isinstance(obj, Parser) and session.is_modified(obj):
+                names.add('parsers')
+            elif isinstance(obj, Client) and session.is_modified(obj):
+                names.add('clients')
+        if names:
+            self.bump(names, session.connection().execute)
+
+
+def _changed(obj, key):
+    return attributes.get_history(obj, key, passive=attributes.PASSIVE_NO_INITIALIZE).has_changes()
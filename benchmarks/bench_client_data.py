@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+
+"""Выдача данных клиентам: get_data с разным count, с фильтром по
+парсеру, инкрементальный опрос по after_id, потоковая выдача NDJSON и
+выгрузка /clients/export в каждом доступном формате против того же числа
+записей, прочитанных постранично через get_data."""
+
+import json
+
+from benchmarks.common import summarize, timed
+
+
+COUNTS = (10, 100, 1000)
+STREAM_COUNT = 10000
+EXPORT_COUNT = 10000
+
+
+def _measure(ctx, url):
+    times = []
+    size = 0
+    for _ in range(ctx.repeat):
+        token = ctx.rng.choice(ctx.seeded['client_tokens'])
+
+        def fetch():
+            # тело потокового ответа тестовый клиент отдает лениво - читается здесь же
+            response = ctx.client.get(url, headers={'Authorization': 'Bearer ' + token})
+            return response, response.get_data()
+
+        (response, body), elapsed = timed(fetch)
+        assert response.status_code == 200, body
+        size = len(body)
+        times.append(elapsed)
+    return dict(summarize(times), bytes=size)
+
+
+def _measure_paged(ctx, total, page):
+    # total записей страницами по page, как клиент листает историю
+    times = []
+    size = 0
+    for _ in range(ctx.repeat):
+        token = ctx.rng.choice(ctx.seeded['client_tokens'])
+        headers = {'Authorization': 'Bearer ' + token}
+
+        def fetch():
+            url = '/api/v1.0/clients/get_data/%d' % page
+            fetched = sent = 0
+            while fetched < total:
+                response = ctx.client.get(url, headers=headers)
+                assert response.status_code == 200, response.data
+                sent += len(response.get_data())
+                body = json.loads(response.get_data(as_text=True))
+                fetched += len(body['resp_data'])
+                if not body['next_cursor']:
+                    break
+                url = '/api/v1.0/clients/get_data/%d?before_id=%d' % (page, body['next_cursor']['before_id'])
+            return sent
+
+        size, elapsed = timed(fetch)
+        times.append(elapsed)
+    return dict(summarize(times), bytes=size)
+
+
+def run(ctx):
+    from app.export import available_formats
+    from app.models import Data
+
+    results = {}
+    for count in COUNTS:
+        results['get_data_%d' % count] = _measure(ctx, '/api/v1.0/clients/get_data/%d' % count)
+
+    parser_id = ctx.seeded['parsers'][0]['id']
+    results['get_data_100_parser'] = _measure(ctx, '/api/v1.0/clients/get_data/100?parser_id=%d' % parser_id)
+
+    with ctx.app.app_context():
+        last_id = Data.max_id()
+    results['get_data_poll'] = _measure(ctx, '/api/v1.0/clients/get_data/100?after_id=%d' % max(last_id - 50, 0))
+
+    # тело потокового ответа читается целиком внутри замера
+    results['stream_%d' % STREAM_COUNT] = _measure(ctx, '/api/v1.0/clients/get_data/%d?stream=1' % STREAM_COUNT)
+
+    results['paged_%d' % EXPORT_COUNT] = _measure_paged(ctx, EXPORT_COUNT, 1000)
+    for name in available_formats():
+        results['export_%s_%d' % (name, EXPORT_COUNT)] = _measure(
+            ctx, '/api/v1.0/clients/export?format=%s&before_id=%d&limit=%d' % (name, last_id + 1, EXPORT_COUNT))
+
+    return results
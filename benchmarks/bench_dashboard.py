@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+
+"""Страницы дашборда по ролям: /user/<id>, /parser/<id> и подгрузка
+данных парсера /dash/v1.0/parser_data/<id>."""
+
+from benchmarks.common import ROOT_PASSWORD, summarize, timed
+
+
+def _measure(ctx, client, url):
+    times = []
+    for _ in range(ctx.repeat):
+        response, elapsed = timed(lambda: client.get(url))
+        assert response.status_code == 200, (url, response.status_code)
+        times.append(elapsed)
+    return summarize(times)
+
+
+def run(ctx):
+    seeded = ctx.seeded
+    parser_id = seeded['parsers'][0]['id']
+    users = [
+        ('root', 'root', ROOT_PASSWORD),
+        ('admin', seeded['admins'][0], seeded['password']),
+        ('moderator', seeded['moderators'][0], seeded['password']),
+    ]
+
+    results = {}
+    for role, name, password in users:
+        client = ctx.login(name, password)
+        results['user_page_%s' % role] = _measure(ctx, client, '/user/%d' % ctx.user_id(name))
+        if role != 'moderator':
+            # парсер seed_parser_0 принадлежит первому admin
+            results['parser_page_%s' % role] = _measure(ctx, client, '/parser/%d' % parser_id)
+            results['parser_data_%s' % role] = _measure(ctx, client, '/dash/v1.0/parser_data/%d' % parser_id)
+    return results
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+
+"""Параллельная нагрузка для каждого профиля базы (app/database.py):
+WRITERS потоков пишут пачки через set_data_batch, READERS потоков читают
+get_data и clients/latest, DURATION секунд на профиль. Каждый профиль
+работает на своей копии базы; кроме задержек считаются ошибки и время
+ожидания блокировки записи (db_profile.lock_stats)."""
+
+import json
+import os
+import random
+import threading
+from datetime import datetime
+from timeit import default_timer
+
+from app.seed import kwork_payload
+
+from benchmarks.common import bench_config, copy_database, summarize
+
+
+PROFILES = ('legacy', 'concurrent', 'durable')
+WRITERS = 4
+READERS = 8
+DURATION = 5.0
+BATCH_SIZE = 20
+
+
+def _database_path(app):
+    return app.config['SQLALCHEMY_DATABASE_URI'][len('sqlite:///'):]
+
+
+def _remove(path):
+    for name in (path, path + '-wal', path + '-shm', path + '.spool', path + '.spool.checkpoint'):
+        if os.path.exists(name):
+            os.remove(name)
+
+
+def _writer(app, parser, rng, deadline, sink):
+    client = app.test_client()
+    headers = {'Authorization': 'Bearer ' + parser['token']}
+    while default_timer() < deadline:
+        records = [{
+            'datestamp': datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S.%f'),
+            'json': kwork_payload(rng, 5000000 + rng.randint(0, 10 ** 6))
+        } for _ in range(BATCH_SIZE)]
+        body = json.dumps({'records': records})
+        started = default_timer()
+        response = client.post('/api/v1.0/parsers/set_data_batch', data=body,
+                               content_type='application/json', headers=headers)
+        sink.append(('write', default_timer() - started, response.status_code == 200))
+
+
+def _reader(app, token, deadline, sink):
+    client = app.test_client()
+    headers = {'Authorization': 'Bearer ' + token}
+    urls = (('get_data', '/api/v1.0/clients/get_data/100'), ('latest', '/api/v1.0/clients/latest'))
+    index = 0
+    while default_timer() < deadline:
+        kind, url = urls[index % len(urls)]
+        started = default_timer()
+        response = client.get(url, headers=headers)
+        response.get_data()
+        sink.append((kind, default_timer() - started, response.status_code == 200))
+        index += 1
+
+
+def run_profile(ctx, name):
+    from app import activity_tracker, create_app, db, db_profile
+
+    source = _database_path(ctx.app)
+    path = '%s.profile-%s' % (source, name)
+    _remove(path)
+    copy_database(ctx.app, source, path)
+
+    app = create_app(bench_config(path, DB_PROFILE=name,
+                                  DATA_PARTITIONING=ctx.app.config.get('DATA_PARTITIONING')))
+    db_profile.lock_stats.reset()
+
+    # list.append атомарен, общий список для всех потоков
+    sink = []
+    deadline = default_timer() + DURATION
+    parsers = ctx.seeded['parsers']
+    tokens = ctx.seeded['client_tokens']
+    threads = [threading.Thread(target=_writer, args=(app, parsers[i % len(parsers)],
+                                                      random.Random(i), deadline, sink))
+               for i in range(WRITERS)]
+    threads += [threading.Thread(target=_reader, args=(app, tokens[i % len(tokens)], deadline, sink))
+                for i in range(READERS)]
+    started = default_timer()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = default_timer() - started
+
+    results = {}
+    for kind in sorted(set(item[0] for item in sink)):
+        items = [item for item in sink if item[0] == kind]
+        results[kind] = dict(summarize([item[1] for item in items]),
+                             per_sec=len(items) / elapsed,
+                             errors=sum(1 for item in items if not item[2]))
+    results['write']['rows_per_sec'] = (results['write']['n'] - results['write']['errors']) * BATCH_SIZE / elapsed
+    results['write_lock'] = db_profile.lock_stats.to_dict()
+    with app.app_context():
+        results['pool'] = db_profile.pool_status(db.engine)
+    activity_tracker.flush()
+    with app.app_context():
+        db.session.remove()
+        db.engine.dispose()
+    _remove(path)
+
+    # расширения-синглтоны снова работают с основным приложением бенчмарков
+    activity_tracker.init_app(ctx.app)
+    db_profile.init_app(ctx.app)
+    return results
+
+
+def run(ctx):
+    return dict((name, run_profile(ctx, name)) for name in PROFILES)
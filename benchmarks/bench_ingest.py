@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+
+"""Прием данных от парсеров: set_data по одной записи и set_data_batch."""
+
+import json
+from datetime import datetime
+
+from app.seed import kwork_payload
+
+from benchmarks.common import summarize, timed
+
+
+BATCH_SIZE = 100
+
+
+def _record(ctx, project_id):
+    return {
+        'datestamp': datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S.%f'),
+        'json': kwork_payload(ctx.rng, project_id)
+    }
+
+
+def run(ctx):
+    parsers = ctx.seeded['parsers']
+    requests = ctx.repeat * 10
+    results = {}
+
+    times = []
+    for index in range(requests):
+        parser = ctx.rng.choice(parsers)
+        body = json.dumps(_record(ctx, 2000000 + index))
+        response, elapsed = timed(lambda: ctx.client.post(
+            '/api/v1.0/parsers/set_data', data=body, content_type='application/json',
+            headers={'Authorization': 'Bearer ' + parser['token']}))
+        assert response.status_code == 200, response.data
+        times.append(elapsed)
+    results['set_data'] = dict(summarize(times), rows_per_sec=len(times) / sum(times))
+
+    times = []
+    for index in range(ctx.repeat):
+        parser = ctx.rng.choice(parsers)
+        records = [_record(ctx, 3000000 + index * BATCH_SIZE + offset) for offset in range(BATCH_SIZE)]
+        body = json.dumps({'records': records})
+        response, elapsed = timed(lambda: ctx.client.post(
+            '/api/v1.0/parsers/set_data_batch', data=body, content_type='application/json',
+            headers={'Authorization': 'Bearer ' + parser['token']}))
+        assert response.status_code == 200, response.data
+        times.append(elapsed)
+    results['set_data_batch'] = dict(summarize(times), batch=BATCH_SIZE,
+                                     rows_per_sec=len(times) * BATCH_SIZE / sum(times))
+
+    return results
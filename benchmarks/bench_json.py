@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+
+"""Сериализация ответа get_data разными кодировщиками app/serialize.py
+(std и установленные orjson / ujson) и прежним путем jsonify
+(flask.json.dumps) - без базы и HTTP, только dumps конверта api_resp.
+
+    python -m benchmarks.bench_json --repeat 50
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.common import summarize, timed
+
+
+COUNTS = (100, 1000, 10000)
+
+
+def client_data_payload(rng, count):
+    # конверт get_client_data: json записей хранится сериализованным (RawJSON)
+    from app.seed import kwork_payload
+    from app.serialize import RawJSON, canonical_json
+
+    now = datetime(2024, 1, 1)
+    rows = [{
+        'id': 1000000 - i,
+        'parser_id': rng.randint(1, 10),
+        'datestamp': now - timedelta(seconds=i * 37),
+        'json': RawJSON(canonical_json(kwork_payload(rng, 1000000 - i)))
+    } for i in range(count)]
+    return {
+        'url': '/api/v1.0/clients/get_data/<count>',
+        'method': 'GET',
+        'success': True,
+        'resp_data': rows,
+        'error': '',
+        'next_cursor': {'before_id': rows[-1]['id']}
+    }
+
+
+def _measure(repeat, func):
+    times = []
+    text = None
+    for _ in range(repeat):
+        text, elapsed = timed(func)
+        times.append(elapsed)
+    return dict(summarize(times), bytes=len(text.encode('utf-8')))
+
+
+def run(ctx):
+    return run_encoders(ctx.rng, ctx.repeat)
+
+
+def run_encoders(rng, repeat):
+    from flask import json as flask_json
+    from app.serialize import available_encoders, dumps
+
+    results = {}
+    for count in COUNTS:
+        payload = client_data_payload(rng, count)
+        expected = json.loads(dumps(payload, encoder='std'))
+        for name in available_encoders():
+            # все кодировщики должны давать один и тот же документ
+            assert json.loads(dumps(payload, encoder=name)) == expected, name
+            results['%s_%d' % (name, count)] = _measure(repeat, lambda: dumps(payload, encoder=name))
+        # прежний путь: json записей уходит экранированной строкой
+        results['jsonify_%d' % count] = _measure(repeat, lambda: flask_json.dumps(payload))
+        std = results['std_%d' % count]['mean_ms']
+        for name in available_encoders():
+            results['%s_%d' % (name, count)]['speedup_vs_std'] = std / results['%s_%d' % (name, count)]['mean_ms']
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='JSON encoder microbenchmark')
+    parser.add_argument('--repeat', type=int, default=20, help='Serializations per measurement')
+    parser.add_argument('--seed', type=int, default=1, help='Random seed')
+    args = parser.parse_args(argv)
+
+    results = run_encoders(random.Random(args.seed), args.repeat)
+    json.dump(results, sys.stdout, indent=2, sort_keys=True)
+    sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
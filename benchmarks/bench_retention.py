@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+
+"""Удаление устаревших данных (remove_data / retention): половина
+записей каждого парсера удаляется чанками без пауз между ними."""
+
+from datetime import datetime
+
+from benchmarks.common import timed
+
+
+def run(ctx):
+    from app import retention
+
+    first = datetime.strptime(ctx.seeded['first'], '%Y-%m-%d %H:%M:%S')
+    last = datetime.strptime(ctx.seeded['last'], '%Y-%m-%d %H:%M:%S')
+    cutoff = first + (last - first) // 2
+
+    pause = retention.pause
+    retention.pause = 0
+    try:
+        with ctx.app.app_context():
+            results, elapsed = timed(lambda: [retention.purge(parser['id'], cutoff)
+                                              for parser in ctx.seeded['parsers']])
+    finally:
+        retention.pause = pause
+
+    removed = sum(result.removed for result in results)
+    return {
+        'purge': {
+            'removed': removed,
+            'chunk': retention.chunk,
+            'seconds': elapsed,
+            'rows_per_sec': removed / elapsed if elapsed else None
+        }
+    }
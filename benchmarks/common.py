@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+
+"""Общие части бенчмарков: конфигурация приложения на отдельном файле
+SQLite, подготовка базы (initdb + seed, снимок переиспользуется между
+запусками), замер времени и запись результатов в JSON."""
+
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+from datetime import datetime
+from timeit import default_timer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+from werkzeug.security import generate_password_hash
+
+from app import create_app, db, migrations
+from app.config import Config
+
+
+ROOT_PASSWORD = 'root'
+
+
+def bench_config(path, **overrides):
+    # Config приложения с базой в path; фоновые потоки (очистка, запись
+    # отметок активности) выключены, чтобы не мешать замерам
+    attrs = {
+        'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + os.path.abspath(path),
+        'DEBUG': False,
+        'WTF_CSRF_ENABLED': False,
+        'RETENTION_INTERVAL': 0,
+        'BACKGROUND_JOBS': False,
+        'INGEST_SPOOL_PATH': os.path.abspath(path) + '.spool',
+        'RETENTION_LOCK_PATH': os.path.abspath(path) + '.retention.lock',
+    }
+    attrs.update(overrides)
+    return type('BenchConfig', (Config,), attrs)
+
+
+def init_database(app):
+    # то же, что flask system initdb
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        migrations.stamp(db.engine)
+        roles = dict((name, app.user_datastore.create_role(name=name)) for name in ('root', 'admin', 'moderator'))
+        root = app.user_datastore.create_user(name='root', password_hash=generate_password_hash(ROOT_PASSWORD))
+        db.session.commit()
+        root.parent_id = root.id
+        app.user_datastore.add_role_to_user(root, roles['root'])
+        db.session.commit()
+
+
+def prepare_database(path, params, overrides=None, echo=None):
+    """Создать приложение на базе path с тестовыми данными по params.
+    Данные берутся из снимка path + '.seed', если он сделан с теми же
+    params, иначе генерируются заново и сохраняются в снимок. Возвращает
+    (app, описание данных от seed_database)."""
+
+    from app.seed import seed_database
+
+    snapshot = path + '.seed'
+    meta_path = snapshot + '.json'
+    meta = None
+    if os.path.exists(snapshot) and os.path.exists(meta_path):
+        with open(meta_path) as f:
+            meta = json.load(f)
+        if meta.get('params') != params:
+            meta = None
+
+    # -wal/-shm от прошлого прогона испортили бы скопированную базу
+    for name in (path, path + '-wal', path + '-shm', path + '.spool', path + '.spool.checkpoint'):
+        if os.path.exists(name):
+            os.remove(name)
+
+    if meta is not None:
+        shutil.copyfile(snapshot, path)
+        return create_app(bench_config(path, **(overrides or {}))), meta['seeded']
+
+    app = create_app(bench_config(path, **(overrides or {})))
+    init_database(app)
+    with app.app_context():
+        seeded = seed_database(app, echo=echo, **params)
+    copy_database(app, path, snapshot)
+    with open(meta_path, 'w') as f:
+        json.dump({'params': params, 'seeded': seeded}, f)
+    return app, seeded
+
+
+def copy_database(app, path, target):
+    # копия файла базы path; в режиме WAL изменения сначала переносятся из -wal
+    with app.app_context():
+        db.session.remove()
+        db.engine.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+    shutil.copyfile(path, target)
+
+
+def summarize(times):
+    # статистика по списку длительностей в секундах
+    times = sorted(times)
+    if not times:
+        return {'n': 0}
+    return {
+        'n': len(times),
+        'mean_ms': sum(times) * 1000 / len(times),
+        'p50_ms': times[len(times) // 2] * 1000,
+        'p95_ms': times[min(len(times) - 1, int(len(times) * 0.95))] * 1000,
+        'min_ms': times[0] * 1000,
+        'max_ms': times[-1] * 1000,
+    }
+
+
+def timed(func):
+    # (результат, секунды)
+    started = default_timer()
+    result = func()
+    return result, default_timer() - started
+
+
+class BenchContext(object):
+    # приложение, тестовый клиент и описание данных для модулей bench_*
+
+    def __init__(self, app, seeded, repeat=20, random_seed=1):
+        self.app = app
+        self.seeded = seeded
+        self.repeat = repeat
+        self.rng = random.Random(random_seed)
+        self.client = app.test_client()
+
+    def login(self, name, password):
+        # тестовый клиент с сессией пользователя дашборда
+        client = self.app.test_client()
+        response = client.post('/login', data={'name': name, 'password': password})
+        if response.status_code != 302:
+            raise RuntimeError('Не удалось войти как %s' % name)
+        return client
+
+    def user_id(self, name):
+        from app.models import User
+
+        with self.app.app_context():
+            return User.query.filter_by(name=name).first().id
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT,
+                                       stderr=subprocess.STDOUT).decode('utf-8').strip()
+    except Exception:
+        return None
+
+
+def write_results(path, params, results):
+    report = {
+        'started': datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S'),
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'params': params,
+        'results': results,
+    }
+    directory = os.path.dirname(os.path.abspath(path))
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    return report
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+
+"""Воспроизводимый набор бенчмарков на локальном файле SQLite.
+
+    python -m benchmarks.run --rows 1000000 --clients 10000
+    python -m benchmarks.run --only client_data,dashboard --repeat 50
+
+База заполняется генератором app/seed.py (как flask system seed) с
+фиксированным --seed; заполненная база сохраняется рядом с --db
+(<db>.seed) и переиспользуется, пока не изменятся параметры данных.
+Результаты пишутся в JSON (--output) вместе с ревизией git и версией
+Python, чтобы прогоны до и после изменения можно было сравнить.
+"""
+
+import argparse
+import json
+import os
+import sys
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks import (bench_client_data, bench_dashboard, bench_database, bench_ingest, bench_json,
+                        bench_retention)
+from app.database import PROFILES
+from benchmarks.common import BenchContext, prepare_database, timed, write_results
+
+
+# retention удаляет данные, поэтому идет последним
+BENCHMARKS = [
+    ('ingest', bench_ingest),
+    ('client_data', bench_client_data),
+    ('dashboard', bench_dashboard),
+    ('json', bench_json),
+    ('database', bench_database),
+    ('retention', bench_retention),
+]
+
+
+def main(argv=None):
+    here = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description='kwork_dashboard benchmarks')
+    parser.add_argument('--db', default=os.path.join(here, 'bench.db'), help='SQLite file for the run')
+    parser.add_argument('--output', default=None, help='JSON results (default benchmarks/results/<time>.json)')
+    parser.add_argument('--only', default=None, help='Comma separated: ' + ','.join(name for name, _ in BENCHMARKS))
+    parser.add_argument('--repeat', type=int, default=20, help='Requests per measurement')
+    parser.add_argument('--admins', type=int, default=2)
+    parser.add_argument('--moderators', type=int, default=10)
+    parser.add_argument('--parsers', type=int, default=10)
+    parser.add_argument('--clients', type=int, default=1000)
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--days', type=int, default=30)
+    parser.add_argument('--seed', type=int, default=1, help='Random seed')
+    parser.add_argument('--partitioning', default=None, choices=['day', 'month'], help='DATA_PARTITIONING')
+    parser.add_argument('--db-profile', default=None, choices=sorted(PROFILES), help='DB_PROFILE')
+    args = parser.parse_args(argv)
+
+    selected = args.only.split(',') if args.only else [name for name, _ in BENCHMARKS]
+    unknown = set(selected) - set(name for name, _ in BENCHMARKS)
+    if unknown:
+        parser.error('unknown benchmark: %s' % ', '.join(sorted(unknown)))
+
+    data_params = {
+        'admins': args.admins,
+        'moderators': args.moderators,
+        'parsers': args.parsers,
+        'clients': args.clients,
+        'rows': args.rows,
+        'days': args.days,
+        'random_seed': args.seed,
+    }
+    overrides = {'DATA_PARTITIONING': args.partitioning, 'DB_PROFILE': args.db_profile}
+
+    def echo(message):
+        sys.stderr.write(message + '\n')
+
+    (app, seeded), seconds = timed(lambda: prepare_database(args.db, data_params, overrides, echo=echo))
+    echo('Database ready in %.1fs' % seconds)
+
+    ctx = BenchContext(app, seeded, repeat=args.repeat, random_seed=args.seed)
+    results = {}
+    for name, module in BENCHMARKS:
+        if name in selected:
+            echo('Running %s' % name)
+            results[name] = module.run(ctx)
+
+    output = args.output or os.path.join(here, 'results', datetime.utcnow().strftime('%Y%m%d-%H%M%S') + '.json')
+    params = dict(data_params, repeat=args.repeat, partitioning=args.partitioning, db_profile=args.db_profile,
+                  only=selected)
+    report = write_results(output, params, results)
+    json.dump(report['results'], sys.stdout, indent=2, sort_keys=True)
+    sys.stdout.write('\n')
+    echo('Results: %s' % output)
+
+
+if __name__ == '__main__':
+    main()
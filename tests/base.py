@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+
+"""Общая часть тестов: приложение на временном файле SQLite, созданном как
+flask system initdb (benchmarks/common.py), и данные из app/seed.py."""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from app import activity_tracker, create_app, db
+from app.seed import seed_database
+from benchmarks.common import bench_config, init_database
+
+
+class AppTestCase(unittest.TestCase):
+    # seed - параметры seed_database для класса, None - только initdb
+    seed = None
+    config = {}
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp()
+        path = os.path.join(cls.directory, 'test.db')
+        cls.app = create_app(bench_config(path, **dict({'SQL_INSTRUMENTATION': False,
+                                                        'COMPRESSION_ENABLED': False}, **cls.config)))
+        init_database(cls.app)
+        cls.seeded = None
+        if cls.seed is not None:
+            with cls.app.app_context():
+                cls.seeded = seed_database(cls.app, **cls.seed)
+                db.session.remove()
+
+    @classmethod
+    def tearDownClass(cls):
+        # отметки входа пишутся в базу до ее удаления
+        activity_tracker.flush()
+        with cls.app.app_context():
+            db.session.remove()
+            db.engine.dispose()
+        shutil.rmtree(cls.directory)
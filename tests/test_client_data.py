@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+
+"""/api/v1.0/clients/get_data: пустые страницы и курсор next_cursor."""
+
+import json
+import unittest
+
+from tests.base import AppTestCase
+
+
+class ClientDataTest(AppTestCase):
+
+    seed = {'admins': 1, 'moderators': 1, 'parsers': 1, 'clients': 1, 'rows': 5}
+
+    def get_data(self, url):
+        client = self.app.test_client()
+        response = client.get(url, headers={'Authorization': 'Bearer ' + self.seeded['client_tokens'][0]})
+        self.assertEqual(response.status_code, 200, response.data)
+        return json.loads(response.get_data(as_text=True))
+
+    def test_page(self):
+        body = self.get_data('/api/v1.0/clients/get_data/3')
+        self.assertEqual(len(body['resp_data']), 3)
+        self.assertEqual(body['next_cursor'], {'before_id': body['resp_data'][-1]['id']})
+
+    def test_count_zero(self):
+        body = self.get_data('/api/v1.0/clients/get_data/0')
+        self.assertTrue(body['success'])
+        self.assertEqual(body['resp_data'], [])
+        self.assertIsNone(body['next_cursor'])
+
+    def test_empty_result(self):
+        body = self.get_data('/api/v1.0/clients/get_data/10?before_id=1')
+        self.assertEqual(body['resp_data'], [])
+        self.assertIsNone(body['next_cursor'])
+
+    def test_empty_poll(self):
+        # опрос без новых записей продолжается с того же места
+        body = self.get_data('/api/v1.0/clients/get_data/10?after_id=1000000')
+        self.assertEqual(body['resp_data'], [])
+        self.assertEqual(body['next_cursor'], {'after_id': 1000000})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+
+"""Новая база (flask system initdb, create_app на пустом файле) проходит
+flask system verify-schema."""
+
+import os
+import unittest
+
+from app import create_app, db, migrations
+from benchmarks.common import bench_config
+from tests.base import AppTestCase
+
+
+class FreshDatabaseTest(AppTestCase):
+
+    def assertVerified(self, app):
+        with app.app_context():
+            self.assertEqual(migrations.pending(db.engine), [])
+            results = migrations.verify(db.engine)
+        self.assertEqual([(m.version, ok, message) for m, ok, message in results if not ok], [])
+        self.assertEqual(len(results), len([m for m in migrations.MIGRATIONS if m.verify is not None]))
+
+    def test_initdb(self):
+        self.assertVerified(self.app)
+
+    def test_create_app(self):
+        path = os.path.join(self.directory, 'new.db')
+        app = create_app(bench_config(path, SQL_INSTRUMENTATION=False))
+        try:
+            self.assertVerified(app)
+        finally:
+            with app.app_context():
+                db.session.remove()
+                db.engine.dispose()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+
+"""Число SQL-запросов на страницу пользователя дашборда и на списки API
+для каждой роли при 10 000 клиентов: владельцы и роли строк должны
+грузиться теми же запросами, а не по запросу на строку (N+1).
+
+    python -m unittest discover -s tests -t .
+"""
+
+import base64
+import unittest
+
+from sqlalchemy import event
+
+from app import db
+from benchmarks.common import ROOT_PASSWORD
+from tests.base import AppTestCase
+
+
+CLIENTS = 10000
+
+# Верхняя граница числа запросов на страницу/ответ; не зависит от CLIENTS
+MAX_QUERIES = {
+    'user_page': {'root': 7, 'admin': 7, 'moderator': 4},
+    'clients_get': {'root': 4, 'admin': 4, 'moderator': 4},
+}
+
+
+class QueryCountTest(AppTestCase):
+
+    seed = {'admins': 2, 'moderators': 10, 'parsers': 10, 'clients': CLIENTS, 'rows': 0}
+
+    @classmethod
+    def setUpClass(cls):
+        super(QueryCountTest, cls).setUpClass()
+        cls.users = {
+            'root': ('root', ROOT_PASSWORD),
+            'admin': (cls.seeded['admins'][0], cls.seeded['password']),
+            'moderator': (cls.seeded['moderators'][0], cls.seeded['password']),
+        }
+
+    def count_queries(self, func):
+        # (ответ, число запросов к базе за время func)
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        with self.app.app_context():
+            engine = db.engine
+        event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            response = func()
+        finally:
+            event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+        return response, len(statements)
+
+    def user_id(self, name):
+        from app.models import User
+
+        with self.app.app_context():
+            return User.query.filter_by(name=name).first().id
+
+    def login(self, name, password):
+        client = self.app.test_client()
+        response = client.post('/login', data={'name': name, 'password': password})
+        self.assertEqual(response.status_code, 302)
+        return client
+
+    def test_user_page(self):
+        for role, (name, password) in sorted(self.users.items()):
+            client = self.login(name, password)
+            url = '/user/%d' % self.user_id(name)
+            client.get(url)
+            response, queries = self.count_queries(lambda: client.get(url))
+            self.assertEqual(response.status_code, 200, role)
+            self.assertLessEqual(queries, MAX_QUERIES['user_page'][role], role)
+
+    def test_clients_get(self):
+        for role, (name, password) in sorted(self.users.items()):
+            client = self.app.test_client()
+            credentials = base64.b64encode(('%s:%s' % (name, password)).encode('utf-8')).decode('ascii')
+            headers = {'Authorization': 'Basic ' + credentials}
+            client.get('/api/v1.0/clients/get', headers=headers)
+            response, queries = self.count_queries(lambda: client.get('/api/v1.0/clients/get', headers=headers))
+            self.assertEqual(response.status_code, 200, role)
+            self.assertLessEqual(queries, MAX_QUERIES['clients_get'][role], role)
+
+
+if __name__ == '__main__':
+    unittest.main()